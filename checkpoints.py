@@ -0,0 +1,84 @@
+"""
+
+Resumable training checkpoints.
+
+A checkpoint holds everything train_dl_model needs to continue a run as if it had not been
+stopped: model, optimizer and grad scaler state, the number of finished epochs and training
+steps, the best val F1, the metrics sink progress and the python / numpy / torch RNG states.
+The RNG states cover the data order, as the samplers draw from them at the start of every epoch.
+
+Checkpoints are written at epoch ends on a background thread, to a temporary file that is then
+renamed over the previous checkpoint, so a run preempted mid write keeps the last good one.
+
+"""
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+def to_cpu(obj):
+    """ Returns a copy of obj with all tensors (also inside dicts, lists and tuples) cloned to the CPU
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+def rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_atomic(state, path):
+    """ Saves state to path through a temporary file, so path always holds a complete checkpoint
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointWriter(object):
+    """ Writes checkpoints on a background thread, one at a time. The state is copied to the
+        CPU before write returns, so training can go on updating the model.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+
+    def write(self, state):
+        state = to_cpu(state)
+        # wait for the previous checkpoint, checkpoints are written in order
+        self.wait()
+        self.thread = threading.Thread(target=save_atomic, args=(state, self.path))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def get_checkpoint_path(args):
+    return os.path.join(args.save_dir, args.name + "_checkpoint")
+
+def load_checkpoint(path):
+    """ Returns the checkpoint at path, or None if there is none yet
+    """
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location='cpu', weights_only=False)
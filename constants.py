@@ -48,8 +48,8 @@ PRETRAINED_GERMANY_PATH = '/home/roserustowicz/crop-type-mapping/runs/20190303_f
 # HYPERPARAMETER SEARCH
 INT_POWER_EXP = ["hidden_dims"]
 REAL_POWER_EXP = ["weight_decay", "lr"]
-INT_HP = ['batch_size', 'crnn_num_layers']
-FLOAT_HP = ['weight_scale', 'percent_of_dataset']
+INT_HP = ['batch_size', 'crnn_num_layers', 'patience', 'early_stop_patience']
+FLOAT_HP = ['weight_scale', 'percent_of_dataset', 'lr_decay']
 STRING_HP = ['crnn_model_name']
 BOOL_HP = ['use_s1', 'use_s2', 'include_clouds', 'bidirectional', 'least_cloudy',
            'avg_hidden_states', 'early_feats']
@@ -68,16 +68,16 @@ HPS = [INT_POWER_EXP, REAL_POWER_EXP, INT_HP, FLOAT_HP, STRING_HP, BOOL_HP, INT_
 
 # LOSS WEIGHTS
 GHANA_LOSS_WEIGHT = 1 - np.array([.17, .56, .16, .11])
-GHANA_LOSS_WEIGHT = torch.tensor(GHANA_LOSS_WEIGHT, dtype=torch.float32).cuda()
+GHANA_LOSS_WEIGHT = torch.tensor(GHANA_LOSS_WEIGHT, dtype=torch.float32)
 
 SSUDAN_LOSS_WEIGHT = 1 - np.array([.72, .11, .10, .07])
-SSUDAN_LOSS_WEIGHT = torch.tensor(SSUDAN_LOSS_WEIGHT, dtype=torch.float32).cuda()
+SSUDAN_LOSS_WEIGHT = torch.tensor(SSUDAN_LOSS_WEIGHT, dtype=torch.float32)
 
 TANZ_LOSS_WEIGHT = 1 - np.array([.64, .14, .12, .05, .05])
-TANZ_LOSS_WEIGHT = torch.tensor(TANZ_LOSS_WEIGHT, dtype=torch.float32).cuda()
+TANZ_LOSS_WEIGHT = torch.tensor(TANZ_LOSS_WEIGHT, dtype=torch.float32)
           
 GERMANY_LOSS_WEIGHT = 1 - np.array([.02, .01, .07, .05, .03, .01, .02, .01, .01, .04, .01, .01, .27, .10, .01, .03, .32])
-GERMANY_LOSS_WEIGHT = torch.tensor(GERMANY_LOSS_WEIGHT, dtype=torch.float32).cuda()
+GERMANY_LOSS_WEIGHT = torch.tensor(GERMANY_LOSS_WEIGHT, dtype=torch.float32)
 
 LOSS_WEIGHT = { 'ghana': GHANA_LOSS_WEIGHT, 
                 'southsudan': SSUDAN_LOSS_WEIGHT,
@@ -125,6 +125,9 @@ NUM_CLASSES = { 'ghana': 4,
                 'tanzania': 5,
                 'germany': 17 }
 
+# Label value for unlabeled pixels when labels are integer class maps (--int_labels)
+IGNORE_INDEX = -100
+
 GRID_SIZE = { 'ghana': 32, 
               'southsudan': 32, 
               'tanzania': 32, 
@@ -5,7 +5,9 @@ File that houses the dataset wrappers we have.
 """
 
 import torch
-from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data import Dataset, DataLoader, Sampler, DistributedSampler
+import hashlib
+import json
 import pickle
 import h5py
 import numpy as np
@@ -13,6 +15,7 @@ import os
 
 from skimage.transform import resize as imresize
 
+import distributed
 import preprocess
 from constants import *
 from random import shuffle
@@ -80,6 +83,19 @@ def get_Xy_batch(inputs, targets, X, y, country):
                 y.append(labels)
     return X, y 
 
+# args that change the cached grids, see CropTypeDS.write_cache
+CACHE_ARGS = ['country', 'use_s1', 'use_s2', 'use_planet', 'include_clouds', 'include_doy', 's2_num_bands',
+              'resize_planet', 'agg_days', 's1_agg', 's2_agg', 'planet_agg']
+
+def get_cache_key(args):
+    """ Returns the values of the args that change the cached grids, runs with equal keys share caches
+    """
+    return tuple(vars(args)[arg] for arg in CACHE_ARGS)
+
+def get_cache_path(args, grid_path):
+    key = json.dumps([HDF5_PATH[args.country], os.path.abspath(grid_path), get_cache_key(args)])
+    return os.path.join(args.cache_dir, f"{os.path.basename(grid_path)}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.hdf5")
+
 def split_and_aggregate(arr, doys, ndays, reduction='avg'):
     """
     Aggregates an array along the time dimension, grouping by every ndays
@@ -164,12 +180,15 @@ class CropTypeDS(Dataset):
         self.planet_agg = args.planet_agg
         
         self.num_classes = NUM_CLASSES[args.country]
+        # pixel-based (non-dl) models index into one-hot labels
+        self.int_labels = args.int_labels and args.model_name in DL_MODELS
         self.split = split
         self.apply_transforms = args.apply_transforms
         self.normalize = args.normalize
         self.sample_w_clouds = args.sample_w_clouds
         self.include_clouds = args.include_clouds
         self.include_doy = args.include_doy
+        self.broadcast_doy = args.include_doy and args.broadcast_doy
         self.include_indices = args.include_indices
         self.num_timesteps = args.num_timesteps
         self.all_samples = args.all_samples
@@ -178,30 +197,76 @@ class CropTypeDS(Dataset):
         self.timeslice = args.time_slice
         self.least_cloudy = args.least_cloudy
         self.s2_num_bands = args.s2_num_bands
-        
-        with h5py.File(self.hdf5_filepath, 'r') as data:
-            self.combined_lengths = []
-            for grid in self.grid_list:
-                total_len = 0
-                if self.use_s1:
-                    total_len += data['s1_length'][grid][()]
-                if self.use_s2:
-                    total_len += data['s2_length'][grid][()]
-                if self.use_planet:
-                    total_len += data['planet_length'][grid][()]
-                self.combined_lengths.append(total_len)                    
+
+        if self.broadcast_doy and not self.var_length:
+            raise ValueError('--broadcast_doy requires --var_length inputs')
+
+        # with a cache dir, grids are read from a cache holding them up to the timestep sampling
+        self.cached = False
+        cache_path = get_cache_path(args, grid_path) if args.cache_dir else None
+        if cache_path is not None and os.path.exists(cache_path):
+            with h5py.File(cache_path, 'r') as data:
+                self.combined_lengths = list(data['combined_lengths'][()])
+        else:
+            with h5py.File(self.hdf5_filepath, 'r') as data:
+                self.combined_lengths = []
+                for grid in self.grid_list:
+                    total_len = 0
+                    if self.use_s1:
+                        total_len += data['s1_length'][grid][()]
+                    if self.use_s2:
+                        total_len += data['s2_length'][grid][()]
+                    if self.use_planet:
+                        total_len += data['planet_length'][grid][()]
+                    self.combined_lengths.append(total_len)                    
+            if cache_path is not None:
+                self.write_cache(cache_path)
+
+        if cache_path is not None:
+            self.hdf5_filepath = cache_path
+            self.cached = True
 
     def __len__(self):
         return self.num_grids
 
+    def get_sat_properties(self):
+        return { 's1': {'data': None, 'doy': None, 'use': self.use_s1, 'agg': self.s1_agg,
+                        'agg_reduction': 'avg', 'cloudmasks': None },
+                 's2': {'data': None, 'doy': None, 'use': self.use_s2, 'agg': self.s2_agg,
+                        'agg_reduction': 'min', 'cloudmasks': None, 'num_bands': self.s2_num_bands },
+                 'planet': {'data': None, 'doy': None, 'use': self.use_planet, 'agg': self.planet_agg,
+                            'agg_reduction': 'median', 'cloudmasks': None, 'num_bands': PLANET_NUM_BANDS } }
+
+    def write_cache(self, cache_path):
+        """ Writes the grids, read and aggregated as by load_data, to cache_path in the layout of the
+            source HDF5 file. Runs with the same CACHE_ARGS (i.e. trials of a hyperparameter search
+            that only change model settings) then skip reading the full band stacks and aggregating.
+
+            Timestep sampling, normalization and transforms are random or cheap on the sampled
+            grids, they are still applied per item.
+        """
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        # concurrent writers of the same cache each write their own file, the last rename wins
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with h5py.File(self.hdf5_filepath, 'r') as data, h5py.File(tmp_path, 'w') as cache:
+            cache['combined_lengths'] = np.array(self.combined_lengths)
+            for idx, grid in enumerate(self.grid_list):
+                sat_properties = self.get_sat_properties()
+                for sat in ['s1', 's2', 'planet']:
+                    if not sat_properties[sat]['use']:
+                        continue
+                    self.load_data(data, idx, sat, sat_properties)
+                    cache[f'{sat}/{grid}'] = np.asarray(sat_properties[sat]['data'])
+                    if sat_properties[sat]['doy'] is not None:
+                        cache[f'{sat}_dates/{grid}'] = sat_properties[sat]['doy']
+                    if sat_properties[sat]['cloudmasks'] is not None:
+                        cache[f'cloudmasks/{grid}'] = sat_properties[sat]['cloudmasks']
+                cache[f'labels/{grid}'] = data['labels'][grid][()]
+        os.replace(tmp_path, cache_path)
+
     def __getitem__(self, idx):
         with h5py.File(self.hdf5_filepath, 'r') as data:
-            sat_properties = { 's1': {'data': None, 'doy': None, 'use': self.use_s1, 'agg': self.s1_agg,
-                                      'agg_reduction': 'avg', 'cloudmasks': None },
-                               's2': {'data': None, 'doy': None, 'use': self.use_s2, 'agg': self.s2_agg,
-                                      'agg_reduction': 'min', 'cloudmasks': None, 'num_bands': self.s2_num_bands },
-                               'planet': {'data': None, 'doy': None, 'use': self.use_planet, 'agg': self.planet_agg,
-                                          'agg_reduction': 'median', 'cloudmasks': None, 'num_bands': PLANET_NUM_BANDS } }
+            sat_properties = self.get_sat_properties()
 
             for sat in ['s1', 's2', 'planet']:
                 sat_properties = self.setup_data(data, idx, sat, sat_properties)
@@ -210,7 +275,7 @@ class CropTypeDS(Dataset):
             rot = np.random.randint(0, 4)
 
             label = data['labels'][self.grid_list[idx]][()]
-            label = preprocess.preprocess_label(label, self.model_name, self.num_classes, transform, rot) 
+            label = preprocess.preprocess_label(label, self.model_name, self.num_classes, transform, rot, self.int_labels) 
         
             if not self.var_length:
                 grid, highres_grid = preprocess.concat_s1_s2_planet(sat_properties['s1']['data'],
@@ -230,6 +295,10 @@ class CropTypeDS(Dataset):
                 if self.use_planet:
                     planet = preprocess.preprocess_grid(sat_properties['planet']['data'], self.model_name, self.timeslice, transform, rot)
                     inputs['planet'] = planet
+                if self.broadcast_doy:
+                    for sat in ['s1', 's2', 'planet']:
+                        if sat in inputs:
+                            inputs[sat + '_doy'] = preprocess.doy2vec(sat_properties[sat]['doy'])
                 highres_grid = None      
           
         if sat_properties['s2']['cloudmasks'] is None:
@@ -266,29 +335,47 @@ class CropTypeDS(Dataset):
         if self.include_clouds:
             sat_properties[sat]['cloudmasks'] = data['cloudmasks'][self.grid_list[idx]][()]
     
+    def load_cached(self, data, idx, sat, sat_properties):
+        """ Reads the grid of sat as written by write_cache
+        """
+        grid = self.grid_list[idx]
+        sat_properties[sat]['data'] = data[sat][grid][()]
+        if self.include_doy:
+            sat_properties[sat]['doy'] = data[f'{sat}_dates'][grid][()]
+        if sat in ['s2'] and self.include_clouds:
+            sat_properties[sat]['cloudmasks'] = data['cloudmasks'][grid][()]
+
+    def load_data(self, data, idx, sat, sat_properties):
+        """ Reads the grid of sat, selects the bands and aggregates it over time if set
+        """
+        sat_properties[sat]['data'] = data[sat][self.grid_list[idx]] 
+        
+        if sat in ['planet']:
+            self.setup_planet(data, sat, sat_properties)
+        if sat in ['s2']:
+            self.setup_s2(data, idx, sat, sat_properties)
+        if self.include_doy:
+            sat_properties[sat]['doy'] = data[f'{sat}_dates'][self.grid_list[idx]][()]
+        if sat_properties[sat]['agg']:
+            sat_properties[sat]['data'], sat_properties[sat]['doy'] = split_and_aggregate(sat_properties[sat]['data'], 
+                                                                                      sat_properties[sat]['doy'],
+                                                                                      self.agg_days, 
+                                                                                      reduction=sat_properties[sat]['agg_reduction'])
+            
+            # Replace the VH/VV band with a cleaner band after aggregation??
+            if sat in ['s1']:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:] = sat_properties[sat]['data'][BANDS[sat]['VH'],:,:,:] / sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:]
+                    sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:][sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:] == 0] = 0
+
     def setup_data(self, data, idx, sat, sat_properties):
         if sat_properties[sat]['use']:
-            sat_properties[sat]['data'] = data[sat][self.grid_list[idx]] 
-            
-            if sat in ['planet']:
-                self.setup_planet(data, sat, sat_properties)
-            if sat in ['s2']:
-                self.setup_s2(data, idx, sat, sat_properties)
-            if self.include_doy:
-                sat_properties[sat]['doy'] = data[f'{sat}_dates'][self.grid_list[idx]][()]
-            if sat_properties[sat]['agg']:
-                sat_properties[sat]['data'], sat_properties[sat]['doy'] = split_and_aggregate(sat_properties[sat]['data'], 
-                                                                                          sat_properties[sat]['doy'],
-                                                                                          self.agg_days, 
-                                                                                          reduction=sat_properties[sat]['agg_reduction'])
-                
-                # Replace the VH/VV band with a cleaner band after aggregation??
-                if sat in ['s1']:
-                    with np.errstate(divide='ignore', invalid='ignore'):
-                        sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:] = sat_properties[sat]['data'][BANDS[sat]['VH'],:,:,:] / sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:]
-                        sat_properties[sat]['data'][BANDS[sat]['RATIO'],:,:,:][sat_properties[sat]['data'][BANDS[sat]['VV'],:,:,:] == 0] = 0
-            
+            if self.cached:
+                self.load_cached(data, idx, sat, sat_properties)
             else:
+                self.load_data(data, idx, sat, sat_properties)
+
+            if not sat_properties[sat]['agg']:
                 sat_properties[sat]['data'], sat_properties[sat]['doy'], sat_properties[sat]['cloudmasks'] = preprocess.sample_timeseries(sat_properties[sat]['data'],
                                                                                                                self.num_timesteps, sat_properties[sat]['doy'],
                                                                                                                cloud_stack = sat_properties[sat]['cloudmasks'],
@@ -303,13 +390,7 @@ class CropTypeDS(Dataset):
 
             # Include NDVI and GCVI for s2 and planet, calculate before normalization and numband selection but AFTER AGGREGATION
             if self.include_indices and sat in ['planet', 's2']:
-                with np.errstate(divide='ignore', invalid='ignore'):
-                    numbands = str(sat_properties[sat]['num_bands'])
-                    ndvi = (sat_properties[sat]['data'][BANDS[sat][numbands]['NIR'], :, :, :] - sat_properties[sat]['data'][BANDS[sat][numbands]['RED'], :, :, :]) / (sat_properties[sat]['data'][BANDS[sat][numbands]['NIR'], :, :, :] + sat_properties[sat]['data'][BANDS[sat][numbands]['RED'], :, :, :])
-                    gcvi = (sat_properties[sat]['data'][BANDS[sat][numbands]['NIR'], :, :, :] / sat_properties[sat]['data'][BANDS[sat][numbands]['GREEN'], :, :, :]) - 1 
-
-                ndvi[(sat_properties[sat]['data'][BANDS[sat][numbands]['NIR'], :, :, :] + sat_properties[sat]['data'][BANDS[sat][numbands]['RED'], :, :, :]) == 0] = 0
-                gcvi[sat_properties[sat]['data'][BANDS[sat][numbands]['GREEN'], :, :, :] == 0] = 0
+                ndvi, gcvi = preprocess.vegetation_indices(sat_properties[sat]['data'], sat, sat_properties[sat]['num_bands'])
 
 
             #TODO: Clean this up a bit. No longer include doy/clouds if data is aggregated? 
@@ -326,8 +407,8 @@ class CropTypeDS(Dataset):
                 sat_properties[sat]['cloudmasks'] = preprocess.preprocess_clouds(sat_properties[sat]['cloudmasks'], self.model_name, self.timeslice)
                 sat_properties[sat]['data'] = np.concatenate(( sat_properties[sat]['data'], sat_properties[sat]['cloudmasks']), 0)
 
-            # Concatenate doy bands
-            if sat_properties[sat]['doy'] is not None and self.include_doy:
+            # Concatenate doy bands, unless doy is broadcast inside the model
+            if sat_properties[sat]['doy'] is not None and self.include_doy and not self.broadcast_doy:
                 doy_stack = preprocess.doy2stack(sat_properties[sat]['doy'], sat_properties[sat]['data'].shape)
                 sat_properties[sat]['data'] = np.concatenate((sat_properties[sat]['data'], doy_stack), 0)
             
@@ -338,7 +419,7 @@ class CropTypeBatchSampler(Sampler):
     """
         Groups sequences of similiar length into the same batch to prevent unnecessary computation.
     """
-    def __init__(self, dataset, max_batch_size, max_seq_length):
+    def __init__(self, dataset, max_batch_size, max_seq_length, pad_shards=False):
         super(CropTypeBatchSampler, self).__init__(dataset)
         batches = []
         idxs = list(range(len(dataset)))
@@ -365,7 +446,9 @@ class CropTypeBatchSampler(Sampler):
             if len(batch) > 0:
                 batches.append(batch)
         
-        self.batches = batches
+        # in distributed runs each rank takes its shard of the batches (identical on all ranks, 
+        #  as they share the seed), padded to equal counts for training
+        self.batches = distributed.shard(batches, pad=pad_shards)
         
     def __iter__(self):
         for b in self.batches:
@@ -389,6 +472,14 @@ def pad_to_equal_length(grids):
             padded[:lengths[i], :, :, :] = grid
             grids[i] = torch.tensor(padded, dtype=torch.float32)
     return grids, lengths
+
+def pad_doy_to_length(doys, max_len):
+    """ Pads compact day of year vectors with 0s into a [batch x max_len] tensor
+    """
+    padded = torch.zeros((len(doys), max_len), dtype=torch.float32)
+    for i, doy in enumerate(doys):
+        padded[i, :doy.shape[0]] = doy
+    return padded
     
     
 def collate_var_length(batch):
@@ -401,18 +492,22 @@ def collate_var_length(batch):
         where s1 has all same length (padded to max len)
               s2 has all same length (padded to max len)
               planet has all same length (paddedd to max len)
+              and SAT_doy, if present, is [batch x max len]
     """
     batch_size = len(batch)
     labels = [batch[i][1] for i in range(batch_size)]
     labels = torch.stack(labels)
     inputs = {}
-    sats = batch[0][0].keys()
+    sats = [key for key in batch[0][0].keys() if not key.endswith('_doy')]
     for sat in sats:
         grids = [batch[i][0][sat] for i in range(batch_size)]
         grids, lengths = pad_to_equal_length(grids)
         grids = torch.stack(grids)
         inputs[sat] = grids
         inputs[sat + "_lengths"] = lengths
+        if sat + "_doy" in batch[0][0]:
+            doys = [batch[i][0][sat + "_doy"] for i in range(batch_size)]
+            inputs[sat + "_doy"] = pad_doy_to_length(doys, grids.shape[1])
   
     if 's2' in sats and not isinstance(batch[0][2], bool): # batch[0][2] checks if cloudmasks exist
         cloudmasks = [batch[i][2].transpose(3, 0, 1, 2) for i in range(batch_size)]
@@ -429,12 +524,26 @@ class GridDataLoader(DataLoader):
     def __init__(self, args, grid_path, split):
         dataset = CropTypeDS(args, grid_path, split)
         if args.var_length:
-            sampler = CropTypeBatchSampler(dataset, max_batch_size=args.batch_size, max_seq_length=args.num_timesteps)
+            sampler = CropTypeBatchSampler(dataset, max_batch_size=args.batch_size, max_seq_length=args.num_timesteps,
+                                           pad_shards=split == 'train')
             super(GridDataLoader, self).__init__(dataset,
                                                  batch_sampler=sampler,
                                                  num_workers=args.num_workers,
                                                  collate_fn=collate_var_length,
                                                  pin_memory=True)
+        elif distributed.world_size() > 1:
+            # training shards are padded so that all ranks run the same number of steps,
+            #  evaluation shards are not so that no grid is counted twice
+            if split == 'train':
+                sampler = DistributedSampler(dataset, num_replicas=distributed.world_size(), rank=distributed.rank(),
+                                             shuffle=args.shuffle, seed=args.seed)
+            else:
+                sampler = distributed.shard(range(len(dataset)))
+            super(GridDataLoader, self).__init__(dataset,
+                                                 batch_size=args.batch_size,
+                                                 sampler=sampler,
+                                                 num_workers=args.num_workers,
+                                                 pin_memory=True)
         else:
             super(GridDataLoader, self).__init__(dataset,
                                                  batch_size=args.batch_size,
@@ -442,14 +551,27 @@ class GridDataLoader(DataLoader):
                                                  num_workers=args.num_workers,
                                                  pin_memory=True)
 
+    def set_epoch(self, epoch):
+        """ Reshuffles the distributed training shard for epoch
+        """
+        if isinstance(self.sampler, DistributedSampler):
+            self.sampler.set_epoch(epoch)
+
+            
+def get_grid_path(country, dataset, split):
+    if country in ['southsudan', 'ghana']:
+        return os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}_32")
+    return os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}")
+
+def build_caches(country, dataset, args):
+    """ Writes the grid caches of all splits to args.cache_dir, if they do not exist yet
+    """
+    for split in SPLITS:
+        CropTypeDS(args, get_grid_path(country, dataset, split), split)
             
 def get_dataloaders(country, dataset, args):
     dataloaders = {}
     for split in SPLITS:
-        if country in ['southsudan', 'ghana']:
-            grid_path = os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}_32")
-        else:
-            grid_path = os.path.join(GRID_DIR[country], f"{country}_{dataset}_final_{split}")
-        dataloaders[split] = GridDataLoader(args, grid_path, split)
+        dataloaders[split] = GridDataLoader(args, get_grid_path(country, dataset, split), split)
 
     return dataloaders
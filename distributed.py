@@ -0,0 +1,108 @@
+"""
+
+Helpers for multi-process data-parallel training with torch.distributed.
+
+Launch one process per rank with torchrun, which sets the rank / world size environment, e.g.
+
+  `torchrun --nproc_per_node=8 train.py --distributed=True --model_name=bidir_clstm --country=ghana ...`
+
+and add --nnodes / --node_rank / --master_addr for multiple nodes. Every rank trains on its own
+shard of each split, gradients are all-reduced by DistributedDataParallel and epoch confusion
+matrices are summed over ranks, only rank 0 writes checkpoints and logs. The all-reduce averages
+gradients, so the summed training loss is scaled by the world size before backward to keep the
+gradient of the loss summed over all ranks' pixels, as in single process training.
+
+"""
+import contextlib
+import os
+import torch
+import torch.distributed as dist
+
+from torch.nn.parallel import DistributedDataParallel
+
+def init(args):
+    """ Joins the process group when args.distributed is set and splits the CPU cores between
+        the local ranks
+    """
+    if not args.distributed:
+        return
+    if args.seed is None:
+        # the var length batch sampler shards batches that every rank builds from the same shuffle
+        raise ValueError('--distributed requires a --seed shared by all ranks')
+    dist.init_process_group(backend=args.dist_backend)
+    threads = args.threads_per_rank
+    if threads is None:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size()))
+        threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads)
+
+def cleanup():
+    if is_initialized():
+        dist.destroy_process_group()
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+def rank():
+    return dist.get_rank() if is_initialized() else 0
+
+def world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+def is_main():
+    """ Whether this process writes checkpoints and logs
+    """
+    return rank() == 0
+
+def all_reduce_sum(tensor):
+    """ Sums tensor over all ranks in place, a no-op in single process runs
+    """
+    if is_initialized():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def wrap_model(model):
+    """ Wraps model in DistributedDataParallel, model parameters are broadcast from rank 0.
+
+    Some configurations leave parameters without gradients (i.e. unused attention or decoder
+    branches), so unused parameters are searched for every step.
+    """
+    if not is_initialized():
+        return model
+    return DistributedDataParallel(model, find_unused_parameters=True)
+
+def no_sync(model, skip_sync):
+    """ Returns a context that skips the gradient all-reduce of backward when skip_sync is set,
+        i.e. for all but the last micro-batch of an accumulation window
+    """
+    if skip_sync and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+def all_reduce_grads(model):
+    """ Averages the gradients over all ranks like the DistributedDataParallel all-reduce, for
+        gradients accumulated under no_sync
+    """
+    if not isinstance(model, DistributedDataParallel):
+        return
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+            param.grad.div_(world_size())
+
+def unwrap(model):
+    """ Returns the model inside a DistributedDataParallel wrapper
+    """
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def shard(items, pad=False):
+    """ Returns this rank's strided shard of items. With pad, items are repeated so that all ranks
+        get the same number, which DistributedDataParallel training needs to stay in lockstep.
+    """
+    items = list(items)
+    num_ranks = world_size()
+    if num_ranks == 1:
+        return items
+    if pad and len(items) > 0:
+        items = items + [items[idx % len(items)] for idx in range((-len(items)) % num_ranks)]
+    return items[rank()::num_ranks]
@@ -0,0 +1,179 @@
+"""
+
+Script for exporting trained models to TorchScript and ONNX
+
+Traces a trained bidir_clstm, fcn_crnn, unet or unet3d model into a TorchScript module and
+an ONNX graph that can be served without this codebase, checks that both match the eager
+model on sample batches and benchmarks them on the CPU against the eager model, e.g.
+
+  `python export.py --model_name=bidir_clstm --country=ghana --model_path=models/ghana_best
+                    --export_dir=exported --export_timesteps 10 20 40`
+
+The batch axis of the ONNX graph is dynamic. The recurrent time loops are unrolled when traced,
+so each artifact has a fixed number of timestamps; --export_timesteps exports one artifact per
+length (all at most --num_timesteps, the length the recurrent norms were built for). unet merges
+time into its input channels and is always exported for --num_timesteps.
+
+onnx and onnxruntime are only needed for the ONNX export and runner, --formats=torchscript
+skips them.
+
+"""
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+import datasets
+import inference
+import util
+
+from constants import *
+from modelling.util import get_num_bands
+
+EXPORTABLE_MODELS = ['bidir_clstm', 'fcn_crnn', 'unet', 'unet3d']
+# dimension of the time axis in the model inputs, None if time is merged into the channels
+TIME_DIMS = {'bidir_clstm': 1, 'fcn_crnn': 1, 'unet': None, 'unet3d': 2}
+
+class ExportWrapper(nn.Module):
+    """ Gives every exported model a single tensor input, multi resolution models are run
+        without high resolution inputs
+    """
+    def __init__(self, model, model_name):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+        self.multi_res = model_name in MULTI_RES_MODELS
+
+    def forward(self, inputs):
+        if self.multi_res:
+            return self.model(inputs, torch.zeros(1))
+        return self.model(inputs)
+
+def synthetic_batches(args, num_batches):
+    """ Returns random batches shaped like the dataset inputs of args.model_name
+    """
+    num_bands = get_num_bands(vars(args))['all']
+    size = GRID_SIZE[args.country]
+    shape = {'bidir_clstm': (args.num_timesteps, num_bands, size, size),
+             'fcn_crnn': (args.num_timesteps, num_bands, size, size),
+             'unet': (args.num_timesteps * num_bands, size, size),
+             'unet3d': (num_bands, args.num_timesteps, size, size)}[args.model_name]
+    return [torch.randn(args.batch_size, *shape) for _ in range(num_batches)]
+
+def data_batches(args, num_batches):
+    batches = []
+    for inputs, _, _, _ in datasets.get_dataloaders(args.country, args.dataset, args)['val']:
+        batches.append(inputs)
+        if len(batches) == num_batches:
+            break
+    return batches
+
+def slice_time(inputs, model_name, num_timesteps):
+    time_dim = TIME_DIMS[model_name]
+    if time_dim is None:
+        return inputs
+    return inputs.narrow(time_dim, 0, num_timesteps).contiguous()
+
+def export_torchscript(wrapper, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example)
+    traced.save(path)
+    return torch.jit.load(path)
+
+def export_onnx(wrapper, example, path, opset):
+    import onnxruntime
+    with torch.no_grad():
+        torch.onnx.export(wrapper, example, path, input_names=['inputs'], output_names=['preds'],
+                          dynamic_axes={'inputs': {0: 'batch'}, 'preds': {0: 'batch'}},
+                          opset_version=opset)
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda inputs: torch.from_numpy(session.run(None, {'inputs': inputs.numpy()})[0])
+
+def max_abs_diff(runner, reference, batches):
+    diffs = []
+    with torch.no_grad():
+        for inputs, expected in zip(batches, reference):
+            diffs.append((runner(inputs) - expected).abs().max().item())
+    return max(diffs)
+
+def benchmark(runner, batches, iters):
+    """ Returns ms per batch of runner over batches, after one warm up pass
+    """
+    with torch.no_grad():
+        for inputs in batches:
+            runner(inputs)
+        start = time.perf_counter()
+        for _ in range(iters):
+            for inputs in batches:
+                runner(inputs)
+    return (time.perf_counter() - start) * 1000 / (iters * len(batches))
+
+def add_export_args(parser):
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help="Directory for the exported artifacts, defaults to --save_dir")
+    parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                        choices=['torchscript', 'onnx'])
+    parser.add_argument('--export_timesteps', type=int, nargs='+', default=None,
+                        help="Number of timestamps of each exported artifact, defaults to --num_timesteps")
+    parser.add_argument('--opset', type=int, default=17,
+                        help="ONNX opset version")
+    parser.add_argument('--synthetic', type=util.str2bool, default=False,
+                        help="Check parity and benchmark on random inputs instead of val batches")
+    parser.add_argument('--parity_batches', type=int, default=4)
+    parser.add_argument('--parity_tol', type=float, default=1e-4,
+                        help="Max abs difference of the exported log probabilities to the eager model")
+    parser.add_argument('--bench_iters', type=int, default=5)
+    return parser
+
+if __name__ == "__main__":
+    parser = add_export_args(util.get_train_parser())
+    args = parser.parse_args()
+    if args.model_name not in EXPORTABLE_MODELS:
+        raise ValueError(f'Export is only supported for {EXPORTABLE_MODELS}, got {args.model_name}')
+    if args.var_length:
+        raise ValueError('Export requires fixed length inputs, --var_length is not supported')
+    if args.model_path is None:
+        raise ValueError('--model_path is required')
+
+    # the fused bidirectional path gives the same outputs, export the plain one
+    args.fused_bidir = False
+    device = torch.device('cpu')
+    model = inference.load_model(args, device)
+    wrapper = ExportWrapper(model, args.model_name).eval()
+
+    export_dir = args.export_dir or args.save_dir
+    os.makedirs(export_dir, exist_ok=True)
+    name = args.name or args.model_name
+    timesteps = args.export_timesteps or [args.num_timesteps]
+    if TIME_DIMS[args.model_name] is None:
+        timesteps = [args.num_timesteps]
+    if max(timesteps) > args.num_timesteps:
+        raise ValueError(f'--export_timesteps must be at most --num_timesteps ({args.num_timesteps})')
+
+    all_batches = synthetic_batches(args, args.parity_batches) if args.synthetic else data_batches(args, args.parity_batches)
+    failed = False
+    for num_timesteps in timesteps:
+        batches = [slice_time(inputs, args.model_name, num_timesteps) for inputs in all_batches]
+        with torch.no_grad():
+            reference = [wrapper(inputs) for inputs in batches]
+        runners = {'eager': wrapper}
+        if 'torchscript' in args.formats:
+            path = os.path.join(export_dir, f'{name}_T{num_timesteps}.pt')
+            runners['torchscript'] = export_torchscript(wrapper, batches[0], path)
+            print(f'Saved {path}')
+        if 'onnx' in args.formats:
+            path = os.path.join(export_dir, f'{name}_T{num_timesteps}.onnx')
+            runners['onnxruntime'] = export_onnx(wrapper, batches[0], path, args.opset)
+            print(f'Saved {path}')
+
+        print(f'{num_timesteps} timestamps, batch size {batches[0].shape[0]}, {torch.get_num_threads()} threads')
+        eager_ms = None
+        for runner_name, runner in runners.items():
+            diff = max_abs_diff(runner, reference, batches)
+            ms = benchmark(runner, batches, args.bench_iters)
+            eager_ms = eager_ms or ms
+            failed = failed or diff > args.parity_tol
+            print(f'{runner_name:>12}: max abs diff {diff:.2e}, {ms:8.2f} ms/batch ({eager_ms / ms:.2f}x eager)')
+
+    if failed:
+        raise RuntimeError(f'Exported outputs differ from the eager model by more than {args.parity_tol}')
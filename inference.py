@@ -0,0 +1,366 @@
+"""
+
+Sliding window inference over full scenes.
+
+Tiles a large S1 / S2 / Planet time series scene with overlap, runs the tiles through a
+trained model in batches, blends the overlapping log probabilities and streams the crop
+type map to a (georeferenced) output, so memory stays bounded regardless of scene size.
+
+Example:
+  `python inference.py --model_name=bidir_clstm --country=ghana --model_path=models/ghana_best
+                       --use_s1=False --scene_s2=s2_scene.tif --scene_s2_dates=s2_doy.npy
+                       --out_path=ghana_map.tif --overlap=8`
+
+Scenes are either GeoTIFFs with one band per (timestamp, band), ordered timestamp major,
+or .npy arrays of shape [bands x rows x cols x timestamps], as stored in the hdf5 grids.
+All satellites must share the same pixel grid (Planet resampled to it, i.e. --resize_planet).
+
+The map stores crop class c as c + 1, so that 0 stays free for nodata / unlabeled, as in the
+label rasters. GeoTIFF outputs declare nodata=0.
+
+"""
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+import models
+import preprocess
+import quantization
+import util
+
+from constants import *
+from tqdm import tqdm
+
+SATS = ['s1', 's2', 'planet']
+
+class ArrayScene(object):
+    """ Scene stored as one [bands x rows x cols x timestamps] .npy array per satellite,
+        memory mapped so that only the tiles being predicted are read.
+    """
+    def __init__(self, paths, dates):
+        self.arrays = {sat: np.load(path, mmap_mode='r') for sat, path in paths.items()}
+        self.dates = dates
+        shapes = set(arr.shape[1:3] for arr in self.arrays.values())
+        if len(shapes) != 1:
+            raise ValueError(f'All satellites must share the same pixel grid, got shapes {shapes}')
+        self.shape = shapes.pop()
+        self.profile = None
+
+    def num_timestamps(self, sat):
+        return self.arrays[sat].shape[3]
+
+    def read(self, sat, row, col, size):
+        return np.asarray(self.arrays[sat][:, row:row+size, col:col+size, :], dtype=np.float32)
+
+    def close(self):
+        pass
+
+class RasterScene(object):
+    """ Scene stored as one GeoTIFF per satellite with timestamps * bands bands, ordered
+        timestamp major. The number of timestamps is given by the dates of each satellite.
+    """
+    def __init__(self, paths, dates):
+        import rasterio
+        from rasterio.windows import Window
+        self.Window = Window
+        self.dates = dates
+        self.rasters = {sat: rasterio.open(path) for sat, path in paths.items()}
+        for sat, raster in self.rasters.items():
+            if dates.get(sat) is None or raster.count % len(dates[sat]) != 0:
+                raise ValueError(f'{sat} raster needs dates for each of its timestamps')
+        grids = set((raster.shape, raster.transform) for raster in self.rasters.values())
+        if len(grids) != 1:
+            raise ValueError('All satellites must share the same pixel grid')
+        first = next(iter(self.rasters.values()))
+        self.shape = first.shape
+        self.profile = first.profile
+
+    def num_timestamps(self, sat):
+        return len(self.dates[sat])
+
+    def read(self, sat, row, col, size):
+        raster = self.rasters[sat]
+        num_timestamps = self.num_timestamps(sat)
+        data = raster.read(window=self.Window(col, row, size, size), out_dtype=np.float32)
+        # [timestamps*bands x rows x cols] --> [bands x rows x cols x timestamps]
+        data = data.reshape(num_timestamps, -1, size, size)
+        return data.transpose(1, 2, 3, 0)
+
+    def close(self):
+        for raster in self.rasters.values():
+            raster.close()
+
+class ArrayWriter(object):
+    """ Writes the crop type map (classes + 1, 0 for nodata) to a memory mapped .npy array
+    """
+    def __init__(self, path, shape):
+        self.out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+
+    def write(self, row, class_rows):
+        self.out[row:row+class_rows.shape[0]] = class_rows
+
+    def close(self):
+        self.out.flush()
+
+class GeoTiffWriter(object):
+    """ Writes the crop type map (classes + 1, nodata=0) to a single band GeoTIFF with the
+        georeferencing of the scene
+    """
+    def __init__(self, path, shape, profile):
+        import rasterio
+        from rasterio.windows import Window
+        self.Window = Window
+        profile = profile.copy()
+        profile.update(driver='GTiff', height=shape[0], width=shape[1], count=1, dtype='uint8',
+                       compress='lzw', nodata=0)
+        self.out = rasterio.open(path, 'w', **profile)
+
+    def write(self, row, class_rows):
+        window = self.Window(0, row, class_rows.shape[1], class_rows.shape[0])
+        self.out.write(class_rows.astype(np.uint8), 1, window=window)
+
+    def close(self):
+        self.out.close()
+
+class TilePreprocessor(object):
+    """ Applies the dataset preprocessing (see datasets.CropTypeDS) to scene tiles.
+
+    The timestamps used are chosen once per scene, evenly spaced over the season, so that
+    neighbouring tiles see the same inputs.
+    """
+    def __init__(self, args, scene):
+        if args.s1_agg or args.s2_agg or args.planet_agg:
+            raise ValueError('Temporal aggregation is not supported for scene inference')
+        if args.include_clouds:
+            raise ValueError('Cloud mask inputs are not supported for scene inference')
+        if args.use_planet and not args.resize_planet:
+            raise ValueError('Scene inference requires Planet on the scene grid, set --resize_planet')
+
+        self.args = args
+        self.sats = [sat for sat in SATS if getattr(args, f'use_{sat}')]
+        self.broadcast_doy = args.include_doy and args.broadcast_doy
+
+        num_timestamps = {sat: scene.num_timestamps(sat) for sat in self.sats}
+        if not args.var_length:
+            # inputs are concatenated, so all satellites use the same number of timestamps
+            num_timestamps = {sat: min(num_timestamps.values()) for sat in self.sats}
+        self.time_idxs = {}
+        for sat in self.sats:
+            total = scene.num_timestamps(sat)
+            num_samples = num_timestamps[sat] if args.all_samples else min(num_timestamps[sat], args.num_timesteps)
+            self.time_idxs[sat] = np.unique(np.round(np.linspace(0, total - 1, num_samples)).astype(int))
+
+        self.dates = {sat: np.asarray(scene.dates[sat])[self.time_idxs[sat]] if scene.dates.get(sat) is not None else None
+                      for sat in self.sats}
+        if args.include_doy and any(self.dates[sat] is None for sat in self.sats):
+            raise ValueError('--include_doy requires the dates of each satellite')
+
+    def _preprocess_sat(self, data, sat):
+        args = self.args
+        data = data[..., self.time_idxs[sat]]
+        num_bands = None
+        if sat == 's2':
+            if args.s2_num_bands == 4:
+                data = data[[BANDS[sat]['10']['BLUE'], BANDS[sat]['10']['GREEN'], BANDS[sat]['10']['RED'], BANDS[sat]['10']['NIR']]]
+            elif args.s2_num_bands == 10:
+                data = data[:10]
+            else:
+                raise ValueError('s2_num_bands must be 4 or 10')
+            num_bands = args.s2_num_bands
+        elif sat == 'planet':
+            num_bands = PLANET_NUM_BANDS
+
+        if args.include_indices and sat in ['planet', 's2']:
+            ndvi, gcvi = preprocess.vegetation_indices(data, sat, num_bands)
+        if args.normalize:
+            data = preprocess.normalization(data, sat, args.country)
+        if args.include_indices and sat in ['planet', 's2']:
+            data = np.concatenate((data, np.expand_dims(ndvi, axis=0), np.expand_dims(gcvi, axis=0)), 0)
+        if args.include_doy and not self.broadcast_doy:
+            data = np.concatenate((data, preprocess.doy2stack(self.dates[sat], data.shape)), 0)
+        return data
+
+    def read_tile(self, scene, row, col, size):
+        """ Reads and preprocesses a tile, returns the model inputs for it
+        """
+        args = self.args
+        sat_data = {sat: self._preprocess_sat(scene.read(sat, row, col, size), sat) for sat in self.sats}
+        if not args.var_length:
+            grid, _ = preprocess.concat_s1_s2_planet(sat_data.get('s1'), sat_data.get('s2'), sat_data.get('planet'), True)
+            return preprocess.preprocess_grid(grid, args.model_name, args.time_slice)
+
+        inputs = {}
+        for sat in self.sats:
+            inputs[sat] = preprocess.preprocess_grid(sat_data[sat], args.model_name, args.time_slice)
+            if self.broadcast_doy:
+                inputs[sat + '_doy'] = preprocess.doy2vec(self.dates[sat])
+        return inputs
+
+    def collate(self, tiles):
+        """ Batches tiles, all tiles of a scene have the same number of timestamps
+        """
+        if not self.args.var_length:
+            return torch.stack(tiles)
+        inputs = {}
+        for key in tiles[0]:
+            inputs[key] = torch.stack([tile[key] for tile in tiles])
+            if not key.endswith('_doy'):
+                inputs[key + '_lengths'] = [inputs[key].shape[1]] * len(tiles)
+        return inputs
+
+def tile_positions(size, tile_size, stride):
+    """ Returns tile offsets covering [0, size), the last tile is aligned to the end
+    """
+    if size < tile_size:
+        raise ValueError(f'Scene size {size} is smaller than the tile size {tile_size}')
+    positions = list(range(0, size - tile_size + 1, stride))
+    if positions[-1] != size - tile_size:
+        positions.append(size - tile_size)
+    return positions
+
+def blend_window(tile_size, overlap):
+    """ Returns [tile_size x tile_size] weights that ramp down linearly over the overlap at
+        the tile borders, so that overlapping predictions are blended smoothly
+    """
+    weights = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        ramp = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        weights[:overlap] = ramp
+        weights[-overlap:] = ramp[::-1]
+    return np.outer(weights, weights)
+
+def predict_scene(model, model_name, scene, preprocessor, writer, num_classes, tile_size, overlap, batch_size, device):
+    """ Predicts a scene tile by tile and streams the crop type map to writer.
+
+    Tiles are processed one row of tiles at a time. Log probabilities of overlapping tiles are
+    blended with blend_window and rows that no later tile covers are written out and dropped,
+    so only about two rows of tiles are held in memory.
+
+    Returns:
+      num_tiles - (int) number of tiles predicted
+      tiles_per_sec - (float) throughput, including reading and preprocessing
+    """
+    rows, cols = scene.shape
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError('overlap must be smaller than the tile size')
+    row_positions = tile_positions(rows, tile_size, stride)
+    col_positions = tile_positions(cols, tile_size, stride)
+    window = blend_window(tile_size, overlap)
+
+    # blended log probabilities of rows [buffer_row, buffer_row + acc.shape[1])
+    acc = np.zeros((num_classes, 0, cols), dtype=np.float32)
+    buffer_row = 0
+    num_tiles = 0
+    model.eval()
+    start = time.time()
+
+    with tqdm(total=len(row_positions) * len(col_positions), unit='tile') as progress:
+        for row_idx, row in enumerate(row_positions):
+            missing = row + tile_size - buffer_row - acc.shape[1]
+            if missing > 0:
+                acc = np.concatenate([acc, np.zeros((num_classes, missing, cols), dtype=np.float32)], axis=1)
+
+            for batch_start in range(0, len(col_positions), batch_size):
+                batch_cols = col_positions[batch_start:batch_start+batch_size]
+                inputs = preprocessor.collate([preprocessor.read_tile(scene, row, col, tile_size) for col in batch_cols])
+                with torch.no_grad():
+                    if model_name in MULTI_RES_MODELS:
+                        preds = model(inputs, torch.zeros(len(batch_cols)))
+                    else:
+                        preds = model(inputs)
+                preds = preds.float().cpu().numpy()
+
+                for pred, col in zip(preds, batch_cols):
+                    acc[:, row-buffer_row:row-buffer_row+tile_size, col:col+tile_size] += pred * window
+                num_tiles += len(batch_cols)
+                progress.update(len(batch_cols))
+
+            # rows above the next row of tiles are final, weights are positive so the argmax
+            # of the weighted sum is the argmax of the blended log probabilities. Classes are
+            # written 1-based, 0 is nodata as in the label rasters
+            next_row = row_positions[row_idx + 1] if row_idx + 1 < len(row_positions) else rows
+            done = next_row - buffer_row
+            writer.write(buffer_row, (np.argmax(acc[:, :done], axis=0) + 1).astype(np.uint8))
+            acc = acc[:, done:]
+            buffer_row = next_row
+
+    elapsed = time.time() - start
+    return num_tiles, num_tiles / elapsed if elapsed > 0 else float('inf')
+
+def get_scene(args):
+    paths = {sat: getattr(args, f'scene_{sat}') for sat in SATS if getattr(args, f'use_{sat}')}
+    missing = [sat for sat, path in paths.items() if path is None]
+    if missing:
+        raise ValueError(f'No scene given for {missing}, set --scene_SAT or --use_SAT=False')
+    dates = {sat: np.load(args.__dict__[f'scene_{sat}_dates']) if args.__dict__[f'scene_{sat}_dates'] else None
+             for sat in paths}
+    if all(path.endswith('.npy') for path in paths.values()):
+        return ArrayScene(paths, dates)
+    return RasterScene(paths, dates)
+
+def get_writer(args, scene):
+    if args.out_path.endswith('.npy') or scene.profile is None:
+        return ArrayWriter(args.out_path, scene.shape)
+    return GeoTiffWriter(args.out_path, scene.shape, scene.profile)
+
+def get_device(args):
+    use_cuda = args.device == 'cuda' and torch.cuda.is_available() and args.quantize == 'none'
+    return torch.device('cuda' if use_cuda else 'cpu')
+
+def load_model(args, device):
+    """ Builds the model from args and loads the state dict at args.model_path. With
+        args.quantize, loads the quantized model saved by quantization.py at args.quantized_path
+        or, for dynamic quantization, quantizes the loaded model.
+    """
+    if args.model_name not in DL_MODELS:
+        raise ValueError(f'Inference is only supported for DL models, got {args.model_name}')
+    model = models.get_model(**vars(args))
+    if args.quantize != 'none':
+        quantization.check_quantize_args(args)
+    if args.quantize != 'none' and args.quantized_path is not None:
+        model = quantization.load_quantized(model, args.model_name, args.quantized_path)
+    elif args.quantize == 'static':
+        # calibration needs the training data, it is done once by quantization.py
+        raise ValueError('--quantize=static needs the --quantized_path saved by quantization.py')
+    else:
+        model.load_state_dict(torch.load(args.model_path, map_location=device))
+        if args.quantize == 'dynamic':
+            model = quantization.quantize_model(model, args.model_name, args.quantize)
+    model.to(device)
+    model.eval()
+    return model
+
+def add_inference_args(parser):
+    for sat in SATS:
+        parser.add_argument(f'--scene_{sat}', type=str, default=None,
+                            help=f"{sat} scene, GeoTIFF with timestamps*bands bands or [bands x rows x cols x timestamps] .npy")
+        parser.add_argument(f'--scene_{sat}_dates', type=str, default=None,
+                            help=f".npy vector of the day of year of each {sat} timestamp")
+    parser.add_argument('--out_path', type=str, required=True,
+                        help="Output crop type map, GeoTIFF (georeferenced like the scene) or .npy, with crop class c stored as c + 1 and 0 as nodata")
+    parser.add_argument('--overlap', type=int, default=8,
+                        help="Overlap in pixels between neighbouring tiles, tiles are GRID_SIZE[country] pixels")
+    return parser
+
+if __name__ == "__main__":
+    parser = add_inference_args(util.get_train_parser())
+    args = parser.parse_args()
+    if args.model_path is None and args.quantized_path is None:
+        raise ValueError('--model_path (or --quantized_path with --quantize) is required')
+
+    device = get_device(args)
+    model = load_model(args, device)
+    scene = get_scene(args)
+    preprocessor = TilePreprocessor(args, scene)
+    writer = get_writer(args, scene)
+    try:
+        num_tiles, tiles_per_sec = predict_scene(model, args.model_name, scene, preprocessor, writer,
+                                                 NUM_CLASSES[args.country], GRID_SIZE[args.country],
+                                                 args.overlap, args.batch_size, device)
+    finally:
+        writer.close()
+        scene.close()
+    print(f'Predicted {num_tiles} tiles at {tiles_per_sec:.2f} tiles/sec, map saved to {args.out_path}')
@@ -7,122 +7,119 @@ Loss functions and optimization definition.
 import numpy as np
 import torch.optim as optim
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 import preprocess
 
 from constants import *
 
-def get_loss_fn(model_name):
+def get_loss_fn(model_name, country, loss_weight=False, weight_scale=1, gamma=None):
     """
         Allows for changing the loss function depending on the model.
-        Currently always returns the focal_loss.
+        Returns the focal loss when gamma is given (--focal_loss), the masked
+        cross entropy loss otherwise. The loss object is built once per run
+        and holds the class weights.
     """
-    return mask_ce_loss
+    if gamma is not None:
+        return FocalLoss(country, loss_weight=loss_weight, weight_scale=weight_scale, gamma=gamma)
+    return MaskCELoss(country, loss_weight=loss_weight, weight_scale=weight_scale)
 
-def focal_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_scale=1, gamma=2):
-    """ Implementation of focal loss
+class MaskCELoss(object):
+    """ Masked cross entropy loss
 
     Args:
-      y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
-      y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
-                tensor of predicted crop classes
-      reduction - (str) "sum" specified to return loss and number examples in order to accumulate 
-                   over many batches. All other strings return loss / num_examples 
+      country - (str) country that the class weights are taken from
       loss_weight - (bool) whether or not to use weighted loss, weights defined in constants file
       weight_scale - (float, int) constant that loss weights are multiplied by
-      gamma - (int, float) constant for focal loss 
 
-    Returns:
-      loss - (float) loss value calculated wrt y_true and y_pred
-      num_examples - (int) returned when reduction == "sum" so that loss
-                      can be calculated over many batches
-    """ 
-    y_true = preprocess.reshapeForLoss(y_true)
-    num_examples = torch.sum(y_true, dtype=torch.float32).cuda()
-    
-    bs, classes, rows, cols = y_pred.shape
-    
-    y_pred = preprocess.reshapeForLoss(y_pred)
-    y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
-    y_confidence, _ = torch.sort(y_pred, dim=1, descending=True)
-    y_confidence = y_confidence[:, 0] - y_confidence[:, 1]
-    y_confidence = y_confidence.view([bs, rows, cols]).detach().cpu().numpy() * 255
-    y_true = y_true.type(torch.LongTensor).cuda()
-    
-    if loss_weight:
-        loss_fn = nn.NLLLoss(weight = LOSS_WEIGHT[country] ** weight_scale,reduction="none")
-    else:
-        loss_fn = nn.NLLLoss(reduction="none")
-    
-    # get the predictions for each true class
-    nll_loss = loss_fn(y_pred, y_true)
-    x = torch.gather(y_pred, dim=1, index=y_true.view(-1, 1))
-    # tricky line, essentially gathers the predictions for the correct class and takes e^{pred} to undo 
-    # log operation 
-    # .view(-1) necessary to get correct shape
-    focal_loss = (1 - torch.exp(x)) ** gamma
-    focal_loss = focal_loss.view(-1)
-    y = focal_loss * nll_loss
-    loss = torch.sum(focal_loss * nll_loss)
-
-    if num_examples == 0:
-        print("WARNING: NUMBER OF EXAMPLES IS 0")
-
-    if reduction == "sum":
-        if num_examples == 0:
-            return None, None, 0
-        else:
-            return loss, y_confidence, num_examples
-    else:
-        if num_examples == 0:
-            return None
-        else:
-            return loss / num_examples, y_confidence
-
-          
-def mask_ce_loss(y_true, y_pred, reduction, country, loss_weight=False, weight_scale=1):
-    """
-    Args:
+    Called as loss_fn(y_true, y_pred, reduction) with
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                integer class map with IGNORE_INDEX for unlabeled pixels
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
+                Both may also be passed already flattened by preprocess.flattenForLoss
       reduction - (str) "sum" specified to return loss and number examples in order to accumulate 
                    over many batches. All other strings return loss / num_examples 
-    
-    nn.CrossEntropyLoss expects inputs: y_pred [N x classes] and y_true [N x 1]
-    As input, y_pred and y_true have shapes [batch x classes x rows x cols] 
-
-    Finally, to get y_true from [N x classes] to [N x 1], we take the argmax along
-      the first dimension to get the largest class values from the one-hot encoding
 
+    Labels are flattened to class indices and unlabeled pixels are skipped through ignore_index,
+      so a step is a single NLL kernel without materialised masks.
     """
-    y_true = preprocess.reshapeForLoss(y_true)
-    num_examples = torch.sum(y_true, dtype=torch.float32).cuda()
-    y_pred = preprocess.reshapeForLoss(y_pred)
-    y_pred, y_true = preprocess.maskForLoss(y_pred, y_true)
-   
-    if loss_weight:
-        loss_fn = nn.NLLLoss(weight=LOSS_WEIGHT[country] ** weight_scale, reduction="none")
-    else:
-        loss_fn = nn.NLLLoss(reduction="none") 
-
-    total_loss = torch.sum(loss_fn(y_pred, y_true.cuda()))
-   
-    if num_examples == 0:
-        print("WARNING: NUMBER OF EXAMPLES IS 0")
-
-    if reduction == "sum":
-        if num_examples == 0:
-            return None, None, 0
-        else:
-            return total_loss, None, num_examples
-    else:
+    def __init__(self, country, loss_weight=False, weight_scale=1):
+        self.weight = LOSS_WEIGHT[country] ** weight_scale if loss_weight else None
+
+    def _weight(self, device):
+        # moved once, on first use, to the device of the predictions 
+        if self.weight is not None and self.weight.device != device:
+            self.weight = self.weight.to(device)
+        return self.weight
+
+    def _flatten(self, y_true, y_pred):
+        if y_pred.dim() == 4:
+            y_pred, y_true = preprocess.flattenForLoss(y_pred, y_true)
+        return y_true, y_pred
+
+    def _nll(self, y_true, y_pred, reduction):
+        # the loss is always computed in fp32, also for low precision (autocast) predictions
+        return F.nll_loss(y_pred.float(), y_true, weight=self._weight(y_pred.device), 
+                          ignore_index=IGNORE_INDEX, reduction=reduction)
+
+    def loss(self, y_true, y_pred):
+        """ Returns the summed loss and confidence for flattened labels and predictions
+        """
+        return self._nll(y_true, y_pred, "sum"), None
+
+    def __call__(self, y_true, y_pred, reduction):
+        """
+        Returns:
+          loss - (float) loss value calculated wrt y_true and y_pred
+          confidence - (npy array) confidence of the predictions, or None
+          num_examples - (int) returned when reduction == "sum" so that loss
+                          can be calculated over many batches
+        """
+        confidence_shape = [y_pred.shape[0], y_pred.shape[2], y_pred.shape[3]] if y_pred.dim() == 4 else [-1]
+        y_true, y_pred = self._flatten(y_true, y_pred)
+        num_examples = torch.sum(y_true != IGNORE_INDEX, dtype=torch.float32)
+        total_loss, confidence = self.loss(y_true, y_pred)
+        if confidence is not None:
+            confidence = confidence.view(confidence_shape).detach().cpu().numpy() * 255
+
         if num_examples == 0:
-            return None
+            print("WARNING: NUMBER OF EXAMPLES IS 0")
+
+        if reduction == "sum":
+            if num_examples == 0:
+                return None, None, 0
+            else:
+                return total_loss, confidence, num_examples
         else:
-            return total_loss / num_examples, None
+            if num_examples == 0:
+                return None
+            else:
+                return total_loss / num_examples, confidence
+
+class FocalLoss(MaskCELoss):
+    """ Implementation of focal loss, see MaskCELoss for arguments
+
+    Args:
+      gamma - (int, float) constant for focal loss 
+    """
+    def __init__(self, country, loss_weight=False, weight_scale=1, gamma=2):
+        super(FocalLoss, self).__init__(country, loss_weight, weight_scale)
+        self.gamma = gamma
+
+    def loss(self, y_true, y_pred):
+        valid = y_true != IGNORE_INDEX
+        y_confidence, _ = torch.topk(y_pred.detach(), 2, dim=1)
+        y_confidence = (y_confidence[:, 0] - y_confidence[:, 1]) * valid.float()
+
+        # get the predictions for each true class
+        nll_loss = self._nll(y_true, y_pred, "none")
+        # gathers the predictions for the correct class and takes e^{pred} to undo 
+        # log operation, unlabeled pixels have zero nll loss
+        x = torch.gather(y_pred, dim=1, index=y_true.clamp(min=0).view(-1, 1)).view(-1)
+        focal_loss = (1 - torch.exp(x)) ** self.gamma
+        return torch.sum(focal_loss * nll_loss), y_confidence
 
 def get_optimizer(params, optimizer_name, lr, momentum, weight_decay):
     """ Define optimizer for model training
@@ -145,3 +142,71 @@ def get_optimizer(params, optimizer_name, lr, momentum, weight_decay):
 
     raise ValueError(f"Optimizer: {optimizer_name} unsupported")
 
+
+class LRSchedule(object):
+    """ Learning rate schedule and early stopping driven by val F1.
+
+    The learning rate is multiplied by lrdecay after every optimizer step and by lr_decay when
+    val F1 has not improved for patience epochs. Training stops once val F1 has not improved
+    for early_stop_patience epochs.
+
+    Args:
+      optimizer - optimizer whose learning rate is scheduled
+      lr_decay - (float) factor to multiply lr by on a val F1 plateau, 1 disables
+      patience - (int) number of epochs without improvement before decaying lr
+      lrdecay - (float) factor to multiply lr by after every optimizer step, 1 disables
+      early_stop_patience - (int) number of epochs without improvement before stopping, 0 never stops
+    """
+    def __init__(self, optimizer, lr_decay, patience, lrdecay=1, early_stop_patience=0):
+        self.plateau = None
+        if lr_decay < 1:
+            self.plateau = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=lr_decay, patience=patience)
+        self.per_step = None
+        if lrdecay != 1:
+            self.per_step = optim.lr_scheduler.ExponentialLR(optimizer, gamma=lrdecay)
+        self.optimizer = optimizer
+        self.early_stop_patience = early_stop_patience
+        self.best_f1 = -np.inf
+        self.epochs_since_best = 0
+
+    def step_batch(self):
+        """ Called after every optimizer step
+        """
+        if self.per_step is not None:
+            self.per_step.step()
+
+    def step_epoch(self, val_f1):
+        """ Called with the val F1 of every epoch
+        """
+        if self.plateau is not None:
+            self.plateau.step(val_f1)
+        if val_f1 > self.best_f1:
+            self.best_f1 = val_f1
+            self.epochs_since_best = 0
+        else:
+            self.epochs_since_best += 1
+
+    @property
+    def should_stop(self):
+        return self.early_stop_patience > 0 and self.epochs_since_best >= self.early_stop_patience
+
+    @property
+    def lr(self):
+        return self.optimizer.param_groups[0]['lr']
+
+    def state_dict(self):
+        return {'plateau': self.plateau.state_dict() if self.plateau is not None else None,
+                'per_step': self.per_step.state_dict() if self.per_step is not None else None,
+                'best_f1': self.best_f1,
+                'epochs_since_best': self.epochs_since_best}
+
+    def load_state_dict(self, state):
+        if self.plateau is not None and state['plateau'] is not None:
+            self.plateau.load_state_dict(state['plateau'])
+        if self.per_step is not None and state['per_step'] is not None:
+            self.per_step.load_state_dict(state['per_step'])
+        self.best_f1 = state['best_f1']
+        self.epochs_since_best = state['epochs_since_best']
+
+def get_lr_schedule(optimizer, args):
+    return LRSchedule(optimizer, args.lr_decay, args.patience, args.lrdecay, args.early_stop_patience)
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+import distributed
 import util
 
 import preprocess
@@ -12,7 +13,8 @@ def get_accuracy(model_name, y_pred, y_true, reduction='avg'):
 
     Args: 
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                integer class map with IGNORE_INDEX for unlabeled pixels
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
       reduction - (str) "avg" specified to return average accuracy, defined as total_correct 
@@ -25,7 +27,11 @@ def get_accuracy(model_name, y_pred, y_true, reduction='avg'):
       
     """
         
-    if model_name in DL_MODELS:
+    if model_name in DL_MODELS and preprocess.is_index_label(y_true):
+        # Get only valid pixels and take argmax of predictions
+        y_pred, y_true = preprocess.maskIndexForMetric(y_pred, y_true)
+        total_correct = torch.sum(y_true == y_pred).item()
+    elif model_name in DL_MODELS:
         # Reshape truth labels into [N, num_classes]
         y_true = preprocess.reshapeForLoss(y_true)
 
@@ -71,7 +77,8 @@ def get_cm(y_pred, y_true, country, model_name):
 
     Args: 
       y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
-                tensor of ground truth crop classes
+                tensor of ground truth crop classes, or torch.Size([batch_size, img_height, img_width])
+                integer class map with IGNORE_INDEX for unlabeled pixels
       y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
                 tensor of predicted crop classes
     
@@ -81,12 +88,121 @@ def get_cm(y_pred, y_true, country, model_name):
     if model_name in NON_DL_MODELS:
         return confusion_matrix(y_true, y_pred, labels=CM_LABELS[country])
     elif model_name in DL_MODELS:
-        # Reshape truth labels into [N, num_classes]
-        y_true = preprocess.reshapeForLoss(y_true)
-        # Reshape predictions into [N, num_classes]
-        y_pred = preprocess.reshapeForLoss(y_pred)
-        y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
+        if preprocess.is_index_label(y_true):
+            y_pred, y_true = preprocess.maskIndexForMetric(y_pred, y_true)
+        else:
+            # Reshape truth labels into [N, num_classes]
+            y_true = preprocess.reshapeForLoss(y_true)
+            # Reshape predictions into [N, num_classes]
+            y_pred = preprocess.reshapeForLoss(y_pred)
+            y_pred, y_true = preprocess.maskForMetric(y_pred, y_true)
         if y_true.shape[0] == 0:
             return None
         else: 
-            return confusion_matrix(y_true.cpu(), y_pred.cpu(), labels=CM_LABELS[country])
+            return bincount_cm(y_pred, y_true, len(CM_LABELS[country]))
+
+def bincount_cm(y_pred, y_true, num_classes):
+    """
+    Get confusion matrix from vectors of valid predictions and labels, on their device
+
+    Args: 
+      y_true - (torch tensor) torch.Size([valid_pixel_locations]) ground truth crop classes
+      y_pred - (torch tensor) torch.Size([valid_pixel_locations]) predicted crop classes
+      num_classes - (int) number of classes
+
+    Returns: 
+      cm - (torch tensor) [num_classes x num_classes] confusion matrix, rows are true classes
+    """ 
+    y_true = y_true.to(y_pred.device).long()
+    cm = torch.bincount(num_classes * y_true + y_pred.long(), minlength=num_classes ** 2)
+    return cm.view(num_classes, num_classes)
+
+def flat_cm(y_pred, y_true, num_classes):
+    """
+    Get confusion matrix from flattened predictions and labels without selecting the 
+     valid pixels first; unlabeled pixels are counted in an extra bin that is dropped
+
+    Args: 
+      y_true - (torch tensor) torch.Size([N]) ground truth crop classes, IGNORE_INDEX where unlabeled
+      y_pred - (torch tensor) torch.Size([N, num_classes]) predicted crop classes
+      num_classes - (int) number of classes
+
+    Returns: 
+      cm - (torch tensor) [num_classes x num_classes] confusion matrix, rows are true classes
+    """ 
+    y_pred = torch.argmax(y_pred, dim=1)
+    bins = num_classes * y_true + y_pred
+    bins = torch.where(y_true != IGNORE_INDEX, bins, torch.full_like(bins, num_classes ** 2))
+    cm = torch.bincount(bins, minlength=num_classes ** 2 + 1)[:num_classes ** 2]
+    return cm.view(num_classes, num_classes)
+
+class ConfusionMatrix:
+    """ Streaming confusion matrix (and loss) accumulated in place on the device of the 
+    batch tensors. Values are only moved to the host when requested, i.e. at epoch end.
+    """
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.cm = None
+        self.loss_sum = None
+        self.reduced = False
+
+    def update(self, y_pred, y_true, loss=None):
+        """ Accumulates vectors of valid predictions and labels, returns the batch confusion matrix
+        """
+        batch_cm = bincount_cm(y_pred, y_true, self.num_classes)
+        self.add(batch_cm, loss)
+        return batch_cm
+
+    def add(self, batch_cm, loss=None):
+        """ Accumulates a batch confusion matrix and optionally the batch "sum" loss
+        """
+        self.reduced = False
+        if batch_cm is not None:
+            batch_cm = torch.as_tensor(batch_cm)
+            self.cm = batch_cm.clone() if self.cm is None else self.cm.add_(batch_cm.to(self.cm.device))
+        if loss is not None:
+            loss = loss.detach() if torch.is_tensor(loss) else loss
+            self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+
+    def all_reduce(self):
+        """ Sums the confusion matrix and loss over all ranks of a distributed run, once per
+            accumulation. Every rank must call it, also ranks that saw no batches.
+        """
+        if self.reduced or not distributed.is_initialized():
+            return
+        if self.cm is None:
+            self.cm = torch.zeros((self.num_classes, self.num_classes), dtype=torch.long)
+        loss_sum = torch.as_tensor(0. if self.loss_sum is None else self.loss_sum, dtype=torch.float64, device=self.cm.device)
+        distributed.all_reduce_sum(self.cm)
+        self.loss_sum = distributed.all_reduce_sum(loss_sum)
+        self.reduced = True
+
+    def value(self):
+        """ Returns the confusion matrix as an int numpy array
+        """
+        if self.cm is None:
+            return np.zeros((self.num_classes, self.num_classes)).astype(int)
+        return self.cm.cpu().numpy().astype(int)
+
+    def correct(self):
+        return int(np.trace(self.value()))
+
+    def pixels(self):
+        return int(np.sum(self.value()))
+
+    def total_loss(self):
+        return float(self.loss_sum) if self.loss_sum is not None else 0
+
+    def accuracy(self):
+        return self.correct() / self.pixels() if self.pixels() > 0 else None
+
+    def loss(self):
+        """ Loss weighted by the number of valid pixels
+        """
+        return self.total_loss() / self.pixels() if self.pixels() > 0 else None
+
+    def f1score(self, avg=True):
+        return get_f1score(self.value(), avg=avg)
@@ -0,0 +1,335 @@
+"""
+
+Metrics sinks for training runs.
+
+A sink accumulates the per split confusion matrices and progress metrics that train.py reads
+back (i.e. epoch_data['val_cm'] to pick the best model) and writes scalars, epoch metrics and
+optionally batch images to a backend:
+
+  visdom  - live plots on a visdom server (visualize.VisdomLogger)
+  jsonl   - append-only JSON lines file on local disk
+  parquet - append-only directory of parquet parts on local disk
+  none    - only tracks the metrics
+
+Writes run on a background thread fed by a bounded queue (see MetricsSink), so the training
+step loop does not wait on the backend.
+
+"""
+import copy
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+import distributed
+import metrics
+from constants import *
+
+class MetricsSink(object):
+    """ Base sink, tracks the metrics and does not write them anywhere.
+
+    With async_logging, writes run on a background thread fed by a bounded queue. Batch records
+    and scalars are dropped when the queue is full, so training never waits on the backend;
+    epoch records and saved (best) batches always wait for a free slot. Batch images are only
+    recorded every image_every[split] batches and each scalar every scalar_every updates.
+
+    Backends override _record_batch, _log_scalar and _record_epoch.
+    """
+    def __init__(self, country, splits, async_logging=False, queue_size=8, image_every=None, scalar_every=1):
+        self.country = country
+        self.splits = splits
+        self._init_progress_data()
+        self._init_epoch_data()
+
+        self.image_every = image_every or {}
+        self.scalar_every = scalar_every
+        self.batch_counts = {split: 0 for split in splits}
+        self.scalar_counts = {}
+        self.dropped = 0
+        self.queue = None
+        if async_logging:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+
+    def _init_progress_data(self):
+        # stores information across epochs
+        self.progress_data = {}
+        for split in self.splits:
+            self.progress_data[f'{split}_loss'] = []
+            self.progress_data[f'{split}_acc'] = []
+            self.progress_data[f'{split}_f1'] = []
+            self.progress_data[f'{split}_classf1'] = None
+        self.progress_data['train_gradnorm'] = []
+
+    def _init_epoch_data(self):
+        # stores information per epoch
+        self.epoch_data = {}
+        # confusion matrices and losses accumulate on device, epoch_data is filled in from them in record_epoch
+        self.epoch_cms = {}
+        for split in self.splits:
+            self.epoch_data[f'{split}_loss'] = 0
+            self.epoch_data[f'{split}_correct'] = 0
+            self.epoch_data[f'{split}_pix'] = 0
+            self.epoch_data[f'{split}_cm'] = np.zeros((NUM_CLASSES[self.country], NUM_CLASSES[self.country])).astype(int)
+            self.epoch_cms[split] = metrics.ConfusionMatrix(NUM_CLASSES[self.country])
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:
+                # a failed write should not take logging down for the rest of training
+                print(f'{type(self).__name__}: {type(e).__name__}: {e}')
+            finally:
+                self.queue.task_done()
+
+    def _submit(self, fn, *args, block=False, **kwargs):
+        """ Runs fn on the logging thread, or inline without async_logging. Non blocking
+            submissions are dropped when the queue is full.
+        """
+        if self.queue is None:
+            return fn(*args, **kwargs)
+        try:
+            self.queue.put((fn, args, kwargs), block=block)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """ Waits for all queued records to be written
+        """
+        if self.queue is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.queue = None
+            if self.dropped:
+                print(f'{type(self).__name__}: dropped {self.dropped} records, the logging queue was full')
+
+    def state_dict(self):
+        """ Returns the progress and sampling state, to resume a run with load_state_dict
+        """
+        return {'progress_data': copy.deepcopy(self.progress_data),
+                'batch_counts': dict(self.batch_counts),
+                'scalar_counts': dict(self.scalar_counts)}
+
+    def load_state_dict(self, state):
+        self.progress_data = copy.deepcopy(state['progress_data'])
+        self.batch_counts.update(state['batch_counts'])
+        self.scalar_counts.update(state['scalar_counts'])
+
+    def update_progress(self, split, metric_name, value):
+        self.progress_data[f'{split}_{metric_name}'].append(value)
+        self.log_scalar(split, metric_name, value, len(self.progress_data[f'{split}_{metric_name}']) - 1)
+
+    def log_scalar(self, split, metric_name, value, step):
+        """ Writes a scalar (i.e. gradnorm or throughput), sampled every scalar_every calls
+        """
+        key = f'{split}_{metric_name}'
+        count = self.scalar_counts.get(key, 0)
+        self.scalar_counts[key] = count + 1
+        if count % self.scalar_every == 0:
+            self._submit(self._log_scalar, split, metric_name, float(value), step)
+
+    def update_epoch_all(self, split, cm_cur, loss, total_correct, num_pixels):
+        # total_correct and num_pixels are recovered from the accumulated confusion matrix
+        self.epoch_cms[split].add(cm_cur, loss)
+
+    def sync_epoch_data(self, split):
+        """ Moves the accumulated epoch metrics for split to the host
+        """
+        epoch_cm = self.epoch_cms[split]
+        # sum over the ranks of a distributed run
+        epoch_cm.all_reduce()
+        self.epoch_data[f'{split}_cm'] = epoch_cm.value()
+        self.epoch_data[f'{split}_loss'] = epoch_cm.total_loss()
+        self.epoch_data[f'{split}_correct'] = epoch_cm.correct()
+        self.epoch_data[f'{split}_pix'] = epoch_cm.pixels()
+
+    def reset_epoch_data(self):
+        self._init_epoch_data()
+
+    def record_batch(self, inputs, clouds, targets, preds, confidence,
+                     num_classes, split, include_doy, use_s1, use_s2,
+                     model_name, time_slice,
+                     save=False, save_dir=None, show_visdom=True, show_matplot=False, var_length=False):
+        """ Records the inputs, targets and predictions of a batch, sampled every
+            image_every[split] batches unless saving or returning the matplot grids
+        """
+        batch_idx = self.batch_counts[split]
+        self.batch_counts[split] += 1
+
+        args = (inputs, clouds, targets, preds, confidence, num_classes, split, include_doy, use_s1, use_s2,
+                model_name, time_slice, save, save_dir, show_visdom, show_matplot, var_length)
+        if show_matplot:
+            return self._record_batch(*args)
+        if not save and batch_idx % self.image_every.get(split, 1) != 0:
+            return
+        if self.queue is not None:
+            # copy to the host so the logging thread does not hold on to (or race) device tensors
+            args = tuple(to_host(arg) for arg in args)
+        self._submit(self._record_batch, *args, block=save)
+
+    def record_epoch(self, split, epoch_num, country, save=False, save_dir=None):
+        """ Syncs the epoch metrics of split, adds them to progress_data and writes them
+        """
+        if country not in CROPS:
+            raise ValueError(f"Country {country} not supported in record_epoch")
+        class_names = CROPS[country]
+
+        self.sync_epoch_data(split)
+        loss_epoch, acc_epoch = None, None
+        if self.epoch_data[f'{split}_loss'] is not None:
+            loss_epoch = self.epoch_data[f'{split}_loss'] / self.epoch_data[f'{split}_pix']
+        if self.epoch_data[f'{split}_correct'] is not None:
+            acc_epoch = self.epoch_data[f'{split}_correct'] / self.epoch_data[f'{split}_pix']
+
+        # Don't append if you are saving. Information has already been appended!
+        if save == False:
+            self.progress_data[f'{split}_loss'].append(loss_epoch)
+            self.progress_data[f'{split}_acc'].append(acc_epoch)
+            self.progress_data[f'{split}_f1'].append(metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=True))
+
+            if self.progress_data[f'{split}_classf1'] is None:
+                self.progress_data[f'{split}_classf1'] = metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=False)
+                self.progress_data[f'{split}_classf1'] = np.vstack(self.progress_data[f'{split}_classf1']).T
+            else:
+                self.progress_data[f'{split}_classf1'] = np.vstack((self.progress_data[f'{split}_classf1'], metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=False)))
+
+        # write from snapshots, the logging thread may run while the next epoch updates the data
+        self._submit(self._record_epoch, split, epoch_num, country, class_names, save, save_dir,
+                     copy.deepcopy(self.progress_data), copy.deepcopy(self.epoch_data), block=True)
+
+    def _record_batch(self, inputs, clouds, targets, preds, confidence,
+                      num_classes, split, include_doy, use_s1, use_s2,
+                      model_name, time_slice,
+                      save, save_dir, show_visdom, show_matplot, var_length):
+        pass
+
+    def _log_scalar(self, split, metric_name, value, step):
+        pass
+
+    def _record_epoch(self, split, epoch_num, country, class_names, save, save_dir, progress_data, epoch_data):
+        pass
+
+class FileSink(MetricsSink):
+    """ Writes scalars and epoch metrics as records to local disk, either appended to a JSON
+        lines file or as append-only parquet parts of `flush_every` records. With save_images,
+        sampled batches are saved as npz files of predicted classes, labels and confidence.
+    """
+    def __init__(self, out_dir, country, splits, file_format='jsonl', save_images=False, flush_every=100, **kwargs):
+        if file_format not in ['jsonl', 'parquet']:
+            raise ValueError(f'file_format: `{file_format}` not supported')
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.save_images = save_images
+        self.flush_every = flush_every
+        self.records = []
+        self.num_parts = 0
+        self.jsonl = open(os.path.join(out_dir, 'metrics.jsonl'), 'a') if file_format == 'jsonl' else None
+        super(FileSink, self).__init__(country, splits, **kwargs)
+
+    def _write(self, record):
+        record['time'] = time.time()
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+        else:
+            self.records.append(record)
+            if len(self.records) >= self.flush_every:
+                self._write_part()
+
+    def _write_part(self):
+        import pandas as pd
+        if len(self.records) == 0:
+            return
+        path = os.path.join(self.out_dir, f'metrics-{time.strftime("%Y%m%d%H%M%S")}-{self.num_parts:05d}.parquet')
+        # nested values (per class f1, confusion matrices) are stored as json strings
+        records = [{key: json.dumps(value) if isinstance(value, list) else value for key, value in record.items()}
+                   for record in self.records]
+        pd.DataFrame(records).to_parquet(path)
+        self.num_parts += 1
+        self.records = []
+
+    def _log_scalar(self, split, metric_name, value, step):
+        self._write({'type': 'scalar', 'split': split, 'name': metric_name, 'step': step, 'value': value})
+
+    def _record_epoch(self, split, epoch_num, country, class_names, save, save_dir, progress_data, epoch_data):
+        if save:
+            return
+        cm = np.asarray(epoch_data[f'{split}_cm'])
+        self._write({'type': 'epoch', 'split': split, 'epoch': epoch_num,
+                     'loss': float(progress_data[f'{split}_loss'][-1]) if progress_data[f'{split}_loss'][-1] is not None else None,
+                     'acc': float(progress_data[f'{split}_acc'][-1]) if progress_data[f'{split}_acc'][-1] is not None else None,
+                     'f1': float(progress_data[f'{split}_f1'][-1]),
+                     'class_f1': [float(f1) for f1 in metrics.get_f1score(cm, avg=False)],
+                     'class_names': list(class_names),
+                     'cm': cm.tolist()})
+
+    def _record_batch(self, inputs, clouds, targets, preds, confidence,
+                      num_classes, split, include_doy, use_s1, use_s2,
+                      model_name, time_slice,
+                      save, save_dir, show_visdom, show_matplot, var_length):
+        if not self.save_images:
+            return
+        image_dir = os.path.join(self.out_dir, 'images')
+        os.makedirs(image_dir, exist_ok=True)
+        name = f'{split}_best' if save else f'{split}_{self.batch_counts[split] - 1:07d}'
+        arrays = {'preds': preds.detach().cpu().argmax(dim=1).numpy().astype(np.uint8),
+                  'targets': targets.cpu().numpy()}
+        if confidence is not None:
+            # the loss returns the confidence as a numpy array, flat for flattened predictions
+            confidence = np.asarray(confidence)
+            if confidence.size == arrays['preds'].size:
+                confidence = confidence.reshape(arrays['preds'].shape)
+            arrays['confidence'] = confidence
+        np.savez_compressed(os.path.join(image_dir, name + '.npz'), **arrays)
+
+    def close(self):
+        super(FileSink, self).close()
+        if self.jsonl is not None:
+            self.jsonl.close()
+        else:
+            self._write_part()
+
+def to_host(x):
+    """ Returns a host copy of tensors (also inside dicts), other values are returned as is
+    """
+    if torch.is_tensor(x):
+        return x.detach().to('cpu', copy=True)
+    if isinstance(x, dict):
+        return {key: to_host(value) for key, value in x.items()}
+    return x
+
+def get_metrics_sink(args, model_name, splits):
+    """ Returns the metrics sink selected by args.metrics_sink
+    """
+    if not distributed.is_main():
+        # other ranks of a distributed run only track (and all-reduce) the metrics
+        return MetricsSink(args.country, splits)
+    kwargs = {'async_logging': args.vis_async, 'queue_size': args.vis_queue_size,
+              'image_every': {'train': args.vis_train_every, 'val': args.vis_eval_every, 'test': args.vis_eval_every},
+              'scalar_every': args.vis_scalar_every}
+    if args.metrics_sink == 'visdom':
+        # visdom is only needed for this sink
+        import visualize
+        return visualize.VisdomLogger(args.env_name, model_name, args.country, splits, **kwargs)
+    elif args.metrics_sink in ['jsonl', 'parquet']:
+        out_dir = args.metrics_dir or os.path.join(args.save_dir, f'{args.name}_metrics')
+        return FileSink(out_dir, args.country, splits, file_format=args.metrics_sink,
+                        save_images=args.sink_images, **kwargs)
+    elif args.metrics_sink == 'none':
+        kwargs['async_logging'] = False
+        return MetricsSink(args.country, splits, **kwargs)
+    raise ValueError(f"metrics_sink: `{args.metrics_sink}` not supported")
@@ -1,8 +1,9 @@
+import math
 import torch
 import torch.nn as nn
 
 def attn_or_avg(attention, avg_hidden_states, layer_outputs, rev_layer_outputs, bidirectional, lengths=None):
-    if (attention is None) or (attention(layer_outputs) is None):
+    if (attention is None) or (attention.attention is None):
         if not avg_hidden_states:
             # TODO: want to take the last non-zero padded output here instead!
             last_fwd_feat = layer_outputs[:, -1, :, :, :]
@@ -10,21 +11,59 @@ def attn_or_avg(attention, avg_hidden_states, layer_outputs, rev_layer_outputs,
             reweighted = torch.concat([last_fwd_feat, last_rev_feat], dim=1) if bidirectional else last_fwd_feat
             reweighted = torch.mean(reweighted, dim=1)
         else:
+            outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
             if lengths is not None:
-                layer_outputs = [torch.mean(layer_outputs[i, :length], dim=0) for i, length in enumerate(lengths)]
-                # TODO: sequences are padded, so you need to reverse only the non-padded inputs
-                if rev_layer_outputs is not None: rev_layer_outputs = [torch.mean(rev_layer_outputs[i, :length], dim=0) for i, length in enumerate(lengths)] 
-                outputs = torch.stack(layer_outputs + rev_layer_outputs) if rev_layer_outputs is not None else torch.stack(layer_outputs)
-                reweighted = outputs #?
+                # mean over the unpadded timesteps of both directions
+                mask = length_mask(lengths, layer_outputs.shape[1], outputs.device, bidirectional=rev_layer_outputs is not None)
+                reweighted = masked_mean(outputs, mask, dim=1)
             else:
-                outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
                 reweighted = torch.mean(outputs, dim=1)
     else:
         outputs = torch.cat([layer_outputs, rev_layer_outputs], dim=1) if rev_layer_outputs is not None else layer_outputs
-        reweighted = attention(outputs, lengths)
+        reweighted = attention(outputs, lengths, bidirectional=rev_layer_outputs is not None)
         reweighted = torch.sum(reweighted, dim=1)
     return reweighted
 
+def padding_mask(lengths, num_timesteps, device, reverse=False):
+    """ Returns a [batch, num_timesteps] bool mask that is False at padded timesteps.
+        With reverse, the sequences were flipped after padding so padding comes first.
+    """
+    steps = torch.arange(num_timesteps, device=device).view(1, -1)
+    lengths = torch.as_tensor(lengths, device=device).view(-1, 1)
+    if reverse:
+        return steps >= num_timesteps - lengths
+    return steps < lengths
+
+def length_mask(lengths, num_timesteps, device, bidirectional=False):
+    """ Returns the padding mask for outputs of num_timesteps steps, or for the forward and reverse 
+        outputs concatenated in time ([batch, 2*num_timesteps]) if bidirectional.
+    """
+    mask = padding_mask(lengths, num_timesteps, device)
+    if bidirectional:
+        mask = torch.cat([mask, padding_mask(lengths, num_timesteps, device, reverse=True)], dim=1)
+    return mask
+
+def _expand_mask(mask, x, dim):
+    """ Views a [batch, time_steps] mask so that it broadcasts against x with time along `dim`
+    """
+    shape = [1] * x.dim()
+    shape[0], shape[dim] = mask.shape
+    return mask.view(shape)
+
+def masked_mean(x, mask, dim=1):
+    """ Mean of x along dim over the timesteps where mask [batch, time_steps] is True
+    """
+    mask = _expand_mask(mask, x, dim).to(x.dtype)
+    return torch.sum(x * mask, dim=dim) / torch.sum(mask, dim=dim).clamp(min=1)
+
+def masked_softmax(scores, mask, dim=1):
+    """ Softmax of scores along dim, with zero weight at timesteps where mask [batch, time_steps] is False
+    """
+    mask = _expand_mask(mask, scores, dim)
+    weights = torch.softmax(scores.masked_fill(~mask, float('-inf')), dim=dim)
+    # fully padded sequences are nan after the softmax
+    return weights.masked_fill(~mask, 0)
+
 class VectorAtt(nn.Module):
 
     def __init__(self, hidden_dim_size):
@@ -37,13 +76,10 @@ class VectorAtt(nn.Module):
         nn.init.constant_(self.linear.weight, 1)
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, hidden_states, lengths=None):
+    def forward(self, hidden_states, mask=None):
         hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous() # puts channels last
-        weights = self.softmax(self.linear(hidden_states))
-        b, t, c, h, w = weights.shape
-        if lengths is not None: #TODO: gives backprop bug
-            for i, length in enumerate(lengths):
-                weights[i, t:] *= 0
+        scores = self.linear(hidden_states)
+        weights = self.softmax(scores) if mask is None else masked_softmax(scores, mask.to(scores.device), dim=1)
         reweighted = weights * hidden_states
         return reweighted.permute(0, 1, 4, 2, 3).contiguous()
 
@@ -65,10 +101,11 @@ class TemporalAtt(nn.Module):
         self.tanh = nn.Tanh()
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, mask=None):
         hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous()
         z1 = self.tanh(self.w_s1(hidden_states))
-        attn_weights = self.softmax(self.w_s2(z1))
+        scores = self.w_s2(z1)
+        attn_weights = self.softmax(scores) if mask is None else masked_softmax(scores, mask.to(scores.device), dim=1)
         reweighted = attn_weights * hidden_states
         reweighted = reweighted.permute(0, 1, 4, 2, 3).contiguous()
         return reweighted
@@ -76,7 +113,7 @@ class TemporalAtt(nn.Module):
 class SelfAtt(nn.Module):
     def __init__(self, hidden_dim_size, dk, dv):
         """
-            Self attention.
+            Self attention along the time axis, computed separately for each pixel.
             Assumes input will be in the form (batch, time_steps, hidden_dim_size, height, width) 
 
             Implementation based on self attention in the following paper: 
@@ -89,25 +126,40 @@ class SelfAtt(nn.Module):
         self.w_q = nn.Linear(in_features=hidden_dim_size, out_features=dk, bias=False)
         self.w_k = nn.Linear(in_features=hidden_dim_size, out_features=dk, bias=False)
         self.w_v = nn.Linear(in_features=hidden_dim_size, out_features=dv, bias=False)
-        self.softmax = nn.Softmax(dim=1)
-
-    def forward(self, hidden_states):
-        hidden_states = hidden_states.permute(0, 1, 3, 4, 2).contiguous()
-        nb, nt, nr, nc, nh = hidden_states.shape
+        self.softmax = nn.Softmax(dim=-1)
 
-        hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
+    def forward(self, hidden_states, mask=None):
+        """
+            hidden_states - (tensor) [batch, time_steps, hidden_dim_size, height, width]
+            mask - (tensor) optional [batch, time_steps] bool, False at padded timesteps. Padded
+                    timesteps are not attended to and their outputs are zero.
+        """
+        nb, nt, nh, nr, nc = hidden_states.shape
+        # [batch*rows*cols, time_steps, hidden_dim_size], each pixel is its own sequence
+        hidden_states = hidden_states.permute(0, 3, 4, 1, 2).reshape(nb * nr * nc, nt, nh)
         queries = self.w_q(hidden_states)
         keys = self.w_k(hidden_states)
         values = self.w_v(hidden_states)
         
-        attn = torch.mm(self.softmax(torch.mm(queries, torch.transpose(keys, 0, 1)) / torch.sqrt(torch.tensor(self.dk, dtype=torch.float).cuda())), values)      
-        attn = attn.view(nb, nt, nr, nc, -1)
-        attn = attn.permute(0, 1, 4, 2, 3).contiguous() 
+        # [batch*rows*cols, time_steps, time_steps]
+        scores = torch.bmm(queries, keys.transpose(1, 2)) / math.sqrt(self.dk)
+        if mask is not None:
+            mask = mask.to(scores.device)
+            pixel_mask = mask.view(nb, 1, nt).expand(nb, nr * nc, nt).reshape(-1, 1, nt)
+            scores = scores.masked_fill(~pixel_mask, float('-inf'))
+        attn = torch.bmm(self.softmax(scores), values)
+        if mask is not None:
+            # fully padded rows are nan after the softmax
+            attn = attn.masked_fill(~pixel_mask.transpose(1, 2), 0)
+
+        attn = attn.view(nb, nr, nc, nt, -1)
+        attn = attn.permute(0, 3, 4, 1, 2).contiguous() 
         return attn
 
 class ApplyAtt(nn.Module):
     def __init__(self, attn_type, hidden_dim_size, attn_dims):
         super(ApplyAtt, self).__init__()
+        self.attn_type = attn_type
         if attn_type == 'vector':
             self.attention = VectorAtt(hidden_dim_size)
         elif attn_type == 'temporal':
@@ -119,7 +171,17 @@ class ApplyAtt(nn.Module):
         else:
             raise ValueError('Specified attention type is not compatible')
 
-    def forward(self, hidden_states):
-        attn_weighted = self.attention(hidden_states) if self.attention is not None else None
-        return attn_weighted
+    def forward(self, hidden_states, lengths=None, bidirectional=False):
+        """
+            hidden_states - (tensor) [batch, time_steps, hidden_dim_size, height, width], for 
+                             bidirectional models the forward and reverse outputs concatenated in time
+            lengths - (tensor) optional [batch] unpadded sequence lengths
+        """
+        if self.attention is None:
+            return None
+        mask = None
+        if lengths is not None:
+            num_timesteps = hidden_states.shape[1] // 2 if bidirectional else hidden_states.shape[1]
+            mask = length_mask(lengths, num_timesteps, hidden_states.device, bidirectional=bidirectional)
+        return self.attention(hidden_states, mask)
 
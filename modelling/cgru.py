@@ -3,7 +3,7 @@ import torch.nn as nn
 
 from modelling.recurrent_norm import RecurrentNorm2d
 from modelling.cgru_cell import ConvGRUCell
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, checkpoint_with_frozen_stats
 
 class CGRU(nn.Module):
 
@@ -52,6 +52,8 @@ class CGRU(nn.Module):
                                          bias=self.bias))
 
         self.cell_list = nn.ModuleList(cell_list)
+        # recompute blocks of this many timesteps in backward instead of storing them, set by models.get_model
+        self.checkpoint_steps = None
         initialize_weights(self)
 
     def forward(self, input_tensor, hidden_state=None):
@@ -61,20 +63,24 @@ class CGRU(nn.Module):
 
         seq_len = input_tensor.size(1)
         cur_layer_input = input_tensor
+        checkpointing = bool(self.checkpoint_steps) and torch.is_grad_enabled()
+        block_len = self.checkpoint_steps if checkpointing else seq_len
         
         for layer_idx in range(self.gru_num_layers):
             # double check that this is right? i.e not resetting every time to 0?
             h = self.init_hidden_state[layer_idx]
-            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3]).cuda()
+            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3])
             output_inner_layers = []
             
-            for t in range(seq_len):
-                h = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :],
-                                                 cur_state=h, timestep=t)
+            for start in range(0, seq_len, block_len):
+                block_input = cur_layer_input[:, start:start+block_len]
+                if checkpointing:
+                    block_output, h = checkpoint_with_frozen_stats(self, self._run_steps, layer_idx, block_input, h, start)
+                else:
+                    block_output, h = self._run_steps(layer_idx, block_input, h, start)
+                output_inner_layers.append(block_output)
 
-                output_inner_layers.append(h)
-
-            layer_output = torch.stack(output_inner_layers, dim=1)
+            layer_output = torch.cat(output_inner_layers, dim=1)
             cur_layer_input = layer_output
             
             layer_output_list.append(layer_output)
@@ -87,6 +93,17 @@ class CGRU(nn.Module):
 
         return layer_output_list, last_state_list
 
+    def _run_steps(self, layer_idx, layer_input, h, start):
+        """ Runs the cell of layer `layer_idx` over the timesteps of layer_input [batch, steps, ...], 
+            the first of which is timestep `start`. Returns the stacked outputs and the last state.
+        """
+        outputs = []
+        for k in range(layer_input.size(1)):
+            h = self.cell_list[layer_idx](input_tensor=layer_input[:, k, :, :, :],
+                                          cur_state=h, timestep=start + k)
+            outputs.append(h)
+        return torch.stack(outputs, dim=1), h
+
     def _init_hidden(self):
         init_states = []
         for i in range(self.gru_num_layers):
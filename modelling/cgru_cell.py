@@ -71,8 +71,7 @@ class ConvGRUCell(nn.Module):
         initialize_weights(self)
 
     def forward(self, input_tensor, cur_state, timestep):
-        # TODO: should not have to call cuda here, figure out where this belongs
-        input_tensor.cuda()
+        input_tensor = input_tensor.to(cur_state.device)
         # BN over the outputs of these convs
         
         combined_conv = self.h_norm(self.h_conv(cur_state), timestep) + self.input_norm(self.input_conv(input_tensor), timestep)
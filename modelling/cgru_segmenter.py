@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, FP32LogSoftmax
 from modelling.cgru import CGRU
 
 class CGRUSegmenter(nn.Module):
@@ -20,14 +20,14 @@ class CGRUSegmenter(nn.Module):
         self.bidirectional = bidirectional
         in_channels = hidden_dims[-1] if not self.bidirectional else hidden_dims[-1] * 2
         self.conv = nn.Conv2d(in_channels=in_channels, out_channels=num_classes, kernel_size=conv_kernel_size, padding=int((conv_kernel_size - 1) / 2))
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
         initialize_weights(self)
 
     def forward(self, inputs):
         layer_output_list, last_state_list = self.cgru(inputs)
         final_state = last_state_list[0]
         if self.bidirectional:
-            rev_inputs = torch.tensor(inputs.cpu().detach().numpy()[::-1].copy(), dtype=torch.float32).cuda()
+            rev_inputs = torch.tensor(inputs.cpu().detach().numpy()[::-1].copy(), dtype=torch.float32).to(inputs.device)
             rev_layer_output_list, rev_last_state_list = self.cgru(rev_inputs)
             final_state = torch.cat([final_state, rev_last_state_list[0][0]], dim=1)
         scores = self.conv(final_state)
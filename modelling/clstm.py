@@ -1,9 +1,10 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from modelling.recurrent_norm import RecurrentNorm2d
 from modelling.clstm_cell import ConvLSTMCell
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, checkpoint_with_frozen_stats
 
 class CLSTM(nn.Module):
 
@@ -59,30 +60,43 @@ class CLSTM(nn.Module):
                                           bias=self.bias))
 
         self.cell_list = nn.ModuleList(cell_list)
+        # recompute blocks of this many timesteps in backward instead of storing them, set by models.get_model
+        self.checkpoint_steps = None
         initialize_weights(self)
 
-    def forward(self, input_tensor, hidden_state=None):
+    def forward(self, input_tensor, hidden_state=None, scalars=None):
+        """
+           Args:
+                input_tensor - (tensor) [batch, time_steps, channels, height, width]
+                scalars - (tensor) optional [batch, time_steps] or [batch, time_steps, S] per timestep
+                           values (i.e. day of year) fed to the first layer as constant channels
+        """
 
         layer_output_list = []
         last_state_list = []
         
         seq_len = input_tensor.size(1)
         cur_layer_input = input_tensor
+        checkpointing = bool(self.checkpoint_steps) and torch.is_grad_enabled()
+        block_len = self.checkpoint_steps if checkpointing else seq_len
         
         for layer_idx in range(self.lstm_num_layers):
             # double check that this is right? i.e not resetting every time to 0?
             h, c = self.init_hidden_state[layer_idx], self.init_cell_state[layer_idx]
-            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3]).cuda()
-            c = c.expand(input_tensor.size(0), c.shape[1], c.shape[2], c.shape[3]).cuda()
+            h = h.expand(input_tensor.size(0), h.shape[1], h.shape[2], h.shape[3])
+            c = c.expand(input_tensor.size(0), c.shape[1], c.shape[2], c.shape[3])
             output_inner_layers = []
             
-            for t in range(seq_len):
-                h, c = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :],
-                                                 cur_state=[h, c], timestep=t)
+            for start in range(0, seq_len, block_len):
+                block_input = cur_layer_input[:, start:start+block_len]
+                block_scalars = scalars[:, start:start+block_len] if (scalars is not None and layer_idx == 0) else None
+                if checkpointing:
+                    block_output, h, c = checkpoint_with_frozen_stats(self, self._run_steps, layer_idx, block_input, block_scalars, h, c, start)
+                else:
+                    block_output, h, c = self._run_steps(layer_idx, block_input, block_scalars, h, c, start)
+                output_inner_layers.append(block_output)
 
-                output_inner_layers.append(h)
-
-            layer_output = torch.stack(output_inner_layers, dim=1)
+            layer_output = torch.cat(output_inner_layers, dim=1)
             cur_layer_input = layer_output
             
             layer_output_list.append(layer_output)
@@ -95,8 +109,111 @@ class CLSTM(nn.Module):
         
         return layer_outputs, last_states
 
+    def _run_steps(self, layer_idx, layer_input, scalars, h, c, start):
+        """ Runs the cell of layer `layer_idx` over the timesteps of layer_input [batch, steps, ...], 
+            the first of which is timestep `start`. Returns the stacked outputs and the last state.
+        """
+        outputs = []
+        for k in range(layer_input.size(1)):
+            cur_scalars = scalars[:, k] if scalars is not None else None
+            h, c = self.cell_list[layer_idx](input_tensor=layer_input[:, k, :, :, :],
+                                             cur_state=[h, c], timestep=start + k, scalars=cur_scalars)
+            outputs.append(h)
+        return torch.stack(outputs, dim=1), h, c
+
     def _init_hidden(self):
         init_states = []
         for i in range(self.lstm_num_layers):
             init_states.append(nn.Parameter(torch.zeros(1, self.hidden_dims[i], self.width, self.height)))
         return nn.ParameterList(init_states)
+
+def _cat_conv_params(conv, conv_rev):
+    weight = torch.cat([conv.weight, conv_rev.weight], dim=0)
+    bias = torch.cat([conv.bias, conv_rev.bias], dim=0) if conv.bias is not None else None
+    return weight, bias
+
+def fused_bidir_forward(clstm, clstm_rev, input_tensor, scalars=None):
+    """ Runs `clstm` on the inputs and `clstm_rev` on the time reversed inputs in the same 
+        timestep loop. The two directions are stacked along the channels and each conv is 
+        a single grouped conv (groups=2) over the concatenated weights, which are kept separate
+        in the modules. Normalization stays per direction, so this matches running the two
+        CLSTMs one after the other. Timestep checkpointing (CLSTM.checkpoint_steps) is not
+        supported by the fused loop.
+
+        Args:
+            clstm, clstm_rev - (CLSTM) forward and reverse direction models with the same sizes
+            input_tensor - (tensor) [batch, time_steps, channels, height, width]
+            scalars - (tensor) optional [batch, time_steps] or [batch, time_steps, S] per timestep
+                       values, see CLSTM.forward
+
+        Returns:
+            (layer_outputs, last_states), (rev_layer_outputs, rev_last_states) as returned by
+             CLSTM.forward for each direction
+    """
+    if (clstm.checkpoint_steps or clstm_rev.checkpoint_steps) and torch.is_grad_enabled():
+        raise ValueError('--fused_bidir does not support --crnn_checkpoint_steps')
+    # as the cells do, move the inputs to the device of the weights
+    input_tensor = input_tensor.to(clstm.cell_list[0].input_conv.weight.device)
+    batch, seq_len = input_tensor.shape[0], input_tensor.shape[1]
+    cur_fwd_input = input_tensor
+    cur_rev_input = torch.flip(input_tensor, dims=[1])
+    if scalars is not None:
+        scalars = scalars.to(device=input_tensor.device, dtype=input_tensor.dtype)
+        scalars = scalars.unsqueeze(2) if scalars.dim() == 2 else scalars
+        rev_scalars = torch.flip(scalars, dims=[1])
+
+    for layer_idx in range(clstm.lstm_num_layers):
+        cell, cell_rev = clstm.cell_list[layer_idx], clstm_rev.cell_list[layer_idx]
+        hidden_dim = cell.hidden_dim
+        # concatenated once per forward, each direction is one group
+        input_weight, input_bias = _cat_conv_params(cell.input_conv, cell_rev.input_conv)
+        h_weight, h_bias = _cat_conv_params(cell.h_conv, cell_rev.h_conv)
+        num_bands = cur_fwd_input.shape[2]
+        layer_scalars = scalars if layer_idx == 0 else None
+        if layer_scalars is not None:
+            # response of the scalar channel weights to a plane of ones, see conv2d_with_scalars
+            ones = input_tensor.new_ones(1, 1, input_tensor.shape[3], input_tensor.shape[4])
+            scalar_responses = [F.conv2d(ones, input_weight[:, num_bands+idx:num_bands+idx+1], None, 
+                                         padding=cell.padding) for idx in range(layer_scalars.shape[2])]
+
+        h = torch.cat([clstm.init_hidden_state[layer_idx], clstm_rev.init_hidden_state[layer_idx]], dim=1)
+        c = torch.cat([clstm.init_cell_state[layer_idx], clstm_rev.init_cell_state[layer_idx]], dim=1)
+        h = h.expand(batch, h.shape[1], h.shape[2], h.shape[3])
+        c = c.expand(batch, c.shape[1], c.shape[2], c.shape[3])
+        fwd_outputs, rev_outputs = [], []
+
+        for t in range(seq_len):
+            x = torch.cat([cur_fwd_input[:, t], cur_rev_input[:, t]], dim=1)
+            input_conv = F.conv2d(x, input_weight[:, :num_bands], input_bias, padding=cell.padding, groups=2)
+            if layer_scalars is not None:
+                for idx, response in enumerate(scalar_responses):
+                    scale = torch.cat([layer_scalars[:, t, idx:idx+1].expand(batch, 4 * hidden_dim), 
+                                       rev_scalars[:, t, idx:idx+1].expand(batch, 4 * hidden_dim)], dim=1)
+                    input_conv = input_conv + scale.view(batch, -1, 1, 1) * response
+            h_conv = F.conv2d(h, h_weight, h_bias, padding=cell.padding, groups=2)
+
+            # BN over the outputs of these convs, with the statistics of each direction
+            combined_conv = torch.cat([cell.h_norm(h_conv[:, :4*hidden_dim], t) + cell.input_norm(input_conv[:, :4*hidden_dim], t),
+                                       cell_rev.h_norm(h_conv[:, 4*hidden_dim:], t) + cell_rev.input_norm(input_conv[:, 4*hidden_dim:], t)], dim=1)
+            # [batch, direction, gate, hidden_dim, height, width]
+            gates = combined_conv.view(batch, 2, 4, hidden_dim, combined_conv.shape[-2], combined_conv.shape[-1])
+            i = torch.sigmoid(gates[:, :, 0])
+            f = torch.sigmoid(gates[:, :, 1])
+            o = torch.sigmoid(gates[:, :, 2])
+            g = torch.tanh(gates[:, :, 3])
+            c_next = f * c.reshape(i.shape) + i * g
+            # BN over the tanh
+            tanh_c = torch.tanh(c_next)
+            h_next = o * torch.stack([cell.cell_norm(tanh_c[:, 0], t), cell_rev.cell_norm(tanh_c[:, 1], t)], dim=1)
+
+            h = h_next.view(batch, 2 * hidden_dim, h_next.shape[-2], h_next.shape[-1])
+            c = c_next.view_as(h)
+            fwd_outputs.append(h_next[:, 0])
+            rev_outputs.append(h_next[:, 1])
+
+        cur_fwd_input = torch.stack(fwd_outputs, dim=1)
+        cur_rev_input = torch.stack(rev_outputs, dim=1)
+
+    last_fwd_states = [[h[:, :hidden_dim], c[:, :hidden_dim]]]
+    last_rev_states = [[h[:, hidden_dim:], c[:, hidden_dim:]]]
+    return (cur_fwd_input, last_fwd_states), (cur_rev_input, last_rev_states)
@@ -7,7 +7,7 @@ from torchvision import models
 import numpy as np
 from constants import *
 from modelling.recurrent_norm import RecurrentNorm2d
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, conv2d_with_scalars
 
 class ConvLSTMCell(nn.Module):
     """
@@ -61,11 +61,13 @@ class ConvLSTMCell(nn.Module):
         
         initialize_weights(self)
 
-    def forward(self, input_tensor, cur_state, timestep):
+    def forward(self, input_tensor, cur_state, timestep, scalars=None):
         
         h_cur, c_cur = cur_state
+        # scalars (i.e. day of year) are the trailing input channels, broadcast inside the input conv
+        input_conv = conv2d_with_scalars(self.input_conv, input_tensor.to(h_cur.device), scalars)
         # BN over the outputs of these convs
-        combined_conv = self.h_norm(self.h_conv(h_cur), timestep) + self.input_norm(self.input_conv(input_tensor.cuda()), timestep)
+        combined_conv = self.h_norm(self.h_conv(h_cur), timestep) + self.input_norm(input_conv, timestep)
  
         cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1) 
         i = torch.sigmoid(cc_i)
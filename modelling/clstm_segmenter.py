@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
-from modelling.clstm import CLSTM
+from modelling.util import initialize_weights, FP32LogSoftmax
+from modelling.clstm import CLSTM, fused_bidir_forward
 from modelling.attention import ApplyAtt, attn_or_avg
 
 class CLSTMSegmenter(nn.Module):
@@ -10,7 +10,7 @@ class CLSTMSegmenter(nn.Module):
 
     def __init__(self, input_size, hidden_dims, lstm_kernel_sizes, conv_kernel_size, 
                  lstm_num_layers, num_outputs, bidirectional, with_pred=False, 
-                 avg_hidden_states=None, attn_type=None, d=None, r=None, dk=None, dv=None): 
+                 avg_hidden_states=None, attn_type=None, attn_dims=None): 
 
         super(CLSTMSegmenter, self).__init__()
         self.input_size = input_size
@@ -19,12 +19,12 @@ class CLSTMSegmenter(nn.Module):
 
         if self.with_pred:
             self.avg_hidden_states = avg_hidden_states
-            self.attention = ApplyAtt(attn_type, hidden_dims, d=d, r=r, dk=dk, dv=dv) 
+            self.attention = ApplyAtt(attn_type, hidden_dims, attn_dims) 
             self.final_conv = nn.Conv2d(in_channels=hidden_dims, 
                                         out_channels=num_outputs, 
                                         kernel_size=conv_kernel_size, 
                                         padding=int((conv_kernel_size-1)/2)) 
-            self.logsoftmax = nn.LogSoftmax(dim=1)
+            self.logsoftmax = FP32LogSoftmax(dim=1)
         
         if not isinstance(hidden_dims, list):
             hidden_dims = [hidden_dims]        
@@ -32,24 +32,33 @@ class CLSTMSegmenter(nn.Module):
         self.clstm = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers)
         
         self.bidirectional = bidirectional
+        # advance both directions in the same timestep loop, set by models.get_model
+        self.fused_bidir = False
         if self.bidirectional:
             self.clstm_rev = CLSTM(input_size, hidden_dims, lstm_kernel_sizes, lstm_num_layers, bidirectional)
         
         in_channels = hidden_dims[-1] if not self.bidirectional else hidden_dims[-1] * 2
         initialize_weights(self)
        
-    def forward(self, inputs):
-
-        layer_outputs, last_states = self.clstm(inputs)
-    
+    def forward(self, inputs, doy=None):
+        """
+            inputs - (tensor) [batch, time_steps, channels, height, width]
+            doy - (tensor) optional [batch, time_steps] day of year values, broadcast inside 
+                   the first convolution instead of being stacked onto the inputs as bands
+        """
         rev_layer_outputs = None
-        if self.bidirectional:
-            rev_inputs = torch.flip(inputs, dims=[1])
-            rev_layer_outputs, rev_last_states = self.clstm_rev(rev_inputs)
+        if self.bidirectional and self.fused_bidir:
+            (layer_outputs, last_states), (rev_layer_outputs, rev_last_states) = fused_bidir_forward(self.clstm, self.clstm_rev, inputs, doy)
+        else:
+            layer_outputs, last_states = self.clstm(inputs, scalars=doy)
+            if self.bidirectional:
+                rev_inputs = torch.flip(inputs, dims=[1])
+                rev_doy = torch.flip(doy, dims=[1]) if doy is not None else None
+                rev_layer_outputs, rev_last_states = self.clstm_rev(rev_inputs, scalars=rev_doy)
 
         if self.with_pred:
             # Apply attention
-            reweighted = attn_or_avg(self.attention, self.avg_hidden_states, layer_outputs, rev_layer_ouputs, self.bidirectional)
+            reweighted = attn_or_avg(self.attention, self.avg_hidden_states, layer_outputs, rev_layer_outputs, self.bidirectional)
 
             # Apply final conv
             scores = self.final_conv(reweighted)
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, apply_to_frames, FP32LogSoftmax, autocast_state, apply_autocast_state
 from modelling.clstm import CLSTM
 from modelling.clstm_segmenter import CLSTMSegmenter
 from modelling.unet import UNet, UNet_Encode, UNet_Decode
@@ -8,6 +8,7 @@ from modelling.attention import ApplyAtt, attn_or_avg
 from pprint import pprint
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 class MI_CLSTM(nn.Module):
     """ MI_CLSTM = Multi Input CLSTM 
@@ -121,62 +122,87 @@ class MI_CLSTM(nn.Module):
         total_sats = len([sat for sat in self.satellites if self.satellites[sat]])
         self.out_linear = nn.Linear(num_classes * total_sats, num_classes)
         self.softmax = nn.Softmax2d()
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
+        # frames per chunk for the per frame encoders and whether to checkpoint them, set by models.get_model
+        self.frame_chunk_size = None
+        self.checkpoint_frames = False
+        # run the satellite branches concurrently, set by models.get_model
+        self.parallel_sats = False
                 
     def forward(self, inputs):
-        preds = []
-        for sat in self.satellites:
-            if self.satellites[sat]:
-                sat_data = inputs[sat]
-                lengths = inputs[sat + "_lengths"]
-                batch, timestamps, bands, rows, cols = sat_data.size()
-                fcn_input = sat_data.view(batch * timestamps, bands, rows, cols)
-                
-                if self.early_feats:
-                    # Encode features
-                    center1_feats, enc4_feats, enc3_feats, _, _ = self.encs[sat](fcn_input, hres=None)
-                    # Reshape tensors to separate batch and timestamps
-                    crnn_input = center1_feats.view(batch, timestamps, -1, center1_feats.shape[-2], center1_feats.shape[-1])
-                    enc4_feats = enc4_feats.view(batch, timestamps, -1, enc4_feats.shape[-2], enc4_feats.shape[-1])
-                    enc3_feats = enc3_feats.view(batch, timestamps, -1, enc3_feats.shape[-2], enc3_feats.shape[-1])
-
-                    enc3_feats = torch.mean(enc3_feats, dim=1, keepdim=False)
-                    enc4_feats = torch.mean(enc4_feats, dim=1, keepdim=False)
-                    
-                    # Apply CRNN
-                    if self.clstms[sat] is not None:
-                        crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) 
-                    else:
-                        crnn_output_fwd = crnn_input 
-                        crnn_output_rev = None
- 
-                    # Apply attention
-                    reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
-                 
-                    # Apply final conv
-                    reweighted = reweighted.cuda()
-                    pred_enc = self.finalconv[sat](reweighted) if self.finalconv[sat] is not None else reweighted
-                    preds.append(self.decs[sat](pred_enc, enc4_feats, enc3_feats))
-
-                else:
-                    fcn_output = self.unets[sat](fcn_input, hres=None)
-                    # Apply CRNN
-                    crnn_input = fcn_output.view(batch, timestamps, -1, fcn_output.shape[-2], fcn_output.shape[-1])
-                    if self.clstms[sat] is not None:
-                        crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) #, lengths)
-                    else:
-                        crnn_output_fwd = crnn_input
-                        crnn_output_rev = None
-
-                    # Apply attention
-                    reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
-
-                    # Apply final conv
-                    scores = self.finalconv[sat](reweighted)
-                    sat_preds = self.logsoftmax(scores)
-                    preds.append(sat_preds)
+        sats = [sat for sat in self.satellites if self.satellites[sat]]
+        if self.parallel_sats and len(sats) > 1:
+            # the branches are independent until out_linear and torch ops release the GIL,
+            # so each branch runs on its own thread. Grad and autocast modes are thread local, pass them along
+            grad_enabled = torch.is_grad_enabled()
+            autocast_modes = autocast_state()
+            def forward_sat(sat):
+                with torch.set_grad_enabled(grad_enabled), apply_autocast_state(autocast_modes):
+                    return self._forward_sat(sat, inputs)
+            with ThreadPoolExecutor(max_workers=len(sats)) as executor:
+                preds = list(executor.map(forward_sat, sats))
+        else:
+            preds = [self._forward_sat(sat, inputs) for sat in sats]
         
         all_preds = torch.cat(preds, dim=1).permute(0, 2, 3, 1).contiguous()
         preds = self.out_linear(all_preds).permute(0, 3, 1, 2).contiguous()
         preds = self.logsoftmax(preds)
         return preds
+
+    def _forward_sat(self, sat, inputs):
+        """ Runs the branch of a single satellite, returns its [batch, num_classes, rows, cols] predictions
+        """
+        sat_data = inputs[sat]
+        lengths = inputs[sat + "_lengths"]
+        batch, timestamps, bands, rows, cols = sat_data.size()
+        fcn_input = sat_data.view(batch * timestamps, bands, rows, cols)
+        # compact [batch, timestamps] day of year, if it is not stacked into the bands
+        doy = inputs.get(sat + "_doy")
+        fcn_doy = doy.reshape(batch * timestamps, -1) if doy is not None else None
+
+        if self.early_feats:
+            # Encode features
+            center1_feats, enc4_feats, enc3_feats, _, _ = apply_to_frames(self.encs[sat], fcn_input, None, fcn_doy, 
+                                                                          chunk_size=self.frame_chunk_size, 
+                                                                          checkpoint_frames=self.checkpoint_frames)
+            # Reshape tensors to separate batch and timestamps
+            crnn_input = center1_feats.view(batch, timestamps, -1, center1_feats.shape[-2], center1_feats.shape[-1])
+            enc4_feats = enc4_feats.view(batch, timestamps, -1, enc4_feats.shape[-2], enc4_feats.shape[-1])
+            enc3_feats = enc3_feats.view(batch, timestamps, -1, enc3_feats.shape[-2], enc3_feats.shape[-1])
+
+            enc3_feats = torch.mean(enc3_feats, dim=1, keepdim=False)
+            enc4_feats = torch.mean(enc4_feats, dim=1, keepdim=False)
+
+            # Apply CRNN
+            if self.clstms[sat] is not None:
+                crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) 
+            else:
+                crnn_output_fwd = crnn_input 
+                crnn_output_rev = None
+
+            # Apply attention
+            reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
+
+            # Apply final conv
+            pred_enc = self.finalconv[sat](reweighted) if self.finalconv[sat] is not None else reweighted
+            return self.decs[sat](pred_enc, enc4_feats, enc3_feats)
+
+        else:
+            fcn_output = apply_to_frames(self.unets[sat], fcn_input, None, fcn_doy, 
+                                         chunk_size=self.frame_chunk_size, 
+                                         checkpoint_frames=self.checkpoint_frames)
+            # Apply CRNN
+            crnn_input = fcn_output.view(batch, timestamps, -1, fcn_output.shape[-2], fcn_output.shape[-1])
+            if self.clstms[sat] is not None:
+                crnn_output_fwd, crnn_output_rev = self.clstms[sat](crnn_input) #, lengths)
+            else:
+                crnn_output_fwd = crnn_input
+                crnn_output_rev = None
+
+            # Apply attention
+            reweighted = attn_or_avg(self.attention[sat], self.avg_hidden_states, crnn_output_fwd, crnn_output_rev, self.bidirectional, lengths)
+
+            # Apply final conv
+            scores = self.finalconv[sat](reweighted)
+            sat_preds = self.logsoftmax(scores)
+            return sat_preds
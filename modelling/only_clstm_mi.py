@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, FP32LogSoftmax
 from modelling.clstm import CLSTM
 from modelling.clstm_segmenter import CLSTMSegmenter
 from modelling.attention import ApplyAtt, attn_or_avg
@@ -72,7 +72,7 @@ class ONLY_CLSTM_MI(nn.Module):
         total_sats = len([sat for sat in self.satellites if self.satellites[sat]])
         self.out_linear = nn.Linear(num_classes * total_sats, num_classes)
         self.softmax = nn.Softmax2d()
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
                 
     def forward(self, inputs):
         preds = []
@@ -84,7 +84,7 @@ class ONLY_CLSTM_MI(nn.Module):
                 
                 # Apply CRNN
                 if self.clstms[sat] is not None:
-                    crnn_output_fwd, crnn_output_rev = self.clstms[sat](sat_data) #, lengths)
+                    crnn_output_fwd, crnn_output_rev = self.clstms[sat](sat_data, doy=inputs.get(sat + "_doy")) #, lengths)
                 else:
                     crnn_output_fwd = crnn_input
                     crnn_output_rev = None
@@ -68,10 +68,12 @@ class RecurrentNorm2d(nn.Module):
             time = self.max_length - 1
         running_mean = getattr(self, 'running_mean_{}'.format(time))
         running_var = getattr(self, 'running_var_{}'.format(time))
-        return functional.batch_norm(
-            input=input_, running_mean=running_mean, running_var=running_var,
-            weight=self.weight, bias=self.bias, training=self.training,
-            momentum=self.momentum, eps=self.eps)
+        # statistics are computed and tracked in fp32, also inside autocast regions
+        with torch.autocast(input_.device.type, enabled=False):
+            return functional.batch_norm(
+                input=input_.float(), running_mean=running_mean, running_var=running_var,
+                weight=self.weight, bias=self.bias, training=self.training,
+                momentum=self.momentum, eps=self.eps)
 
     def __repr__(self):
         return ('{name}({num_features}, eps={eps}, momentum={momentum},'
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from modelling.util import initialize_weights
+from modelling.util import initialize_weights, conv2d_with_scalars, FP32LogSoftmax
 
 
 class _EncoderBlock(nn.Module):
@@ -22,8 +22,12 @@ class _EncoderBlock(nn.Module):
             layers.append(nn.Dropout())
         self.encode = nn.Sequential(*layers)
 
-    def forward(self, x):
-        return self.encode(x)
+    def forward(self, x, scalars=None):
+        if scalars is None:
+            return self.encode(x)
+        # broadcast per-frame scalars (i.e. day of year) inside the first conv
+        x = conv2d_with_scalars(self.encode[0], x, scalars)
+        return self.encode[1:](x)
 
 class _DownSample(nn.Module):
     """ U-Net downsample block
@@ -62,8 +66,8 @@ class UNet(nn.Module):
         self.unet_encode = UNet_Encode(num_bands_dict, use_planet, resize_planet)
         self.unet_decode = UNet_Decode(num_classes, late_feats_for_fcn, use_planet, resize_planet)
 
-    def forward(self, x, hres):
-        center1, enc4, enc3, enc2, enc1 = self.unet_encode(x, hres) 
+    def forward(self, x, hres, doy=None):
+        center1, enc4, enc3, enc2, enc1 = self.unet_encode(x, hres, doy) 
         final = self.unet_decode(center1, enc4, enc3, enc2, enc1)
         return final
 
@@ -104,18 +108,24 @@ class UNet_Encode(nn.Module):
         
         initialize_weights(self)
 
-    def forward(self, x, hres):
-
+    def forward(self, x, hres, doy=None):
+        """
+            x - (tensor) [N, bands, rows, cols] input frames
+            hres - (tensor) optional high resolution frames
+            doy - (tensor) optional [N] or [N, S] day of year per frame, broadcast inside the 
+                   first convolution applied to x instead of being stacked onto x as bands
+        """
         # ENCODE
-        x = x.cuda()
-        if hres is not None: hres = hres.cuda()
+        device = next(self.parameters()).device
+        x = x.to(device)
+        if hres is not None: hres = hres.to(device)
         if (self.use_planet and self.resize_planet) or (not self.use_planet):
-            enc3 = self.enc3(x)
+            enc3 = self.enc3(x, doy)
         else:
             if hres is None:
-                enc1_hres = self.enc1_hres(x)
+                enc1_hres = self.enc1_hres(x, doy)
             else:
-                enc1_lres = self.enc1_lres(x)
+                enc1_lres = self.enc1_lres(x, doy)
                 enc2_lres = self.enc2_lres(enc1_lres)
                 enc1_hres = self.enc1_hres(hres)
  
@@ -174,7 +184,7 @@ class UNet_Decode(nn.Module):
             nn.Conv2d(feats*2, num_classes, kernel_size=3, padding=1),
         )
 
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
         initialize_weights(self)
 
     def forward(self, center1, enc4, enc3, enc2=None, enc1=None):
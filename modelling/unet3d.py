@@ -1,6 +1,8 @@
 import torch 
 import torch.nn as nn
 
+from modelling.util import FP32LogSoftmax
+
 
 def conv_block(in_dim, middle_dim, out_dim):
     model = nn.Sequential(
@@ -55,11 +57,11 @@ class UNet3D(nn.Module):
         self.dc3 = conv_block(feats*8, feats*4, feats*2)
         self.final = nn.Conv3d(feats*2, n_classes, kernel_size=3, stride=1, padding=1)    
         self.fn = nn.Linear(timesteps, 1)
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
         self.dropout = nn.Dropout(p=dropout, inplace=True)
         
     def forward(self, x):
-        x = x.cuda()
+        x = x.to(next(self.parameters()).device)
         en3 = self.en3(x)
         pool_3 = self.pool_3(en3)
         en4 = self.en4(pool_3)
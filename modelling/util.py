@@ -1,13 +1,49 @@
+import contextlib
 import torch 
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from constants import *
+from modelling.recurrent_norm import RecurrentNorm2d
 
 def set_parameter_requires_grad(model, fix_feats):
     if fix_feats:
         for param in model.parameters():
             param.requires_grad = False
 
+@contextlib.contextmanager
+def frozen_stats(module):
+    """ Context in which the RecurrentNorm2d and BatchNorm layers of module normalize as usual, but
+        their running statistics are restored on exit. The layers run the same ops as outside of
+        it, which the checkpoint recompute relies on to match the saved tensors of the forward.
+    """
+    norms = [m for m in module.modules() if isinstance(m, (RecurrentNorm2d, nn.modules.batchnorm._BatchNorm))]
+    saved = [(buf, buf.clone()) for norm in norms for buf in norm.buffers(recurse=False)]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buf, value in saved:
+                buf.copy_(value)
+
+def has_batch_norm(module):
+    return any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in module.modules())
+
+def checkpoint_with_frozen_stats(module, fn, *args):
+    """ torch.utils.checkpoint of fn(*args), i.e. for the CLSTM / CGRU time loops or the per frame
+    UNets. The recompute in backward runs fn again in train mode, it must not update the running
+    statistics of the norm layers in module a second time, so it runs with them frozen.
+    """
+    calls = []
+    def run(*args):
+        if calls:
+            with frozen_stats(module):
+                return fn(*args)
+        calls.append(True)
+        return fn(*args)
+    return checkpoint(run, *args, use_reentrant=False)
+
 def initialize_weights(*models):
     for model in models:
         for module in model.modules():
@@ -19,7 +55,106 @@ def initialize_weights(*models):
                 module.weight.data.fill_(1)
                 module.bias.data.zero_()
 
-                
+
+class FP32LogSoftmax(nn.LogSoftmax):
+    """ LogSoftmax that always runs in fp32, also inside autocast regions, so that the
+        log probabilities fed to the NLL loss keep full precision
+    """
+    def forward(self, x):
+        with torch.autocast(x.device.type, enabled=False):
+            return super(FP32LogSoftmax, self).forward(x.float())
+
+def autocast_state():
+    """ Returns the enabled autocast modes of the current thread as [(device_type, dtype)]
+    """
+    modes = []
+    if torch.is_autocast_cpu_enabled():
+        modes.append(('cpu', torch.get_autocast_cpu_dtype()))
+    if torch.is_autocast_enabled():
+        modes.append(('cuda', torch.get_autocast_gpu_dtype()))
+    return modes
+
+def apply_autocast_state(modes):
+    """ Enters the autocast modes returned by autocast_state, i.e. on a worker thread
+    """
+    stack = contextlib.ExitStack()
+    for device_type, dtype in modes:
+        stack.enter_context(torch.autocast(device_type, dtype=dtype))
+    return stack
+
+def conv2d_with_scalars(conv, x, scalars=None):
+    """ Applies `conv` to `x` extended with input channels that are constant over space.
+
+    Gives the same result as conv(torch.cat([x, broadcast(scalars)], dim=1)) without
+    materialising the [N, S, rows, cols] scalar bands; their contribution is the response
+    of the matching weight slice to a plane of ones, scaled per sample.
+
+    Args:
+      conv - (nn.Conv2d) convolution whose last S input channels are the scalar channels
+      x - (tensor) [N, C, rows, cols] input bands
+      scalars - (tensor) [N] or [N, S] per sample values (i.e. normalized day of year)
+
+    Returns:
+      out - (tensor) output of conv
+    """
+    if scalars is None:
+        return conv(x)
+    if conv.groups != 1:
+        raise ValueError('Scalar channels are only supported for convolutions with groups=1')
+    if scalars.dim() == 1:
+        scalars = scalars.unsqueeze(1)
+    scalars = scalars.to(device=x.device, dtype=x.dtype)
+
+    num_bands = x.shape[1]
+    out = F.conv2d(x, conv.weight[:, :num_bands], conv.bias, conv.stride, conv.padding, conv.dilation)
+    ones = x.new_ones(1, 1, x.shape[2], x.shape[3])
+    for idx in range(scalars.shape[1]):
+        weight = conv.weight[:, num_bands+idx:num_bands+idx+1]
+        response = F.conv2d(ones, weight, None, conv.stride, conv.padding, conv.dilation)
+        out = out + scalars[:, idx].view(-1, 1, 1, 1) * response
+    return out
+
+def apply_to_frames(fn, frames, *args, chunk_size=None, checkpoint_frames=False):
+    """ Applies a per frame model to [N, ...] frames `chunk_size` frames at a time.
+
+    Bounds peak activation memory by the chunk size instead of N = batch*timestamps. The outputs
+    are identical to fn(frames, *args). In train mode, BatchNorm layers would normalize each chunk
+    with its own batch statistics, so chunking a fn with BatchNorm is only allowed in eval mode.
+    With checkpoint_frames, each chunk's activations are recomputed in backward instead of stored,
+    the recompute leaves the norm running statistics unchanged.
+
+    Args:
+      fn - (nn.Module) model applied to each chunk as fn(frames, *args)
+      frames - (tensor) [N, bands, rows, cols] frames
+      args - (tensor or None) further inputs with N leading, split along with the frames
+      chunk_size - (int) number of frames per chunk, None to use all frames at once
+      checkpoint_frames - (bool) whether to checkpoint the activations of each chunk
+
+    Returns:
+      outputs of fn, concatenated along the first dimension (tuple outputs elementwise)
+    """
+    num_frames = frames.shape[0]
+    chunk_size = chunk_size or num_frames
+    checkpoint_frames = checkpoint_frames and torch.is_grad_enabled()
+    if chunk_size >= num_frames and not checkpoint_frames:
+        return fn(frames, *args)
+    if chunk_size < num_frames and fn.training and has_batch_norm(fn):
+        raise ValueError('frame_chunk_size changes the BatchNorm batch statistics of the per frame model in train mode, '
+                         'use it for evaluation only or with early_feats')
+
+    outputs = []
+    for start in range(0, num_frames, chunk_size):
+        chunk_args = [arg[start:start+chunk_size] if arg is not None else None for arg in (frames,) + args]
+        if checkpoint_frames:
+            outputs.append(checkpoint_with_frozen_stats(fn, fn, *chunk_args))
+        else:
+            outputs.append(fn(*chunk_args))
+
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(chunk_outputs, dim=0) if chunk_outputs[0] is not None else None 
+                     for chunk_outputs in zip(*outputs))
+    return torch.cat(outputs, dim=0)
+
 def get_num_bands(kwargs):
     num_bands = 0
     added_doy = 0
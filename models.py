@@ -25,9 +25,10 @@ from modelling.baselines import make_rf_model, make_logreg_model, make_1d_nn_mod
 from modelling.recurrent_norm import RecurrentNorm2d
 from modelling.clstm_cell import ConvLSTMCell
 from modelling.clstm import CLSTM
+from modelling.cgru import CGRU
 from modelling.cgru_segmenter import CGRUSegmenter
 from modelling.clstm_segmenter import CLSTMSegmenter
-from modelling.util import initialize_weights, get_num_bands, get_upsampling_weight, set_parameter_requires_grad
+from modelling.util import initialize_weights, get_num_bands, get_upsampling_weight, set_parameter_requires_grad, apply_to_frames, FP32LogSoftmax
 from modelling.fcn8 import FCN8
 from modelling.unet import UNet, UNet_Encode, UNet_Decode
 from modelling.unet3d import UNet3D
@@ -64,6 +65,9 @@ class FCN_CRNN(nn.Module):
         self.enc_attn = enc_attn
         self.enc_attn_type = enc_attn_type
         self.processed_feats = {'main': None, 'enc4': None, 'enc3': None, 'enc2': None, 'enc1': None }
+        # frames per chunk for the per frame encoder and whether to checkpoint it, set by get_model
+        self.frame_chunk_size = None
+        self.checkpoint_frames = False
 
         # get appropriate encoder / decoder
         if not self.early_feats:
@@ -86,7 +90,7 @@ class FCN_CRNN(nn.Module):
             self.crnns = self.get_crnns()  
             self.final_convs = self.get_final_convs()
 
-        self.logsoftmax = nn.LogSoftmax(dim=1)
+        self.logsoftmax = FP32LogSoftmax(dim=1)
 
     def forward(self, input_tensor, hres_inputs=None):
         batch, timestamps, bands, rows, cols = input_tensor.size()
@@ -99,7 +103,9 @@ class FCN_CRNN(nn.Module):
 
         if self.early_feats:
             # Encode features
-            center1_feats, enc4_feats, enc3_feats, enc2_feats, enc1_feats = self.fcn_enc(fcn_input, fcn_input_hres)
+            center1_feats, enc4_feats, enc3_feats, enc2_feats, enc1_feats = apply_to_frames(self.fcn_enc, fcn_input, fcn_input_hres, 
+                                                                                            chunk_size=self.frame_chunk_size, 
+                                                                                            checkpoint_frames=self.checkpoint_frames)
 
             for cur_feats, cur_enc in zip([center1_feats, enc4_feats, enc3_feats, enc2_feats, enc1_feats], self.crnns):
                 if cur_feats is not None:
@@ -123,7 +129,8 @@ class FCN_CRNN(nn.Module):
         
         else:
             # Encode and decode features
-            fcn_output = self.fcn(fcn_input, fcn_input_hres)
+            fcn_output = apply_to_frames(self.fcn, fcn_input, fcn_input_hres, 
+                                         chunk_size=self.frame_chunk_size, checkpoint_frames=self.checkpoint_frames)
             
             # Apply CRNN
             crnn_input = fcn_output.view(batch, timestamps, -1, fcn_output.shape[-2], fcn_output.shape[-1])
@@ -309,7 +316,6 @@ def make_UNet_model(n_class, num_bands_dict, late_feats_for_fcn=False, pretraine
         model.unet_encode.enc4.encode[3] = pre_trained_features[7] # 128 in, 128 out
         model.unet_encode.center[0] = pre_trained_features[10]     # 128 in, 256 out
         
-    model = model.cuda()
     return model
 
 def make_UNetEncoder_model(num_bands_dict, use_planet=True, resize_planet=False, pretrained=True):
@@ -325,12 +331,10 @@ def make_UNetEncoder_model(num_bands_dict, use_planet=True, resize_planet=False,
         model.enc4.encode[3] = pre_trained_features[7] # 128 in, 128 out
         model.center[0] = pre_trained_features[10]     # 128 in, 256 out
 
-    model = model.cuda()
     return model
 
 def make_UNetDecoder_model(n_class, late_feats_for_fcn, use_planet, resize_planet):
     model = UNet_Decode(n_class, late_feats_for_fcn, use_planet, resize_planet)
-    model = model.cuda()
     return model
 
 def make_fcn_clstm_model(country, fcn_input_size, crnn_input_size, crnn_model_name, 
@@ -365,8 +369,6 @@ def make_fcn_clstm_model(country, fcn_input_size, crnn_input_size, crnn_model_na
                      conv_kernel_size, lstm_num_layers, avg_hidden_states, num_classes, bidirectional, pretrained, 
                      early_feats, use_planet, resize_planet, num_bands_dict, main_crnn, main_attn_type, attn_dims, 
                      enc_crnn, enc_attn, enc_attn_type)
-    model = model.cuda()
-
     return model
 
 def make_UNet3D_model(n_class, n_channel, timesteps, dropout):
@@ -380,7 +382,6 @@ def make_UNet3D_model(n_class, n_channel, timesteps, dropout):
     """
 
     model = UNet3D(n_channel, n_class, timesteps, dropout)
-    model = model.cuda()
     return model
 
 def get_model(model_name, **kwargs):
@@ -550,6 +551,25 @@ def get_model(model_name, **kwargs):
     else:
         raise ValueError(f"Model {model_name} unsupported, check `model_name` arg") 
         
+    if isinstance(model, (FCN_CRNN, MI_CLSTM)):
+        model.frame_chunk_size = kwargs.get('frame_chunk_size')
+        model.checkpoint_frames = kwargs.get('checkpoint_frames', False)
+
+    if isinstance(model, MI_CLSTM):
+        model.parallel_sats = kwargs.get('parallel_sats', False)
+
+    if kwargs.get('fused_bidir') and kwargs.get('crnn_checkpoint_steps'):
+        raise ValueError('--fused_bidir does not support --crnn_checkpoint_steps')
+
+    if kwargs.get('crnn_checkpoint_steps'):
+        for module in model.modules():
+            if isinstance(module, (CLSTM, CGRU)):
+                module.checkpoint_steps = kwargs.get('crnn_checkpoint_steps')
+
+    if kwargs.get('fused_bidir'):
+        for module in model.modules():
+            if isinstance(module, CLSTMSegmenter):
+                module.fused_bidir = True
 
     return model
 
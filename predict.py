@@ -0,0 +1,171 @@
+"""
+
+Script for batch prediction with a trained model
+
+Loads a `_best` state dict, predicts every grid of a split (or of a pickled grid list)
+and writes per grid class maps and class probabilities to an hdf5 or npz store, e.g.
+
+  `python predict.py --model_name=bidir_clstm --country=ghana --name=ghana_run --save_dir=models
+                     --split=test --out_path=ghana_test_preds.h5`
+
+The hdf5 store has datasets `class_map/GRID` ([rows x cols] uint8) and `probs/GRID`
+([classes x rows x cols] float16), the npz store has keys `class_map_GRID` and `probs_GRID`.
+
+As in the scene maps of inference.py, class maps store crop class c as c + 1 and keep 0 free
+for nodata / unlabeled, `probs[c]` is the probability of class c. The stores record this in
+their `class_offset` (1) and `nodata` (0) attributes.
+
+"""
+import os
+import time
+import h5py
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader
+
+import datasets
+import inference
+import util
+
+from constants import *
+from tqdm import tqdm
+
+# torch.inference_mode is not available in older torch versions
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+class HDF5Store(object):
+    """ Writes predictions grid by grid to an hdf5 file
+    """
+    def __init__(self, path, attrs):
+        self.out = h5py.File(path, 'w')
+        self.out.attrs.update(attrs)
+
+    def add(self, grid, class_map, probs):
+        self.out.create_dataset(f'class_map/{grid}', data=class_map, compression='gzip')
+        if probs is not None:
+            self.out.create_dataset(f'probs/{grid}', data=probs, compression='gzip')
+
+    def close(self):
+        self.out.close()
+
+class NpzStore(object):
+    """ Collects predictions and writes them to a compressed npz file on close
+    """
+    def __init__(self, path, attrs):
+        self.path = path
+        self.arrays = {f'attr_{key}': np.asarray(value) for key, value in attrs.items()}
+
+    def add(self, grid, class_map, probs):
+        self.arrays[f'class_map_{grid}'] = class_map
+        if probs is not None:
+            self.arrays[f'probs_{grid}'] = probs
+
+    def close(self):
+        np.savez_compressed(self.path, **self.arrays)
+
+def get_store(path, attrs):
+    if path.endswith('.npz'):
+        return NpzStore(path, attrs)
+    if path.endswith('.h5') or path.endswith('.hdf5'):
+        return HDF5Store(path, attrs)
+    raise ValueError(f'Unsupported output store: {path}, use .h5 / .hdf5 or .npz')
+
+def get_prediction_loader(args, grid_path):
+    """ Returns the dataset and a loader that keeps the grid order of the dataset, so that
+        batch i holds grids grid_list[i * batch_size:(i + 1) * batch_size]
+    """
+    dataset = datasets.CropTypeDS(args, grid_path, 'test')
+    loader = DataLoader(dataset,
+                        batch_size=args.batch_size,
+                        shuffle=False,
+                        num_workers=args.num_workers,
+                        collate_fn=datasets.collate_var_length if args.var_length else None,
+                        pin_memory=args.device == 'cuda')
+    return dataset, loader
+
+def to_device(inputs, device):
+    if isinstance(inputs, dict):
+        return {key: value.to(device, non_blocking=True) if torch.is_tensor(value) else value
+                for key, value in inputs.items()}
+    return inputs.to(device, non_blocking=True)
+
+def predict(model, model_name, dataset, loader, store, device, save_probs=True):
+    """ Predicts all grids of dataset and adds them to store.
+
+    Returns:
+      stats - (dict) number of grids, throughput in grids/sec and per batch latency in ms
+              (mean, p50, p95, max), latency covers the host to device copy, the forward pass
+              and the copy of the predictions back to the host, not data loading
+    """
+    model.eval()
+    latencies = []
+    grid_idx = 0
+    start = time.time()
+    with inference_mode():
+        for inputs, _, _, hres_inputs in tqdm(loader):
+            batch_start = time.perf_counter()
+            inputs = to_device(inputs, device)
+            if model_name in MULTI_RES_MODELS:
+                preds = model(inputs, to_device(hres_inputs, device) if torch.is_tensor(hres_inputs) else hres_inputs)
+            else:
+                preds = model(inputs)
+            preds = preds.float().cpu()
+            latencies.append((time.perf_counter() - batch_start) * 1000)
+
+            # classes are stored 1-based, 0 is nodata as in the label rasters and scene maps
+            class_maps = (preds.argmax(dim=1) + 1).numpy().astype(np.uint8)
+            probs = preds.exp().numpy().astype(np.float16) if save_probs else [None] * len(class_maps)
+            for class_map, grid_probs in zip(class_maps, probs):
+                store.add(dataset.grid_list[grid_idx], class_map, grid_probs)
+                grid_idx += 1
+
+    elapsed = time.time() - start
+    latencies = np.asarray(latencies) if latencies else np.zeros(1)
+    return {'num_grids': grid_idx,
+            'grids_per_sec': grid_idx / elapsed if elapsed > 0 else float('inf'),
+            'latency_mean_ms': float(np.mean(latencies)),
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p95_ms': float(np.percentile(latencies, 95)),
+            'latency_max_ms': float(np.max(latencies))}
+
+def get_grid_path(args):
+    if args.grid_path is not None:
+        return args.grid_path
+    return datasets.get_grid_path(args.country, args.dataset, args.split)
+
+def add_predict_args(parser):
+    parser.add_argument('--split', type=str, default='test', choices=SPLITS,
+                        help="Split to predict, ignored if --grid_path is set")
+    parser.add_argument('--grid_path', type=str, default=None,
+                        help="Pickled list of grids to predict instead of a split")
+    parser.add_argument('--out_path', type=str, required=True,
+                        help="Output store, .h5 / .hdf5 or .npz, class maps store crop class c as c + 1 and 0 as nodata")
+    parser.add_argument('--save_probs', type=util.str2bool, default=True,
+                        help="Store class probabilities next to the class maps")
+    return parser
+
+if __name__ == "__main__":
+    parser = add_predict_args(util.get_train_parser())
+    args = parser.parse_args()
+
+    if args.model_path is None and args.quantized_path is None:
+        if args.name is None:
+            raise ValueError('Set --model_path or --name of the run whose _best model to load')
+        args.model_path = os.path.join(args.save_dir, args.name + "_best")
+
+    device = inference.get_device(args)
+    model = inference.load_model(args, device)
+    dataset, loader = get_prediction_loader(args, get_grid_path(args))
+    store = get_store(args.out_path, {'model_name': args.model_name, 'country': args.country,
+                                      'model_path': args.model_path or args.quantized_path,
+                                      'class_offset': 1, 'nodata': 0})
+    try:
+        stats = predict(model, args.model_name, dataset, loader, store, device, args.save_probs)
+    finally:
+        store.close()
+
+    print(f"Predicted {stats['num_grids']} grids at {stats['grids_per_sec']:.2f} grids/sec")
+    print(f"Batch latency: mean {stats['latency_mean_ms']:.1f} ms, p50 {stats['latency_p50_ms']:.1f} ms, "
+          f"p95 {stats['latency_p95_ms']:.1f} ms, max {stats['latency_max_ms']:.1f} ms")
+    print(f"Predictions saved to {args.out_path}")
@@ -47,33 +47,6 @@ def reshapeForLoss(y):
     y = y.contiguous().view(-1, y.shape[3])
     return y
 
-def maskForLoss(y_pred, y_true):
-    """
-    Masks y_pred and y_true with valid pixel locations. 
-
-    Args:    
-      y_true - (torch tensor) torch.Size([batch_size*img_height*img_width, num_classes]) 
-                tensor of ground truth crop classes
-      y_pred - (torch tensor) torch.Size([batch_size*img_height*img_width, num_classes])
-                tensor of predicted crop classes
-
-    Returns: 
-      y_true - (torch tensor) torch.Size([batch_size*img_height*img_width]) 
-                tensor of ground truth crop classes, argmaxed
-      y_pred - (torch tensor) torch.Size([batch_size*img_height*img_width, num_classes])
-                tensor of predicted crop classes
-    """
-    loss_mask = torch.sum(y_true, dim=1).type(torch.LongTensor)
-
-    loss_mask_repeat = loss_mask.unsqueeze(1).repeat(1,y_pred.shape[1]).type(torch.FloatTensor).cuda()
-    y_pred = y_pred * loss_mask_repeat
-   
-    # take argmax to get true values from one-hot encoding 
-    _, y_true = torch.max(y_true, dim=1)
-    y_true = y_true * loss_mask
-
-    return y_pred, y_true
-
 def maskForMetric(y_pred, y_true):
     """
     Masks y_pred and y_true with valid pixel locations for metric calculations and returns 
@@ -102,6 +75,61 @@ def maskForMetric(y_pred, y_true):
     y_pred = y_pred[loss_mask == 1]
     return y_pred, y_true
 
+def is_index_label(y_true):
+    """ Whether labels are integer class maps (--int_labels) rather than one-hot masks
+    """
+    return not torch.is_floating_point(y_true)
+
+def flattenForLoss(y_pred, y_true):
+    """
+    Flattens predictions and labels in a single pass so that the loss and metrics
+     can share them (see train.evaluate).
+
+    Args:    
+      y_true - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width]) 
+                one-hot ground truth, or torch.Size([batch_size, img_height, img_width])
+                integer class map with IGNORE_INDEX for unlabeled pixels
+      y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
+                tensor of predicted crop classes
+
+    Returns: 
+      y_pred - (torch tensor) torch.Size([batch_size*img_height*img_width, num_classes])
+                tensor of predicted crop classes
+      y_true - (torch tensor) torch.Size([batch_size*img_height*img_width]) 
+                tensor of ground truth crop classes, IGNORE_INDEX where unlabeled
+    """
+    y_pred = reshapeForLoss(y_pred)
+    y_true = y_true.to(y_pred.device)
+    if is_index_label(y_true):
+        return y_pred, y_true.reshape(-1).long()
+
+    # labeled pixels are the ones with a hot class, no permute needed for the labels
+    valid = torch.sum(y_true, dim=1).reshape(-1) > 0
+    y_true = torch.argmax(y_true, dim=1).reshape(-1)
+    y_true = torch.where(valid, y_true, torch.full_like(y_true, IGNORE_INDEX))
+    return y_pred, y_true
+
+def maskIndexForMetric(y_pred, y_true):
+    """
+    Returns vectors of only valid locations for metric calculations given integer labels
+
+    Args:    
+      y_true - (torch tensor) torch.Size([batch_size, img_height, img_width]) 
+                tensor of ground truth crop classes, IGNORE_INDEX where unlabeled
+      y_pred - (torch tensor) torch.Size([batch_size, num_classes, img_height, img_width])
+                tensor of predicted crop classes
+
+    Returns: 
+      y_true - (torch tensor) torch.Size([valid_pixel_locations]) 
+                tensor of ground truth crop classes
+      y_pred - (torch tensor) torch.Size([valid_pixel_locations])
+                tensor of predicted crop classes, argmaxed
+    """
+    y_true = y_true.reshape(-1).to(y_pred.device)
+    y_pred = torch.argmax(y_pred, dim=1).reshape(-1)
+    valid = y_true != IGNORE_INDEX
+    return y_pred[valid], y_true[valid]
+
 def onehot_mask(mask, num_classes):
     """
     Return a one-hot version of the mask for a grid
@@ -119,12 +147,71 @@ def onehot_mask(mask, num_classes):
       Returns a mask of size [64 x 64 x num_classes]. If a pixel was unlabeled, 
       it has 0's in all channels of the one hot mask at that pixel location.
     """
+    mask = clean_mask(mask, num_classes)
+    return (mask[:, :, np.newaxis] == np.arange(1, num_classes+1)).astype(np.float32)
+
+def index_mask(mask, num_classes):
+    """
+    Return an integer class map version of the mask for a grid
+
+    Args: 
+      mask - (np array) mask for grid that contains crop labels according 
+             to '/home/data/crop_dict.npy'
+      num_classes - (int) number of classes, as in onehot_mask
+
+    Returns: 
+      Returns a mask of size [64 x 64] of classes 0 to num_classes-1. If a pixel 
+      was unlabeled, it has the value IGNORE_INDEX.
+    """
+    mask = clean_mask(mask, num_classes).astype(np.int64)
+    return np.where(mask > 0, mask - 1, IGNORE_INDEX)
+
+def clean_mask(mask, num_classes):
+    """ Maps labels outside of the classes used to unlabeled (0)
+    """
+    mask = np.array(mask, dtype=np.int64)
     if num_classes == 2:
         # TODO: why do we treat this as a separate case?
         mask[(mask != 2) & (mask > 0)] = 1
     else:
         mask[mask > num_classes] = 0
-    return np.eye(num_classes+1)[mask][:, :, 1:] 
+    return mask
+
+def vegetation_indices(data, satellite, num_bands):
+    """ Computes NDVI and GCVI for s2 or planet data
+
+    Args:
+      data - (npy array) [bands, rows, cols, timestamps] unnormalized data
+      satellite - (str) 's2' or 'planet'
+      num_bands - (int) number of bands in data, selects the band indices
+
+    Returns:
+      ndvi, gcvi - (npy arrays) [rows, cols, timestamps], 0 where undefined
+    """
+    bands = BANDS[satellite][str(num_bands)]
+    nir, red, green = data[bands['NIR']], data[bands['RED']], data[bands['GREEN']]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = (nir - red) / (nir + red)
+        gcvi = (nir / green) - 1 
+
+    ndvi[(nir + red) == 0] = 0
+    gcvi[green == 0] = 0
+    return ndvi, gcvi
+
+def normalize_doy(doy_vec):
+    """ Normalizes day of year values to [-1, 1]
+    """
+    return (doy_vec - 177.5) / 177.5
+
+def doy2vec(doy_vec):
+    """ Creates a compact day of year input, to be broadcast to bands inside the model
+    Args:
+      doy_vec - (vector) vector of day of year values 
+
+    Returns: 
+      doy - (tensor) [timestamps] normalized doy values
+    """
+    return torch.tensor(normalize_doy(np.asarray(doy_vec, dtype=np.float32)), dtype=torch.float32)
 
 def doy2stack(doy_vec, in_shp):
     """ Creates input bands for day of year values
@@ -139,7 +226,7 @@ def doy2stack(doy_vec, in_shp):
     assert t == len(doy_vec)
 
     # normalize
-    doy_vec = (doy_vec - 177.5) / 177.5
+    doy_vec = normalize_doy(doy_vec)
     doy = torch.from_numpy(doy_vec)
 
     # create feature bands filled with the doy values
@@ -218,7 +305,7 @@ def preprocess_clouds(clouds, model_name, time_slice=None, transform=False, rot=
     
     raise ValueError(f'Model: {model_name} unsupported')
 
-def preprocess_label(label, model_name, num_classes=None, transform=False, rot=None):
+def preprocess_label(label, model_name, num_classes=None, transform=False, rot=None, int_labels=False):
     """ Returns a preprocess version of the label based on the model.
 
     Usually this just means converting to a one hot representation and 
@@ -227,18 +314,20 @@ def preprocess_label(label, model_name, num_classes=None, transform=False, rot=N
     Args:
         label - (npy arr) categorical labels for each pixel
         model_name - (str) name of the model
+        int_labels - (bool) if True, return an integer class map instead of a one hot mask
     Returns:
-        (npy arr) [num_classes x 64 x 64]
+        (npy arr) [num_classes x 64 x 64], or [64 x 64] if int_labels
     """
     # TODO: make this into a constant somewhere so we don't have to keep adding models
     if model_name in ["bidir_clstm", "fcn", "fcn_crnn", "unet", "unet3d", "random_forest", "mi_clstm", "only_clstm_mi"]:
         assert not num_classes is None
-        return preprocessLabel(label, num_classes, transform, rot)
+        return preprocessLabel(label, num_classes, transform, rot, int_labels)
     
     raise ValueError(f'Model: {model_name} unsupported')
     
-def preprocessLabel(label, num_classes, transform, rot):
+def preprocessLabel(label, num_classes, transform, rot, int_labels=False):
     """ Converts to onehot encoding and shifts channels to be first dim.
+    If int_labels, converts to an int64 class map with IGNORE_INDEX for unlabeled pixels.
 
     Args:
         label - (npy arr) [64x64] categorical labels for each pixel
@@ -247,6 +336,8 @@ def preprocessLabel(label, num_classes, transform, rot):
     if transform:
         label = np.fliplr(label)
         label = np.rot90(label, k=rot)
+    if int_labels:
+        return torch.from_numpy(index_mask(label, num_classes))
     label = onehot_mask(label, num_classes)
     label = np.transpose(label, [2, 0, 1])
     label = torch.tensor(label.copy(), dtype=torch.float32)
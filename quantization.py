@@ -0,0 +1,177 @@
+"""
+
+Post training int8 quantization for CPU inference
+
+Two modes are supported:
+  dynamic - nn.Linear layers are quantized dynamically (weights int8, activations quantized on the fly)
+  static  - in addition, every nn.Conv2d is wrapped in a quant / dequant pair and quantized statically,
+            with activation ranges calibrated on a few val batches. Normalization, recurrent gating and
+            the log softmax stay in fp32.
+
+Run
+
+`python quantization.py --model_name=bidir_clstm --country=ghana --model_path=models/ghana_best --quantize=static
+                        --quantized_path=models/ghana_best_int8`
+
+to report accuracy / F1, throughput and model size of the quantized model against fp32 and to
+save it to --quantized_path. Static quantization is calibrated here, once; inference.py and
+predict.py load the saved model with --quantized_path, so they do not need the training data.
+
+"""
+import argparse
+import copy
+import io
+import time
+import torch
+import torch.nn as nn
+
+from torch.quantization import QuantWrapper, get_default_qconfig, prepare, convert, quantize_dynamic
+
+import datasets
+import inference
+import train
+import util
+
+from constants import *
+from modelling.clstm_segmenter import CLSTMSegmenter
+
+QUANTIZE_MODES = ['none', 'dynamic', 'static']
+QUANTIZABLE_MODELS = ['bidir_clstm', 'fcn_crnn', 'mi_clstm']
+
+def check_quantize_args(args):
+    """ Raises a ValueError if the model or inputs can not be quantized
+    """
+    if args.quantize not in QUANTIZE_MODES:
+        raise ValueError(f'quantize: `{args.quantize}` not supported, use one of {QUANTIZE_MODES}')
+    if args.model_name not in QUANTIZABLE_MODELS:
+        raise ValueError(f'Quantization is only supported for {QUANTIZABLE_MODELS}, got {args.model_name}')
+    if args.include_doy and args.broadcast_doy:
+        # the broadcast doy channels are applied with the float conv weights directly
+        raise ValueError('Quantization does not support --broadcast_doy')
+
+def wrap_convs(module, qconfig):
+    """ Replaces every nn.Conv2d below module with a QuantWrapper, so that only the convs are
+        quantized and their inputs / outputs stay fp32
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            wrapped = QuantWrapper(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            wrap_convs(child, qconfig)
+    return module
+
+def forward(model, model_name, inputs, hres_inputs):
+    if model_name in MULTI_RES_MODELS:
+        return model(inputs, hres_inputs)
+    return model(inputs)
+
+def quantize_model(model, model_name, mode, calib_loader=None, num_calib_batches=10, state_dict=None):
+    """ Returns an int8 quantized copy of model for CPU inference.
+
+    Args:
+      model - (nn.Module) trained fp32 model, or an untrained one when state_dict is given
+      model_name - (str) name of the model
+      mode - (str) "dynamic" or "static", see the module docstring
+      calib_loader - (DataLoader) loader of calibration batches, required for "static"
+                      unless state_dict is given
+      num_calib_batches - (int) number of batches used to calibrate the activation ranges
+      state_dict - (dict) state of a quantized model saved by save_quantized, loaded instead
+                    of calibrating
+
+    Returns:
+      model - (nn.Module) quantized model in eval mode, on the CPU
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    # the fused bidirectional path concatenates the float conv weights of both directions
+    for module in model.modules():
+        if isinstance(module, CLSTMSegmenter):
+            module.fused_bidir = False
+
+    if mode == 'static':
+        if calib_loader is None and state_dict is None:
+            raise ValueError('Static quantization requires a calibration loader or a saved quantized model')
+        wrap_convs(model, get_default_qconfig(torch.backends.quantized.engine))
+        prepare(model, inplace=True)
+        if state_dict is None:
+            with torch.no_grad():
+                for batch_idx, (inputs, _, _, hres_inputs) in enumerate(calib_loader):
+                    if batch_idx == num_calib_batches:
+                        break
+                    forward(model, model_name, inputs, hres_inputs)
+        convert(model, inplace=True)
+    elif mode != 'dynamic':
+        raise ValueError(f'quantize: `{mode}` not supported')
+
+    model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if state_dict is not None:
+        # scales and zero points of the calibrated model replace the uncalibrated ones
+        model.load_state_dict(state_dict)
+    return model
+
+def save_quantized(model, mode, path):
+    """ Saves a model returned by quantize_model, load it with load_quantized
+    """
+    torch.save({'quantize': mode, 'state_dict': model.state_dict()}, path)
+
+def load_quantized(model, model_name, path):
+    """ Returns the quantized model saved at path, model is an fp32 model built with the same args
+    """
+    saved = torch.load(path, map_location='cpu', weights_only=False)
+    return quantize_model(model, model_name, saved['quantize'], state_dict=saved['state_dict'])
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+def throughput(model, model_name, batches):
+    """ Returns grids/sec of the forward pass over cached batches
+    """
+    num_grids = 0
+    with torch.no_grad():
+        forward(model, model_name, batches[0][0], batches[0][1])
+        start = time.perf_counter()
+        for inputs, hres_inputs in batches:
+            forward(model, model_name, inputs, hres_inputs)
+            num_grids += len(hres_inputs) if torch.is_tensor(hres_inputs) else len(next(iter(inputs.values())))
+    return num_grids / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = util.get_train_parser()
+    parser.add_argument('--split', type=str, default='test', choices=SPLITS,
+                        help="Split to report accuracy / F1 on, calibration always uses val")
+    parser.add_argument('--bench_batches', type=int, default=10,
+                        help="Number of batches the throughput is measured over")
+    args = parser.parse_args()
+    if args.quantize == 'none':
+        args.quantize = 'static'
+    check_quantize_args(args)
+
+    device = torch.device('cpu')
+    dataloaders = datasets.get_dataloaders(args.country, args.dataset, args)
+    fp32 = inference.load_model(argparse.Namespace(**{**vars(args), 'quantize': 'none'}), device)
+    int8 = quantize_model(fp32, args.model_name, args.quantize, dataloaders['val'], args.calib_batches)
+    if args.quantized_path is not None:
+        save_quantized(int8, args.quantize, args.quantized_path)
+        print(f'Saved the quantized model to {args.quantized_path}')
+
+    batches = []
+    for inputs, _, _, hres_inputs in dataloaders[args.split]:
+        batches.append((inputs, hres_inputs))
+        if len(batches) == args.bench_batches:
+            break
+
+    results = {}
+    for name, model in [('fp32', fp32), (f'int8 {args.quantize}', int8)]:
+        _, f1, accuracy = train.evaluate_split(model, args.model_name, dataloaders[args.split], device,
+                                               args.loss_weight, args.weight_scale, args.gamma if args.focal_loss else None,
+                                               NUM_CLASSES[args.country], args.country, args.var_length)
+        results[name] = (float(accuracy), float(f1), throughput(model, args.model_name, batches), model_size_mb(model))
+
+    fp32_speed = results['fp32'][2]
+    print(f'{args.model_name} on {args.country} {args.split}, {torch.get_num_threads()} threads')
+    for name, (accuracy, f1, grids_per_sec, size_mb) in results.items():
+        print(f'{name:>14}: accuracy {accuracy:.4f}, f1 {f1:.4f}, {grids_per_sec:8.2f} grids/sec '
+              f'({grids_per_sec / fp32_speed:.2f}x), {size_mb:.1f} MB')
@@ -7,25 +7,45 @@ The types of values that can be generated are specified in the functions below.
 
 run with:
 
-python random_search.py --model_name fcn_crnn --dataset full --epochs 2 --batch_size_range="(1, 5)" --crnn_num_layers_range="(1, 1)" --lr_range="(10, -5, -1)" --hidden_dims_range="(2, 3, 7)" --weight_scale_range="(.5, 2)" --gamma_range="(0, 2)" --weight_decay_range="(10, -5, 0)" --momentum_range="(.5, .999)" --optimizer_range="('adam', 'adam')" --num_samples=3 --patience_range="(1, 5)" --use_s1_range="()" --use_s2_range="()" --apply_transforms_range="()" --sample_w_clouds_range="()" --include_clouds_range="()" --include_doy_range="()" --bidirectional_range="()"
-
+python random_search.py --model_name fcn_crnn --dataset full --epochs 27 --batch_size_range="(1, 5)" --crnn_num_layers_range="(1, 1)" --lr_range="(10, -5, -1)" --hidden_dims_range="(2, 3, 7)" --weight_scale_range="(.5, 2)" --weight_decay_range="(10, -5, 0)" --patience_range="(1, 5)" --use_s1_range="(True, False)" --use_s2_range="(True, False)" --num_samples=60 --parallel_trials=4
+
+Trials run concurrently in a pool of --parallel_trials processes, each capped to --threads_per_trial
+CPU threads (and, with several GPUs, spread over them). With --asha, trials are compared at
+rungs of grace_epochs * reduction_factor^k epochs (asynchronous successive halving) and a trial
+stops when its best val F1 so far is not in the top 1 / reduction_factor of the trials that
+reached the rung before it, so most of the budget goes to the promising ones.
+
+Trials, their hyperparameters, status and rung results are kept in the SQLite --store.
+Rerunning the same command resumes the search: finished trials are kept, interrupted trials
+continue from their last training checkpoint and new trials are sampled up to --num_samples.
+The output of every trial is written to LOG_DIR/NAME.log. A trial process that dies (i.e. killed
+when out of memory) takes the pool down, the interrupted trials are set back to pending and rerun
+in a new pool, up to --max_pool_restarts times.
+
+Trials are grouped by the hyperparameters that change the data (datasets.CACHE_ARGS, i.e.
+use_s1, use_s2, include_clouds, s2_num_bands). Before a group is submitted, its grids are read,
+band selected and aggregated once into --cache_dir, and all trials of the group train from that
+cache; timestep sampling (num_timesteps, least_cloudy) and augmentation still run per item.
 
 """
 
 
 import argparse
-import datetime
+import contextlib
+import hashlib
+import json
+import multiprocessing
 import os
+import sqlite3
 import train 
-import pickle
 import numpy as np
 import util
 import datasets
-import os
 import models
 import torch
-import sys
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from constants import *
 from ast import literal_eval
 
@@ -75,20 +95,242 @@ def str2tuple(arg):
     """
     return literal_eval(arg)
 
-def recordMetadata(args, experiment_name, hps, train_loss, train_f1, train_acc, val_loss, val_f1, val_acc):
+def recordMetadata(args, experiment_name, hps, status, best_val_f1, epochs):
     with open(os.path.join(args.save_dir, experiment_name + ".log"), 'w') as f:
         f.write('HYPERPARAMETERS:\n')
-        for hp in hps:
-            hp_val = args.__dict__[hp]
+        for hp, hp_val in hps.items():
             if type(hp_val) == float:
                 hp_val = '%.3f'%hp_val 
             f.write(f'{hp}:{hp_val}\n')
-        f.write(f"Best Performance (val): \n\t loss: {val_loss} \n\t f1: {val_f1}\n\t acc:{val_acc}\n")
-        f.write(f"Corresponding Train Performance: \n\t loss: {train_loss} \n\t f1: {train_f1}\n\t acc:{train_acc}\n")
+        f.write(f"Status: {status} after {epochs} epochs\n")
+        f.write(f"Best Performance (val): \n\t f1: {best_val_f1}\n")
+
+def to_python(value):
+    """ Converts numpy scalars to python values, so they can be stored as json
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+class TrialStore(object):
+    """ SQLite store of the trials of a search and of the val F1 they reached at the ASHA rungs.
+
+    Every process opens its own connection, sqlite serializes the writes of concurrent trials.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('CREATE TABLE IF NOT EXISTS trials (trial_id INTEGER PRIMARY KEY, name TEXT, hps TEXT, '
+                          'status TEXT, best_val_f1 REAL, epochs INTEGER, error TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rungs (trial_id INTEGER, rung INTEGER, val_f1 REAL, '
+                          'PRIMARY KEY (trial_id, rung))')
+
+    def add_trial(self, trial_id, name, hps):
+        self.conn.execute('INSERT INTO trials (trial_id, name, hps, status, best_val_f1, epochs) VALUES (?, ?, ?, ?, 0, 0)',
+                          (trial_id, name, json.dumps(hps), 'pending'))
+
+    def trials(self):
+        rows = self.conn.execute('SELECT * FROM trials ORDER BY trial_id').fetchall()
+        return [dict(dict(row), hps=json.loads(row['hps'])) for row in rows]
+
+    def status(self, trial_id):
+        row = self.conn.execute('SELECT status FROM trials WHERE trial_id = ?', (trial_id,)).fetchone()
+        return row['status'] if row is not None else None
+
+    def update_trial(self, trial_id, **fields):
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        self.conn.execute(f'UPDATE trials SET {columns} WHERE trial_id = ?', (*fields.values(), trial_id))
+
+    def report(self, trial_id, rung, val_f1, reduction_factor):
+        """ Records the val F1 of a trial at a rung and returns whether the trial should continue
+        """
+        with self.conn:
+            # read and write in one transaction, so concurrent trials see each other's results
+            self.conn.execute('BEGIN IMMEDIATE')
+            rung_f1s = [row['val_f1'] for row in self.conn.execute('SELECT val_f1 FROM rungs WHERE rung = ? AND trial_id != ?',
+                                                                   (rung, trial_id))]
+            self.conn.execute('INSERT OR REPLACE INTO rungs VALUES (?, ?, ?)', (trial_id, rung, val_f1))
+        return asha_continue(rung_f1s, val_f1, reduction_factor)
+
+    def close(self):
+        self.conn.close()
+
+def asha_rungs(grace_epochs, reduction_factor, max_epochs):
+    """ Returns the epoch counts at which ASHA compares trials, grace_epochs * reduction_factor^k
+    """
+    rungs = []
+    epochs = grace_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    return rungs
+
+def asha_continue(rung_f1s, val_f1, reduction_factor):
+    """ Whether val_f1 is in the top 1 / reduction_factor of the val F1s already recorded at a rung,
+        the first trial to reach a rung always continues
+    """
+    if len(rung_f1s) == 0:
+        return True
+    return val_f1 >= np.percentile(rung_f1s, (1 - 1 / reduction_factor) * 100)
+
+class AshaCallback(object):
+    """ Epoch callback of train.train that records the progress of a trial and stops it when it
+        falls out of the top 1 / reduction_factor at a rung
+    """
+    def __init__(self, store, trial_id, rungs, reduction_factor, best_val_f1=0):
+        self.store = store
+        self.trial_id = trial_id
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+        self.best_val_f1 = best_val_f1
+        self.pruned = False
+
+    def __call__(self, epoch, val_f1):
+        self.best_val_f1 = max(self.best_val_f1, val_f1)
+        self.store.update_trial(self.trial_id, best_val_f1=self.best_val_f1, epochs=epoch + 1)
+        if epoch + 1 not in self.rungs:
+            return False
+        rung = self.rungs.index(epoch + 1)
+        self.pruned = not self.store.report(self.trial_id, rung, self.best_val_f1, self.reduction_factor)
+        return self.pruned
+
+def get_train_args(search_range, hps, name):
+    argv = ['--model_name', search_range.model_name, 
+            '--dataset', search_range.dataset, 
+            '--country', search_range.country,
+            '--device', search_range.device,
+            '--num_workers', str(search_range.num_workers),
+            '--metrics_sink', search_range.metrics_sink]
+    if search_range.env_name is not None:
+        argv += ['--env_name', search_range.env_name]
+    if search_range.cache_dir:
+        argv += ['--cache_dir', search_range.cache_dir]
+    train_args = util.get_train_parser().parse_args(argv)
+    train_args.__dict__.update(hps)
+    train_args.epochs = search_range.epochs
+    train_args.name = name
+    # interrupted trials continue from their last checkpoint, names are unique per store and hyperparameters
+    train_args.resume = True
+    return train_args
+
+def sample_hps(search_range, sample_no):
+    """ Samples the hyperparameters of a trial, seeded by the trial number so that a resumed
+        search samples the same trials
+    """
+    np.random.seed(search_range.seed + sample_no)
+    train_args = get_train_args(search_range, {}, None)
+    generate_hps(train_args, search_range)
+    sampled = [arg[:arg.find("range") - 1] for arg in vars(search_range) if "range" in arg and vars(search_range)[arg] is not None]
+    return {hp: to_python(train_args.__dict__[hp]) for hp in sampled + ['use_s1', 'use_s2']}
+
+def trial_hash(search_range, hps):
+    """ Short hash of the store and hyperparameters of a trial. Part of the trial name, so that
+        trials of other searches sharing save_dir never resume each other's checkpoints
+    """
+    key = json.dumps({'store': os.path.abspath(search_range.store), 'hps': hps}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:8]
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+def run_trial(search_range, rungs, trial):
+    """ Trains a trial in a pool worker, returns its id, status and best val F1
+    """
+    os.makedirs(search_range.log_dir, exist_ok=True)
+    with open(os.path.join(search_range.log_dir, trial['name'] + '.log'), 'a') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        store = TrialStore(search_range.store)
+        store.update_trial(trial['trial_id'], status='running')
+        train_args = get_train_args(search_range, trial['hps'], trial['name'])
+        use_cuda = train_args.device == 'cuda'
+        if use_cuda:
+            torch.cuda.set_device(trial['trial_id'] % torch.cuda.device_count())
+        util.random_seed(seed_value=train_args.seed, use_cuda=use_cuda)
+        os.makedirs(train_args.save_dir, exist_ok=True)
+
+        dataloaders = datasets.get_dataloaders(train_args.country, train_args.dataset, train_args)
+        model = models.get_model(**vars(train_args))
+        model.to(train_args.device)
+        callback = AshaCallback(store, trial['trial_id'], rungs, search_range.reduction_factor, trial['best_val_f1'])
+        print("="*100)
+        print(f"TRAINING: {trial['name']}")
+        for hp, hp_val in trial['hps'].items():
+            print(hp, hp_val)
+        train.train(model, train_args.model_name, train_args, dataloaders=dataloaders, epoch_callback=callback) 
+
+        status = 'pruned' if callback.pruned else 'done'
+        store.update_trial(trial['trial_id'], status=status)
+        store.close()
+    return trial['trial_id'], status, callback.best_val_f1
+
+def group_trials(search_range, trials):
+    """ Groups trials by data settings, so that each group builds its grid cache once
+    """
+    groups = {}
+    for trial in trials:
+        key = datasets.get_cache_key(get_train_args(search_range, trial['hps'], trial['name']))
+        groups.setdefault(key, []).append(trial)
+    return groups
+
+def run_pool(search_range, store, groups, rungs, threads, crashes):
+    """ Runs the groups of trials in a process pool, returns the ids of the trials that were
+        interrupted by a pool worker dying (i.e. killed when out of memory), set back to pending
+
+    A dead worker breaks the whole pool and it is not known which trial it ran, so every trial
+    that was running counts a crash in crashes; trials with more than --max_pool_restarts
+    crashes are marked failed instead.
+    """
+    interrupted = []
+
+    def interrupt(trial):
+        running = store.status(trial['trial_id']) == 'running'
+        if running:
+            crashes[trial['trial_id']] = crashes.get(trial['trial_id'], 0) + 1
+        if crashes.get(trial['trial_id'], 0) > search_range.max_pool_restarts:
+            store.update_trial(trial['trial_id'], status='failed', error='trial process died')
+            print(f"FAILED: {trial['name']}: trial process died {crashes[trial['trial_id']]} times")
+        else:
+            # resumes from its last training checkpoint in the next pool
+            store.update_trial(trial['trial_id'], status='pending')
+            interrupted.append(trial['trial_id'])
+
+    # spawn, as forked workers cannot use CUDA
+    with ProcessPoolExecutor(max_workers=search_range.parallel_trials, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(threads,)) as pool:
+        futures = {}
+        for group in groups.values():
+            if search_range.cache_dir:
+                # built here while the trials of earlier groups train
+                train_args = get_train_args(search_range, group[0]['hps'], group[0]['name'])
+                try:
+                    datasets.build_caches(train_args.country, train_args.dataset, train_args)
+                except Exception as e:
+                    for trial in group:
+                        store.update_trial(trial['trial_id'], status='failed', error=repr(e))
+                    print(f"FAILED: building the cache of {len(group)} trials: {e!r}")
+                    continue
+            for trial in group:
+                try:
+                    futures[pool.submit(run_trial, search_range, rungs, trial)] = trial
+                except BrokenProcessPool:
+                    interrupt(trial)
+
+        for future in as_completed(futures):
+            trial = futures[future]
+            try:
+                trial_id, status, best_val_f1 = future.result()
+            except BrokenProcessPool:
+                interrupt(trial)
+                continue
+            except Exception as e:
+                # a failing trial (i.e. out of memory with a large batch size) does not stop the search
+                store.update_trial(trial['trial_id'], status='failed', error=repr(e))
+                print(f"FAILED: {trial['name']}: {e!r}")
+                continue
+            print(f"{status.upper()}: {trial['name']}, best val f1: {best_val_f1}")
+    return interrupted
 
 def generate_hps(train_args, search_range):
     for arg in vars(search_range):
-        if "range" not in arg: continue
+        if "range" not in arg or vars(search_range)[arg] is None: continue
         hp = arg[:arg.find("range") - 1]
         if hp in INT_POWER_EXP:
             hp_val = generate_int_power_HP(vars(search_range)[arg][0], vars(search_range)[arg][1], vars(search_range)[arg][2])
@@ -120,92 +362,72 @@ if __name__ ==  "__main__":
     search_parser.add_argument('--num_samples', type=int,
                         help="number of random searches to perform")
     search_parser.add_argument('--epochs', type=int,
-                        help="number of epochs to train the model for")
-    search_parser.add_argument('--logfile', type=str,
-                        help="file to write logs to; if not specified, prints to terminal")
-    search_parser.add_argument('--hp_dict_name', type=str,
-                        help="name of hp dict, defaults to hp_results.pkl if unspecified",
-                        default="hp_results.pkl")
+                        help="max number of epochs to train each trial for")
     search_parser.add_argument('--env_name', type=str,
                         default=None)
     search_parser.add_argument('--country', type=str,
                         default="ghana")
+    search_parser.add_argument('--device', type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    search_parser.add_argument('--metrics_sink', type=str, default='jsonl',
+                        help="Metrics sink of the trials, see train.py")
+    search_parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the hyperparameter sampling, trial i is sampled with seed + i")
+    search_parser.add_argument('--parallel_trials', type=int, default=2,
+                        help="Number of trials to train concurrently")
+    search_parser.add_argument('--threads_per_trial', type=int, default=None,
+                        help="CPU threads per trial, defaults to the cores split evenly between the trials")
+    search_parser.add_argument('--num_workers', type=int, default=2,
+                        help="Number of data loading workers per trial")
+    search_parser.add_argument('--asha', type=util.str2bool, default=True,
+                        help="Stop unpromising trials early with asynchronous successive halving")
+    search_parser.add_argument('--grace_epochs', type=int, default=1,
+                        help="Epochs of the first ASHA rung")
+    search_parser.add_argument('--reduction_factor', type=int, default=3,
+                        help="Ratio between ASHA rungs, the top 1 / reduction_factor of the trials continue at every rung")
+    search_parser.add_argument('--max_pool_restarts', type=int, default=2,
+                        help="Times a trial is rerun after its process died and took the pool down, before it is marked failed")
+    search_parser.add_argument('--store', type=str, default='random_search.sqlite',
+                        help="SQLite file of the trials, rerun with the same store to resume a search")
+    search_parser.add_argument('--log_dir', type=str, default='random_search_logs',
+                        help="Directory of the trial logs")
+    search_parser.add_argument('--cache_dir', type=str, default='random_search_cache',
+                        help="Directory of the preprocessed grids shared by trials with the same data settings, '' to not cache")
     for hp_type in HPS:
         for hp in hp_type:
             search_parser.add_argument('--' + hp + "_range", type=str2tuple)
     search_range = search_parser.parse_args()
-    #TODO: VERY HACKY, SWITCH TO USING PYTHON LOGGING MODULE OR ACTUALLY USING WRITE CALLS
-    # CURRENTLY CHANGES STDOUT OF THE PROGRAM
-    old_stdout = sys.stdout
-    if search_range.logfile is not None:
-        logfile = open(search_range.logfile, "w")
-        sys.stdout = logfile
-   
-    hps = {}
-    for arg in vars(search_range):
-        if "range" not in arg: continue 
-        hp = arg[:arg.find("range") - 1]
-        hps[hp] = [] 
-
-    experiments = {}
-
-    # for some number of iterations
-    for sample_no in range(search_range.num_samples):
-        # build argparse args by parsing args and then setting empty fields to specified ones above
-        train_parser = util.get_train_parser()
-        train_args = train_parser.parse_args(['--model_name', search_range.model_name, 
-                                              '--dataset', search_range.dataset, 
-                                              '--env_name', search_range.env_name,
-                                              '--country', search_range.country])
-        generate_hps(train_args, search_range) 
-        train_args.epochs = search_range.epochs
-        dataloaders = datasets.get_dataloaders(train_args.country, train_args.dataset, train_args)
-        
-        model = models.get_model(**vars(train_args))
-        model.to(train_args.device)
-        experiment_name = f"model:{train_args.model_name}_dataset:{train_args.dataset}_epochs:{search_range.epochs}_sample_no:{sample_no}"
 
-        train_args.name = experiment_name
-        print("="*100)
-        print(f"TRAINING: {experiment_name}")
-        for hp in hps:
-            print(hp, train_args.__dict__[hp])
-        try: 
-            train.train(model, train_args.model_name, train_args, dataloaders=dataloaders) 
-            print("FINISHED TRAINING") 
-            for state_dict_name in os.listdir(train_args.save_dir):
-                if (experiment_name + "_best") in state_dict_name:
-                    model.load_state_dict(torch.load(os.path.join(train_args.save_dir, state_dict_name)))
-                    train_loss, train_f1, train_acc = train.evaluate_split(model, train_args.model_name, dataloaders['train'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length)
-                    val_loss, val_f1, val_acc = train.evaluate_split(model, train_args.model_name, dataloaders['val'], train_args.device, train_args.loss_weight, train_args.weight_scale, train_args.gamma, NUM_CLASSES[train_args.country], train_args.country, train_args.var_length)
-                    print(f"Best Performance (val): \n\t loss: {val_loss} \n\t f1: {val_f1}\n\t acc: {val_acc}")
-                    print(f"Corresponding Train Performance: \n\t loss: {train_loss} \n\t f1: {train_f1}\n\t acc: {train_acc}")
-
-                    recordMetadata(train_args, experiment_name, hps, train_loss, train_f1, train_acc, val_loss, val_f1, val_acc)
-
-                    experiments[experiment_name] = [train_loss, train_f1, train_acc, val_loss, val_f1, val_acc]
-                    for hp in hps:
-                        hps[hp].append([train_args.__dict__[hp], train_loss, train_f1, train_acc, val_loss, val_f1, val_acc])
-                    break
-
-
-        except Exception as e:
-            print("CRASHED!")
-            print(e)
-
-        torch.cuda.empty_cache()
-        
-        with open(search_range.hp_dict_name, "wb") as f:
-            pickle.dump(hps, f)
+    store = TrialStore(search_range.store)
+    trials = store.trials()
+    for trial in trials:
+        if trial['status'] == 'running':
+            # interrupted by a previous run of the search
+            store.update_trial(trial['trial_id'], status='pending')
+    for sample_no in range(len(trials), search_range.num_samples):
+        hps = sample_hps(search_range, sample_no)
+        experiment_name = f"model:{search_range.model_name}_dataset:{search_range.dataset}_epochs:{search_range.epochs}_sample_no:{sample_no}_{trial_hash(search_range, hps)}"
+        store.add_trial(sample_no, experiment_name, hps)
+    pending = [trial for trial in store.trials() if trial['status'] == 'pending']
+
+    groups = group_trials(search_range, pending)
+    rungs = asha_rungs(search_range.grace_epochs, search_range.reduction_factor, search_range.epochs) if search_range.asha else []
+    threads = search_range.threads_per_trial or max(1, (os.cpu_count() or 1) // search_range.parallel_trials)
+    print(f"{len(pending)} trials in {len(groups)} data groups to run, {search_range.parallel_trials} at a time, ASHA rungs at epochs {rungs}")
+
+    crashes = {}
+    while groups:
+        interrupted = run_pool(search_range, store, groups, rungs, threads, crashes)
+        rerun = [trial for trial in store.trials() if trial['trial_id'] in interrupted and trial['status'] == 'pending']
+        groups = group_trials(search_range, rerun)
+        if rerun:
+            print(f"A trial process died, restarting the pool for {len(rerun)} interrupted trials")
 
     print("SUMMARY")
-
-    for key, value in sorted(experiments.items(), key=lambda x: x[1][-1], reverse=True):
-        print(key, "\t Val:", value[-2], "\t", value[-1], "\t Train: ", value[0], "\t", value[1])
-    
-    with open(search_range.hp_dict_name, "wb") as f:
-        pickle.dump(hps, f)
-
-    sys.stdout = old_stdout
-    if search_range.logfile is not None:
-        logfile.close()
+    trials = sorted(store.trials(), key=lambda trial: trial['best_val_f1'] or 0, reverse=True)
+    for trial in trials:
+        if trial['status'] in ['done', 'pruned']:
+            train_args = get_train_args(search_range, trial['hps'], trial['name'])
+            recordMetadata(train_args, trial['name'], trial['hps'], trial['status'], trial['best_val_f1'], trial['epochs'])
+        print(trial['name'], "\t", trial['status'], "after", trial['epochs'], "epochs", "\t Val f1:", trial['best_val_f1'])
+    store.close()
@@ -0,0 +1,102 @@
+"""
+Run
+
+`python scripts/benchmark_amp.py --country=ghana`
+
+to report forward + backward + optimizer step time and peak memory of bidir_clstm, fcn_crnn
+and unet3d in fp32 and with --amp (bf16 autocast on CPU, fp16 autocast with loss scaling on GPU).
+
+On GPU peak memory is torch.cuda.max_memory_allocated, on CPU it is the max resident
+set size of a fresh process per setting (so it includes the process baseline).
+
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+
+import loss_fns
+import models
+import train
+import util
+
+from constants import *
+from export import synthetic_batches
+
+MODELS = ['bidir_clstm', 'fcn_crnn', 'unet3d']
+
+def run(bench_args, model_name, amp, device):
+    torch.manual_seed(0)
+    args = util.get_train_parser().parse_args(['--model_name', model_name, '--country', bench_args.country,
+                                               '--batch_size', str(bench_args.batch_size),
+                                               '--num_timesteps', str(bench_args.num_timesteps),
+                                               '--device', device.type, '--amp', str(amp)])
+    model = models.get_model(**vars(args)).to(device)
+    model.train()
+    loss_fn = loss_fns.get_loss_fn(model_name, args.country)
+    optimizer = loss_fns.get_optimizer(model.parameters(), args.optimizer, args.lr, args.momentum, args.weight_decay)
+    autocast, scaler = util.get_amp(amp, device)
+
+    inputs = synthetic_batches(args, 1)[0].to(device)
+    grid_size = GRID_SIZE[args.country]
+    targets = torch.randint(0, NUM_CLASSES[args.country], (args.batch_size, grid_size, grid_size), device=device)
+
+    def step():
+        with autocast():
+            preds = model(inputs, torch.zeros(1)) if model_name in MULTI_RES_MODELS else model(inputs)
+        loss, _, _, _, _ = train.evaluate(model_name, preds, targets, args.country, loss_fn=loss_fn, reduction="sum")
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(bench_args.iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return (time.perf_counter() - start) / bench_args.iters * 1000, peak_mb
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--country', type=str, default='ghana')
+    parser.add_argument('--models', type=str, nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_timesteps', type=int, default=20)
+    parser.add_argument('--iters', type=int, default=3)
+    # internal, runs a single setting and prints the result
+    parser.add_argument('--single', type=str, nargs=2, default=None)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    if args.single is not None:
+        step_ms, peak_mb = run(args, args.single[0], args.single[1] == 'amp', device)
+        print(f'{step_ms} {peak_mb}')
+        sys.exit(0)
+
+    print(f'{device}, batch {args.batch_size}, {args.num_timesteps} timesteps, {args.country} grids')
+    for model_name in args.models:
+        results = {}
+        for setting in ['fp32', 'amp']:
+            if device.type == 'cuda':
+                results[setting] = run(args, model_name, setting == 'amp', device)
+            else:
+                # ru_maxrss never decreases, so measure each setting in a fresh process
+                cmd = [sys.executable, __file__, '--single', model_name, setting] + sys.argv[1:]
+                results[setting] = tuple(map(float, subprocess.check_output(cmd).decode().split()[-2:]))
+        for setting, (step_ms, peak_mb) in results.items():
+            speedup = results['fp32'][0] / step_ms
+            print(f'{model_name:>12} {setting:>4}: {step_ms:9.1f} ms/step ({speedup:.2f}x), peak {peak_mb:9.1f} MB')
@@ -0,0 +1,93 @@
+"""
+Run
+
+`python scripts/benchmark_crnn_checkpoint.py`
+
+to report peak memory and forward + backward step time of a CLSTM and a CGRU
+without checkpointing and with --crnn_checkpoint_steps K for K in {1, 5, 10}.
+
+On GPU peak memory is torch.cuda.max_memory_allocated, on CPU it is the max resident
+set size of a fresh process per setting (so it includes the process baseline).
+
+scripts/check_crnn_checkpoint.py checks that checkpointed train steps give the same
+gradients and per timestep normalization statistics.
+
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+
+from modelling.clstm import CLSTM
+from modelling.cgru import CGRU
+
+def make_crnn(crnn, input_size, hidden_dims, num_layers, checkpoint_steps, device):
+    if crnn == 'clstm':
+        model = CLSTM(input_size, hidden_dims, (3, 3), num_layers)
+    else:
+        model = CGRU(input_size, hidden_dims, (3, 3), num_layers)
+    model.checkpoint_steps = checkpoint_steps
+    return model.to(device)
+
+def run(args, checkpoint_steps, device):
+    torch.manual_seed(0)
+    input_size = (args.num_timesteps, args.num_bands, args.grid_size, args.grid_size)
+    model = make_crnn(args.crnn, input_size, args.hidden_dims, args.num_layers, checkpoint_steps, device)
+    inputs = torch.randn(args.batch_size, *input_size, device=device)
+
+    def step():
+        layer_outputs, _ = model(inputs)
+        layer_outputs = layer_outputs[-1] if isinstance(layer_outputs, list) else layer_outputs
+        layer_outputs.sum().backward()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return (time.perf_counter() - start) / args.iters * 1000, peak_mb
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crnn', type=str, default='clstm', choices=['clstm', 'gru'])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_timesteps', type=int, default=40)
+    parser.add_argument('--num_bands', type=int, default=16)
+    parser.add_argument('--hidden_dims', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=1)
+    parser.add_argument('--grid_size', type=int, default=64)
+    parser.add_argument('--iters', type=int, default=3)
+    # internal, runs a single setting and prints the result
+    parser.add_argument('--single', type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    settings = [0, 1, 5, 10]
+
+    if args.single is not None:
+        step_ms, peak_mb = run(args, args.single or None, device)
+        print(f'{step_ms} {peak_mb}')
+        sys.exit(0)
+
+    print(f'{args.crnn} on {device}, batch {args.batch_size}, {args.num_timesteps} timesteps, {args.grid_size}x{args.grid_size}')
+    for checkpoint_steps in settings:
+        if device.type == 'cuda':
+            step_ms, peak_mb = run(args, checkpoint_steps or None, device)
+        else:
+            # ru_maxrss never decreases, so measure each setting in a fresh process
+            cmd = [sys.executable, __file__, '--single', str(checkpoint_steps)] + sys.argv[1:]
+            step_ms, peak_mb = map(float, subprocess.check_output(cmd).decode().split()[-2:])
+        name = f'K={checkpoint_steps}' if checkpoint_steps else 'no checkpointing'
+        print(f'{name:>18}: {step_ms:9.1f} ms/step, peak {peak_mb:9.1f} MB')
@@ -0,0 +1,137 @@
+"""
+Run
+
+`python scripts/benchmark_evaluate.py --country=ghana`
+
+to time the per batch cost of train.evaluate (loss, correct / valid pixels and confusion
+matrix from one flatten / mask pass) against the evaluate pipeline it replaced, for 64x64 and
+32x32 grids. The baseline is a pinned copy of the old code path: a mask_ce_loss call that
+permutes the predictions and labels, masks them with a repeated [N x classes] mask built on
+the host and builds the weighted NLLLoss per call, followed by metrics.get_cm with its own
+permute and mask, and the pixel counts read off the confusion matrix.
+
+Predictions and labels are random, 80% of the pixels are labeled. Before timing, it checks
+that both give the same loss, pixel counts and confusion matrix, for one-hot and integer labels.
+
+"""
+import argparse
+import os
+import sys
+import time
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import loss_fns
+import metrics
+import preprocess
+import train
+
+from constants import *
+from torch.testing import assert_close
+
+def make_batch(batch_size, num_classes, grid_size, device, int_labels):
+    preds = F.log_softmax(torch.randn(batch_size, num_classes, grid_size, grid_size, device=device), dim=1)
+    classes = torch.randint(0, num_classes, (batch_size, grid_size, grid_size), device=device)
+    labeled = torch.rand(batch_size, grid_size, grid_size, device=device) < 0.8
+    if int_labels:
+        labels = torch.where(labeled, classes, torch.full_like(classes, IGNORE_INDEX))
+    else:
+        labels = F.one_hot(classes, num_classes).permute(0, 3, 1, 2).float()
+        labels = labels * labeled.unsqueeze(1).float()
+    return preds, labels
+
+def old_mask_for_loss(y_pred, y_true):
+    """ preprocess.maskForLoss before the single flatten pass, with .cuda() replaced by the device of y_pred
+    """
+    loss_mask = torch.sum(y_true, dim=1).type(torch.LongTensor)
+    loss_mask_repeat = loss_mask.unsqueeze(1).repeat(1, y_pred.shape[1]).type(torch.FloatTensor).to(y_pred.device)
+    y_pred = y_pred * loss_mask_repeat
+    _, y_true = torch.max(y_true, dim=1)
+    y_true = y_true * loss_mask.to(y_true.device)
+    return y_pred, y_true
+
+def old_mask_ce_loss(y_true, y_pred, loss_weight, weight_scale=1):
+    """ loss_fns.mask_ce_loss with the "sum" reduction before the single flatten pass
+    """
+    device = y_pred.device
+    if preprocess.is_index_label(y_true):
+        y_true = y_true.reshape(-1)
+        num_examples = torch.sum(y_true != IGNORE_INDEX, dtype=torch.float32).to(device)
+        y_pred = preprocess.reshapeForLoss(y_pred)
+    else:
+        y_true = preprocess.reshapeForLoss(y_true)
+        num_examples = torch.sum(y_true, dtype=torch.float32).to(device)
+        y_pred = preprocess.reshapeForLoss(y_pred)
+        y_pred, y_true = old_mask_for_loss(y_pred, y_true)
+    loss_fn = nn.NLLLoss(weight=loss_weight ** weight_scale, ignore_index=IGNORE_INDEX, reduction="none")
+    total_loss = torch.sum(loss_fn(y_pred, y_true.to(device)))
+    if num_examples == 0:
+        return None, None, 0
+    return total_loss, None, num_examples
+
+def separate(model_name, preds, labels, country, loss_weight):
+    """ train.evaluate with the "sum" reduction before the single flatten pass
+    """
+    cm = metrics.get_cm(preds, labels, country, model_name)
+    loss, confidence, _ = old_mask_ce_loss(labels, preds, loss_weight)
+    total_correct, num_pixels = (torch.trace(cm), torch.sum(cm)) if cm is not None else (0, 0)
+    return loss, cm, total_correct, num_pixels, confidence
+
+def fused(model_name, preds, labels, country, loss_fn):
+    return train.evaluate(model_name, preds, labels, country, loss_fn=loss_fn, reduction="sum")
+
+def check_equivalence(model_name, country, loss_fn, loss_weight, batch_size, device):
+    """ Asserts that train.evaluate gives the same loss, correct / valid pixel counts and confusion
+        matrix as the pinned old path, for one-hot and integer labels with unlabeled pixels
+    """
+    num_classes = NUM_CLASSES[country]
+    for int_labels in [False, True]:
+        for grid_size in [64, 32]:
+            preds, labels = make_batch(batch_size, num_classes, grid_size, device, int_labels)
+            old_loss, old_cm, old_correct, old_pixels, _ = separate(model_name, preds, labels, country, loss_weight)
+            loss, cm, correct, pixels, _ = fused(model_name, preds, labels, country, loss_fn)
+            assert_close(loss, old_loss)
+            assert_close(cm, torch.as_tensor(old_cm, device=cm.device), check_dtype=False)
+            assert int(correct) == int(old_correct) and int(pixels) == int(old_pixels)
+            if int_labels:
+                assert int(pixels) == int(torch.sum(labels != IGNORE_INDEX))
+
+def time_fn(fn, args, iters, device):
+    for _ in range(5):
+        fn(*args)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        out = fn(*args)
+        # pull the counts to the host as the training loop eventually does
+        float(out[2]), float(out[3])
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--country', type=str, default='ghana')
+    parser.add_argument('--model_name', type=str, default='bidir_clstm')
+    parser.add_argument('--batch_size', type=int, default=5)
+    parser.add_argument('--iters', type=int, default=100)
+    parser.add_argument('--int_labels', action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    loss_fn = loss_fns.get_loss_fn(args.model_name, args.country, loss_weight=True)
+    # the old pipeline kept the class weights on the GPU
+    loss_weight = LOSS_WEIGHT[args.country].to(device)
+    num_classes = NUM_CLASSES[args.country]
+
+    check_equivalence(args.model_name, args.country, loss_fn, loss_weight, args.batch_size, device)
+    print('loss, pixel counts and confusion matrices match the old path')
+    for grid_size in [64, 32]:
+        preds, labels = make_batch(args.batch_size, num_classes, grid_size, device, args.int_labels)
+        separate_ms = time_fn(separate, (args.model_name, preds, labels, args.country, loss_weight), args.iters, device)
+        fused_ms = time_fn(fused, (args.model_name, preds, labels, args.country, loss_fn), args.iters, device)
+        print(f'{grid_size}x{grid_size}: separate {separate_ms:.3f} ms/batch, fused {fused_ms:.3f} ms/batch, '
+              f'saved {separate_ms - fused_ms:.3f} ms ({100 * (1 - fused_ms / separate_ms):.1f}%)')
@@ -0,0 +1,67 @@
+"""
+Run
+
+`python scripts/check_crnn_checkpoint.py`
+
+to check that a train step of a CLSTM and a CGRU with --crnn_checkpoint_steps K gives the
+same outputs, parameter gradients and per timestep normalization statistics as one without
+checkpointing, on the CPU for K in {1, 2, 4, num_timesteps}.
+
+"""
+import argparse
+import copy
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+
+from torch.testing import assert_close
+from modelling.clstm import CLSTM
+from modelling.cgru import CGRU
+
+def step(model, inputs, out_weights):
+    """ Runs a train step of model, returns its last layer outputs and the parameter gradients
+    """
+    model.train()
+    model.zero_grad()
+    layer_outputs, _ = model(inputs)
+    layer_outputs = layer_outputs[-1] if isinstance(layer_outputs, list) else layer_outputs
+    (layer_outputs * out_weights).sum().backward()
+    grads = {name: param.grad for name, param in model.named_parameters() if param.grad is not None}
+    return layer_outputs.detach(), grads
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_timesteps', type=int, default=6)
+    parser.add_argument('--num_bands', type=int, default=4)
+    parser.add_argument('--hidden_dims', type=int, default=8)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--grid_size', type=int, default=8)
+    parser.add_argument('--rtol', type=float, default=1e-5)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    input_size = (args.num_timesteps, args.num_bands, args.grid_size, args.grid_size)
+    inputs = torch.randn(args.batch_size, *input_size)
+    for crnn in [CLSTM, CGRU]:
+        plain = crnn(input_size, args.hidden_dims, (3, 3), args.num_layers)
+        with torch.no_grad():
+            layer_outputs, _ = copy.deepcopy(plain).eval()(inputs)
+            layer_outputs = layer_outputs[-1] if isinstance(layer_outputs, list) else layer_outputs
+            out_weights = torch.randn_like(layer_outputs)
+
+        for checkpoint_steps in sorted({1, 2, 4, args.num_timesteps}):
+            reference = copy.deepcopy(plain)
+            model = copy.deepcopy(plain)
+            model.checkpoint_steps = checkpoint_steps
+            ref_outputs, ref_grads = step(reference, inputs, out_weights)
+            outputs, grads = step(model, inputs, out_weights)
+
+            assert_close(outputs, ref_outputs, rtol=args.rtol, atol=args.atol)
+            assert_close(grads, ref_grads, rtol=args.rtol, atol=args.atol)
+            assert_close(dict(model.named_buffers()), dict(reference.named_buffers()), rtol=args.rtol, atol=args.atol)
+            print(f'{crnn.__name__}, K={checkpoint_steps}: outputs, gradients and norm statistics match')
+    print('OK')
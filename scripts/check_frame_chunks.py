@@ -0,0 +1,83 @@
+"""
+Run
+
+`python scripts/check_frame_chunks.py`
+
+to check that encoding frames through modelling.util.apply_to_frames (--frame_chunk_size,
+--checkpoint_frames) matches running the per frame UNet on all frames at once: outputs,
+parameter gradients and the BatchNorm running statistics after one train step. Chunking
+the full UNet, whose decoder holds BatchNorm, must be refused in train mode.
+
+"""
+import argparse
+import copy
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+
+from torch.testing import assert_close
+from modelling.unet import UNet, UNet_Encode
+from modelling.util import apply_to_frames
+
+def step(model, frames, out_weights, chunk_size, checkpoint_frames):
+    """ Runs model over frames, and in train mode backward of a weighted sum of the outputs.
+        Returns the outputs and the parameter gradients
+    """
+    model.zero_grad()
+    with torch.set_grad_enabled(model.training):
+        outputs = apply_to_frames(model, frames, None, chunk_size=chunk_size, checkpoint_frames=checkpoint_frames)
+        outputs = [out for out in outputs if out is not None] if isinstance(outputs, tuple) else [outputs]
+        grads = {}
+        if model.training:
+            sum(((out * weight).sum() for out, weight in zip(outputs, out_weights)), frames.new_zeros(())).backward()
+            grads = {name: param.grad for name, param in model.named_parameters() if param.grad is not None}
+    return [out.detach() for out in outputs], grads
+
+def check(name, model, frames, chunk_size, checkpoint_frames, train_mode, args):
+    model.train(train_mode)
+    reference = copy.deepcopy(model)
+    with torch.no_grad():
+        out_weights = [torch.randn_like(out) for out in step(copy.deepcopy(reference).eval(), frames, None, None, False)[0]]
+    ref_outputs, ref_grads = step(reference, frames, out_weights, None, False)
+    outputs, grads = step(model, frames, out_weights, chunk_size, checkpoint_frames)
+
+    assert_close(outputs, ref_outputs, rtol=args.rtol, atol=args.atol)
+    assert_close(grads, ref_grads, rtol=args.rtol, atol=args.atol)
+    assert_close(dict(model.named_buffers()), dict(reference.named_buffers()), rtol=args.rtol, atol=args.atol)
+    print(f'{name}, chunk size {chunk_size}, checkpoint {checkpoint_frames}, train {train_mode}: '
+          'outputs, gradients and norm statistics match')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', type=int, default=6)
+    parser.add_argument('--num_bands', type=int, default=4)
+    parser.add_argument('--grid_size', type=int, default=32)
+    parser.add_argument('--chunk_size', type=int, default=4)
+    parser.add_argument('--rtol', type=float, default=1e-7)
+    parser.add_argument('--atol', type=float, default=1e-7)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    num_bands = {'s1': 0, 's2': args.num_bands, 'planet': 0, 'all': args.num_bands}
+    # in double precision, so that the chunked sums of the gradients round the same
+    frames = torch.randn(args.num_frames, args.num_bands, args.grid_size, args.grid_size, dtype=torch.float64)
+    unet = UNet(8, num_bands, late_feats_for_fcn=True).double()
+    encoder = UNet_Encode(num_bands).double()
+
+    # the encoder (early_feats) only holds GroupNorm, chunking is exact in train mode as well
+    for chunk_size, checkpoint_frames in [(args.chunk_size, False), (args.chunk_size, True), (None, True)]:
+        check('encoder', encoder, frames, chunk_size, checkpoint_frames, True, args)
+    # the full UNet decodes with BatchNorm, checkpointing must not update its running stats twice
+    check('unet', unet, frames, None, True, True, args)
+    check('unet', unet, frames, args.chunk_size, False, False, args)
+
+    unet.train()
+    try:
+        apply_to_frames(unet, frames, None, chunk_size=args.chunk_size)
+    except ValueError:
+        print('unet, chunked in train mode: refused')
+    else:
+        raise AssertionError('chunking the BatchNorm decoder in train mode was not refused')
+    print('OK')
@@ -0,0 +1,77 @@
+"""
+Run
+
+`python scripts/check_fused_bidir.py`
+
+to check that the fused bidirectional CLSTM (--fused_bidir) matches running the forward
+and reverse CLSTMs one after the other: outputs in train and eval mode, parameter gradients
+and the updated normalization statistics, with and without a day of year scalar. Runs on
+the CPU, pass --device=cuda to also check the GPU kernels.
+
+"""
+import argparse
+import copy
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import torch
+
+from torch.testing import assert_close
+from modelling.clstm_segmenter import CLSTMSegmenter
+
+def run(model, inputs, doy, train_mode, out_weights):
+    """ Returns the outputs of model, and in train mode the gradients of a weighted sum of
+        them with respect to the parameters
+    """
+    model.train(train_mode)
+    model.zero_grad()
+    with torch.set_grad_enabled(train_mode):
+        out_fwd, out_rev = model(inputs, doy=doy)
+        grads = {}
+        if train_mode:
+            loss = (out_fwd * out_weights[0]).sum() + (out_rev * out_weights[1]).sum()
+            loss.backward()
+            grads = {name: param.grad for name, param in model.named_parameters() if param.grad is not None}
+    return out_fwd.detach(), out_rev.detach(), grads
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_timesteps', type=int, default=6)
+    parser.add_argument('--num_bands', type=int, default=4)
+    parser.add_argument('--grid_size', type=int, default=16)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--rtol', type=float, default=1e-5)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    for use_doy in [False, True]:
+        input_size = (args.num_timesteps, args.num_bands + int(use_doy), args.grid_size, args.grid_size)
+        two_pass = CLSTMSegmenter(input_size, [8] * args.num_layers, (3, 3), 3, args.num_layers, 4, bidirectional=True).to(device)
+        fused = copy.deepcopy(two_pass)
+        fused.fused_bidir = True
+
+        inputs = torch.randn(args.batch_size, args.num_timesteps, args.num_bands, args.grid_size, args.grid_size, device=device)
+        doy = torch.rand(args.batch_size, args.num_timesteps, device=device) if use_doy else None
+
+        # in eval mode, so that the normalization statistics are not updated
+        out_shape = run(two_pass, inputs, doy, False, None)[0].shape
+        out_weights = torch.randn(2, *out_shape, device=device)
+
+        for train_mode in [True, False]:
+            two_pass_fwd, two_pass_rev, two_pass_grads = run(two_pass, inputs, doy, train_mode, out_weights)
+            fused_fwd, fused_rev, fused_grads = run(fused, inputs, doy, train_mode, out_weights)
+
+            assert_close(fused_fwd, two_pass_fwd, rtol=args.rtol, atol=args.atol)
+            assert_close(fused_rev, two_pass_rev, rtol=args.rtol, atol=args.atol)
+            # the conv biases ahead of the norms have a zero true gradient, in fp32 it is left as
+            # cancellation noise on the scale of the largest gradients
+            grad_scale = max([grad.abs().max().item() for grad in two_pass_grads.values()], default=1)
+            assert_close(fused_grads, two_pass_grads, rtol=args.rtol, atol=args.atol * grad_scale)
+            assert_close(dict(fused.named_buffers()), dict(two_pass.named_buffers()), rtol=args.rtol, atol=args.atol)
+            print(f'doy: {use_doy}, train: {train_mode}: outputs, gradients and norm statistics match')
+    print('OK')
@@ -4,12 +4,16 @@ Script for training and evaluating a model
 
 """
 import os
+import time
+import checkpoints
 import loss_fns
 import models
 import datetime
 import torch
 import datasets
+import distributed
 import metrics
+import preprocess
 import util
 import numpy as np
 import pickle 
@@ -19,13 +23,12 @@ from torch import autograd
 from constants import *
 from tqdm import tqdm
 from torch import autograd
-import visualize
+import metrics_sinks
 
-def evaluate_split(model, model_name, split_loader, device, loss_weight, weight_scale, gamma, num_classes, country, var_length):
-    total_loss = 0
-    total_pixels = 0
-    total_cm = np.zeros((num_classes, num_classes)).astype(int) 
-    loss_fn = loss_fns.get_loss_fn(model_name)
+def evaluate_split(model, model_name, split_loader, device, loss_weight, weight_scale, gamma, num_classes, country, var_length, amp=False):
+    split_cm = metrics.ConfusionMatrix(num_classes)
+    loss_fn = loss_fns.get_loss_fn(model_name, country, loss_weight, weight_scale, gamma)
+    autocast, _ = util.get_amp(amp, device)
     for inputs, targets, cloudmasks, hres_inputs in split_loader:
         with torch.set_grad_enabled(False):
             if not var_length:
@@ -38,47 +41,47 @@ def evaluate_split(model, model_name, split_loader, device, loss_weight, weight_
             hres_inputs.to(device)
             if hres_inputs is not None: hres_inputs.to(device)
 
-            preds = model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else model(inputs)   
-            batch_loss, batch_cm, _, num_pixels, confidence = evaluate(model_name, preds, targets, country, loss_fn=loss_fn, reduction="sum", loss_weight=loss_weight, weight_scale=weight_scale, gamma=gamma)
-            total_loss += batch_loss.item()
-            total_pixels += num_pixels
-            total_cm += batch_cm
+            with autocast():
+                preds = model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else model(inputs)   
+            batch_loss, batch_cm, _, num_pixels, confidence = evaluate(model_name, preds, targets, country, loss_fn=loss_fn, reduction="sum")
+            split_cm.add(batch_cm, batch_loss)
 
-    f1_avg = metrics.get_f1score(total_cm, avg=True)
-    acc_avg = sum([total_cm[i][i] for i in range(num_classes)]) / np.sum(total_cm) 
-    return total_loss / total_pixels, f1_avg, acc_avg 
+    return split_cm.loss(), split_cm.f1score(avg=True), split_cm.accuracy() 
 
-def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None, loss_weight=None, weight_scale=None, gamma=None):
+def evaluate(model_name, preds, labels, country, loss_fn=None, reduction=None):
     """ Evalautes loss and metrics for predictions vs labels.
 
     Args:
         preds - (tensor) model predictions
         labels - (npy array / tensor) ground truth labels
-        loss_fn - (function) function that takes preds and labels and outputs some loss metric
+        loss_fn - (loss_fns.MaskCELoss) loss object that takes labels, preds and reduction
         reduction - (str) "avg" or "sum", where "avg" calculates the average accuracy for each batch
                                           where "sum" tracks total correct and total pixels separately
-        loss_weight - (bool) whether we use weighted loss function or not
 
     Returns:
         loss - (float) the loss the model incurs
-        cm - (nparray) confusion matrix given preds and labels
+        cm - (nparray) confusion matrix given preds and labels, for DL models a 
+              tensor on the device of preds
         accuracy - (float) given "avg" reduction, returns accuracy 
         total_correct - (int) given "sum" reduction, gives total correct pixels
         num_pixels - (int) given "sum" reduction, gives total number of valid pixels
     """
-    cm = metrics.get_cm(preds, labels, country, model_name)
-    
     if model_name in NON_DL_MODELS:
+        cm = metrics.get_cm(preds, labels, country, model_name)
         accuracy = metrics.get_accuracy(model_name, preds, labels, reduction=reduction)
         return None, cm, accuracy, None
     elif model_name in DL_MODELS:
         if reduction == "avg":
-            loss, confidence = loss_fn(labels, preds, reduction, country, loss_weight, weight_scale)
+            cm = metrics.get_cm(preds, labels, country, model_name)
+            loss, confidence = loss_fn(labels, preds, reduction)
             accuracy = metrics.get_accuracy(model_name, labels, model_name, reduction=reduction)
             return loss, cm, accuracy, confidence
         elif reduction == "sum":
-            loss, confidence, _ = loss_fn(labels, preds, reduction, country, loss_weight, weight_scale) 
-            total_correct, num_pixels = metrics.get_accuracy(model_name, preds, labels, reduction=reduction)
+            # permute / mask once and share the flattened tensors between the loss and the metrics
+            y_pred, y_true = preprocess.flattenForLoss(preds, labels)
+            loss, confidence, _ = loss_fn(y_true, y_pred, reduction)
+            cm = metrics.flat_cm(y_pred, y_true, len(CM_LABELS[country]))
+            total_correct, num_pixels = torch.trace(cm), torch.sum(cm)
             return loss, cm, total_correct, num_pixels, confidence
         else:
             raise ValueError(f"reduction: `{reduction}` not supported")
@@ -116,29 +119,99 @@ def train_non_dl_model(model, model_name, dataloaders, args, X, y):
         print('{} accuracy: {} +/- {}'.format(split, np.mean(results[f'{split}_acc']), np.std(results[f'{split}_acc'])))
         print('{} f1-score: {} +/- {}'.format(split, np.mean(results[f'{split}_f1']), np.std(results[f'{split}_f1'])))
 
-def train_dl_model(model, model_name, dataloaders, args):
+def optimizer_step(model, optimizer, scaler, clip_val, metrics_sink, log_gradnorm):
+    """ Clips the accumulated gradients, updates the weights and resets the gradients
+
+    Args:
+        clip_val - (float) max gradient norm, None to not clip
+        log_gradnorm - (bool) whether to log the gradient norm, which syncs it to the host
+    """
+    if clip_val is not None or log_gradnorm:
+        # clip and log the norm of the unscaled gradients
+        scaler.unscale_(optimizer)
+    if clip_val is not None:
+        # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
+        # it returns the total (pre-clipping) norm, reuse it for logging
+        gradnorm = torch.nn.utils.clip_grad_norm_(model.parameters(), clip_val)
+    elif log_gradnorm:
+        gradnorm = util.grad_norm(model.parameters())
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad()
+
+    if log_gradnorm:
+        # only sync the norm to the host every gradnorm_interval steps
+        metrics_sink.update_progress('train', 'gradnorm', float(gradnorm))
+
+def train_dl_model(model, model_name, dataloaders, args, epoch_callback=None):
+    """ Trains a deep learning model, see train
+
+    Args:
+        epoch_callback - (function) called with the epoch and val F1 after every epoch,
+          training stops when it returns True (i.e. when a hyperparameter search prunes the run)
+    """
     splits = ['train', 'val'] if not args.eval_on_test else ['test']
     
+    clip_val = None
     if args.clip_val:
         clip_val = sum(p.numel() for p in model.parameters() if p.requires_grad) // 20000
         print('clip value: ', clip_val)
 
-    # set up information lists for visdom    
-    vis_logger = visualize.VisdomLogger(args.env_name, model_name, args.country, splits)
-    loss_fn = loss_fns.get_loss_fn(model_name)
+    # set up the metrics sink (visdom, local files or none)
+    metrics_sink = metrics_sinks.get_metrics_sink(args, model_name, splits)
+    loss_fn = loss_fns.get_loss_fn(model_name, args.country, args.loss_weight, args.weight_scale, args.gamma if args.focal_loss else None)
     optimizer = loss_fns.get_optimizer(model.parameters(), args.optimizer, args.lr, args.momentum, args.weight_decay)
+    # with --amp the forward pass runs in bf16 (CPU) / fp16 (GPU), the scaler is a no-op unless fp16
+    autocast, scaler = util.get_amp(args.amp, args.device)
+    # decays the lr on val F1 plateaus and stops runs that stopped improving
+    lr_schedule = loss_fns.get_lr_schedule(optimizer, args)
     best_val_f1 = 0
+    train_step = 0
+    start_epoch = 0
+
+    checkpoint_path = checkpoints.get_checkpoint_path(args)
+    checkpoint_writer = None
+    if args.checkpoint_every and not args.eval_on_test and distributed.is_main():
+        checkpoint_writer = checkpoints.CheckpointWriter(checkpoint_path)
+    if args.resume:
+        checkpoint = checkpoints.load_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            print(f'No checkpoint at {checkpoint_path}, starting from epoch 0')
+        else:
+            distributed.unwrap(model).load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scaler.load_state_dict(checkpoint['scaler'])
+            if checkpoint.get('lr_schedule') is not None:
+                # checkpoints written before the lr schedule was saved start with a fresh schedule
+                lr_schedule.load_state_dict(checkpoint['lr_schedule'])
+            metrics_sink.load_state_dict(checkpoint['metrics'])
+            start_epoch = checkpoint['epoch'] + 1
+            train_step = checkpoint['train_step']
+            best_val_f1 = checkpoint['best_val_f1']
+            # restored last, so that the data order continues where the run stopped
+            checkpoints.set_rng_state(checkpoint['rng'])
+            print(f'Resuming from {checkpoint_path} at epoch {start_epoch}')
     
-    for i in range(args.epochs if not args.eval_on_test else 1):
+    num_epochs = args.epochs if not args.eval_on_test else 1
+    for i in range(start_epoch, num_epochs):
         print('Epoch: {}'.format(i))
+        stop_reason = None
         
-        vis_logger.reset_epoch_data()
+        metrics_sink.reset_epoch_data()
         
         for split in ['train', 'val'] if not args.eval_on_test else ['test']:
             dl = dataloaders[split]
+            if hasattr(dl, 'set_epoch'):
+                dl.set_epoch(i)
             model.train() if split == ['train'] else model.eval()
+            # evaluation shards differ in size between ranks, so they skip the DistributedDataParallel 
+            #  wrapper and its collectives
+            split_model = model if split == 'train' else distributed.unwrap(model)
+            split_start, split_grids = time.time(), 0
+            micro_step = 0
+            optimizer.zero_grad()
             # TODO: figure out how to pack inputs from dataloader together in the case of variable length sequences
-            for inputs, targets, cloudmasks, hres_inputs in tqdm(dl):
+            for inputs, targets, cloudmasks, hres_inputs in tqdm(dl, disable=not distributed.is_main()):
                 with torch.set_grad_enabled(True):
                     if not args.var_length:
                         inputs.to(args.device)
@@ -148,67 +221,106 @@ def train_dl_model(model, model_name, dataloaders, args):
                             if "length" not in sat:
                                 inputs[sat].to(args.device)
                     targets.to(args.device)
-                    preds = model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else model(inputs)
-                    loss, cm_cur, total_correct, num_pixels, confidence = evaluate(model_name, preds, targets, args.country, loss_fn=loss_fn, 
-                                              reduction="sum", loss_weight=args.loss_weight, weight_scale=args.weight_scale, gamma=args.gamma)
+                    with autocast():
+                        preds = split_model(inputs, hres_inputs) if model_name in MULTI_RES_MODELS else split_model(inputs)
+                    loss, cm_cur, total_correct, num_pixels, confidence = evaluate(model_name, preds, targets, args.country, loss_fn=loss_fn, reduction="sum")
  
+                    if split == 'train' and loss is None and distributed.is_initialized():
+                        # all ranks have to take part in every gradient all-reduce
+                        loss = preds.sum() * 0
+
                     if split == 'train' and loss is not None:         # TODO: not sure if we need this check?
-                        # If there are valid pixels, update weights
-                        optimizer.zero_grad()
+                        # If there are valid pixels, accumulate gradients and update weights every accum_steps
+                        #  micro-batches. The loss is summed over pixels, so the accumulated gradient is the
+                        #  gradient of the effective (micro-batch x accum_steps x world size) batch. The
+                        #  all-reduce averages the gradients over ranks, scaling by the world size keeps the sum
                         #with autograd.detect_anomaly():
-                        loss.backward()
-                        if args.clip_val:
-                            # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-                            torch.nn.utils.clip_grad_norm_(model.parameters(), clip_val)
-                        optimizer.step()
-                       
-                        total_norm = 0 
-                        for p in model.parameters():
-                            if p.grad is not None:
-                                param_norm = p.grad.data.norm(2)
-                                total_norm += param_norm.item() ** 2
-                        gradnorm = total_norm ** (1. / 2)
-                        #gradnorm = torch.norm(list(model.parameters())[0].grad).detach().cpu() / torch.prod(torch.tensor(list(model.parameters())[0].shape), dtype=torch.float32)
-
-                        vis_logger.update_progress('train', 'gradnorm', gradnorm)
+                        with distributed.no_sync(model, (micro_step + 1) % args.accum_steps != 0):
+                            scaler.scale(loss * distributed.world_size()).backward()
+                        micro_step += 1
+                        if micro_step % args.accum_steps == 0:
+                            train_step += 1
+                            optimizer_step(model, optimizer, scaler, clip_val, metrics_sink, train_step % args.gradnorm_interval == 0)
+                            lr_schedule.step_batch()
                     
                     if cm_cur is not None: # TODO: not sure if we need this check?
                         # If there are valid pixels, update metrics
-                        vis_logger.update_epoch_all(split, cm_cur, loss, total_correct, num_pixels)
+                        metrics_sink.update_epoch_all(split, cm_cur, loss, total_correct, num_pixels)
                 
-                vis_logger.record_batch(inputs, cloudmasks, targets, preds, confidence, 
-                                        NUM_CLASSES[args.country], split, 
-                                        args.include_doy, args.use_s1, args.use_s2, 
-                                        model_name, args.time_slice, var_length=args.var_length)
+                metrics_sink.record_batch(inputs, cloudmasks, targets, preds, confidence, 
+                                          NUM_CLASSES[args.country], split, 
+                                          args.include_doy, args.use_s1, args.use_s2, 
+                                          model_name, args.time_slice, var_length=args.var_length)
+                split_grids += targets.shape[0]
+
+            if split == 'train' and micro_step % args.accum_steps != 0:
+                # update with the remaining micro-batches of the epoch, their gradients were not all-reduced yet
+                distributed.all_reduce_grads(model)
+                train_step += 1
+                optimizer_step(model, optimizer, scaler, clip_val, metrics_sink, train_step % args.gradnorm_interval == 0)
+                lr_schedule.step_batch()
+
+            metrics_sink.log_scalar(split, 'throughput', split_grids / (time.time() - split_start), i)
+            if split == 'train':
+                metrics_sink.log_scalar(split, 'lr', lr_schedule.lr, i)
 
             if split in ['test']:
-                vis_logger.record_epoch(split, i, args.country, save=False, save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
+                metrics_sink.record_epoch(split, i, args.country, save=False, save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
             else:
-                vis_logger.record_epoch(split, i, args.country)
+                metrics_sink.record_epoch(split, i, args.country)
 
             if split == 'val':
-                val_f1 = metrics.get_f1score(vis_logger.epoch_data['val_cm'], avg=True)                 
+                # the val confusion matrix is summed over ranks, so all ranks take the same lr / stopping decisions
+                val_f1 = metrics.get_f1score(metrics_sink.epoch_data['val_cm'], avg=True)                 
+                lr_schedule.step_epoch(val_f1)
+                if epoch_callback is not None and epoch_callback(i, val_f1):
+                    stop_reason = 'Stopped by the epoch callback'
 
                 if val_f1 > best_val_f1:
-                    torch.save(model.state_dict(), os.path.join(args.save_dir, args.name + "_best"))
+                    if distributed.is_main():
+                        torch.save(distributed.unwrap(model).state_dict(), os.path.join(args.save_dir, args.name + "_best"))
                     best_val_f1 = val_f1
                     if args.save_best: 
                         # TODO: Ideally, this would save any batch except the last one so that the saved images
                         #  are not only the remainder from the last batch 
-                        vis_logger.record_batch(inputs, cloudmasks, targets, preds, confidence, 
-                                                NUM_CLASSES[args.country], split, 
-                                                args.include_doy, args.use_s1, args.use_s2, 
-                                                model_name, args.time_slice, save=True, var_length=args.var_length, 
-                                                save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
+                        metrics_sink.record_batch(inputs, cloudmasks, targets, preds, confidence, 
+                                                  NUM_CLASSES[args.country], split, 
+                                                  args.include_doy, args.use_s1, args.use_s2, 
+                                                  model_name, args.time_slice, save=True, var_length=args.var_length, 
+                                                  save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))
 
-                        vis_logger.record_epoch(split, i, args.country, save=True, 
+                        metrics_sink.record_epoch(split, i, args.country, save=True, 
                                               save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))               
 
-                        vis_logger.record_epoch('train', i, args.country, save=True, 
+                        metrics_sink.record_epoch('train', i, args.country, save=True, 
                                               save_dir=os.path.join(args.save_dir, args.name + "_best_dir"))               
 
+        if lr_schedule.should_stop:
+            stop_reason = f'Val F1 did not improve for {lr_schedule.epochs_since_best} epochs'
+
+        if checkpoint_writer is not None and ((i + 1) % args.checkpoint_every == 0 or i + 1 == num_epochs or stop_reason):
+            checkpoint_writer.write({'model': distributed.unwrap(model).state_dict(),
+                                     'optimizer': optimizer.state_dict(),
+                                     'scaler': scaler.state_dict(),
+                                     'lr_schedule': lr_schedule.state_dict(),
+                                     'metrics': metrics_sink.state_dict(),
+                                     'epoch': i,
+                                     'train_step': train_step,
+                                     'best_val_f1': best_val_f1,
+                                     'rng': checkpoints.rng_state(),
+                                     'args': vars(args)})
+
+        if stop_reason:
+            print(f'{stop_reason}, stopping after epoch {i}')
+            break
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+    # wait for the queued records to be logged
+    metrics_sink.close()
+
             
-def train(model, model_name, args=None, dataloaders=None, X=None, y=None):
+def train(model, model_name, args=None, dataloaders=None, X=None, y=None, epoch_callback=None):
     """ Trains the model on the inputs
     
     Args:
@@ -218,6 +330,8 @@ def train(model, model_name, args=None, dataloaders=None, X=None, y=None):
         dataloaders - (dict of dataloaders) used only for DL models
         X - (npy arr) data for non-dl models
         y - (npy arr) labels for non-dl models
+        epoch_callback - (function) called with the epoch and val F1 after every epoch, 
+          stops training when it returns True; used only for DL models
     """
     if dataloaders is None and model_name in DL_MODELS: raise ValueError("DATA GENERATOR IS NONE")
     if args is None and model_name in DL_MODELS: raise ValueError("Args is NONE")
@@ -225,7 +339,7 @@ def train(model, model_name, args=None, dataloaders=None, X=None, y=None):
     if model_name in NON_DL_MODELS:
         train_non_dl_model(model, model_name, dataloaders, args, X, y)
     elif model_name in DL_MODELS:
-        train_dl_model(model, model_name, dataloaders, args)
+        train_dl_model(model, model_name, dataloaders, args, epoch_callback)
     else:
         raise ValueError(f"Unsupported model name: {model_name}")
 
@@ -236,6 +350,7 @@ if __name__ == "__main__":
     parser = util.get_train_parser()
 
     args = parser.parse_args()
+    distributed.init(args)
 
     if args.seed is not None:
         if args.device == 'cuda':
@@ -257,12 +372,17 @@ if __name__ == "__main__":
     if args.model_name in DL_MODELS and args.device == 'cuda' and torch.cuda.is_available():
         model.to(args.device)
 
+    if args.model_name in DL_MODELS:
+        # a no-op without --distributed
+        model = distributed.wrap_model(model)
+
     if args.name is None:
+        if args.resume:
+            raise ValueError('--resume needs the --name of the run to resume')
         args.name = str(datetime.datetime.now()) + "_" + args.model_name
 
     
-    if not os.path.exists(args.save_dir):
-        os.mkdir(args.save_dir)
+    os.makedirs(args.save_dir, exist_ok=True)
         
     print(args.save_dir)
     # train model
@@ -271,9 +391,10 @@ if __name__ == "__main__":
     # evaluate model
 
     # save model
-    if args.model_name in DL_MODELS:
-        torch.save(model.state_dict(), os.path.join(args.save_dir, args.name))
+    if args.model_name in DL_MODELS and distributed.is_main():
+        torch.save(distributed.unwrap(model).state_dict(), os.path.join(args.save_dir, args.name))
         print("MODEL SAVED")
+    distributed.cleanup()
      
     
     
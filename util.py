@@ -41,6 +41,31 @@ def dates2doy(dates):
     data = np.array(data)
     return data
 
+def grad_norm(parameters):
+    """ Returns the total L2 norm of the gradients of parameters as a tensor on their device,
+        computed with one fused norm over all gradients instead of a host sync per parameter
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return torch.tensor(0.)
+    if hasattr(torch, '_foreach_norm'):
+        norms = torch._foreach_norm(grads, 2)
+    else:
+        norms = [grad.norm(2) for grad in grads]
+    return torch.stack(norms).norm(2)
+
+def get_amp(amp, device):
+    """ Returns an autocast context factory and a grad scaler for mixed precision.
+
+    bf16 autocast on the CPU; fp16 autocast with loss scaling on the GPU. Without amp
+    both are no-ops.
+    """
+    device_type = 'cuda' if str(device).startswith('cuda') and torch.cuda.is_available() else 'cpu'
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    autocast = lambda: torch.autocast(device_type, dtype=dtype, enabled=amp)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and device_type == 'cuda')
+    return autocast, scaler
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -315,7 +340,7 @@ def get_train_parser():
                         help="Momentum to use when training",
                         default=.9)
     parser.add_argument('--lrdecay', type=float,
-                        help="Learning rate decay per **batch**",
+                        help="Learning rate decay per **batch** (optimizer step), 1 to disable",
                         default=1)
     parser.add_argument('--shuffle', type=str2bool,
                         help="shuffle dataset between epochs?",
@@ -360,6 +385,9 @@ def get_train_parser():
     parser.add_argument('--loss_weight', type=str2bool,
                         help="weighted cross entropy loss",
                         default=True)
+    parser.add_argument('--focal_loss', type=str2bool,
+                        help="use the focal loss with --gamma instead of the masked cross entropy loss",
+                        default=False)
     parser.add_argument('--gamma', type=int,
                         help="weighting factor for focal loss",
                         default=2)
@@ -367,7 +395,7 @@ def get_train_parser():
                         help="power to raise weights by",
                         default=1)
     parser.add_argument('--lr_decay', type=float,
-                        help="Factor to multiply lr by on decay",
+                        help="Factor to multiply lr by when val F1 plateaus, on by default, 1 to disable (constant lr)",
                         default=.5)
     parser.add_argument('--apply_transforms', type=str2bool,
                         help="Apply horizontal flipping / rotation",
@@ -376,10 +404,28 @@ def get_train_parser():
                         help="Apply normalization to input based on overall band means and stds",
                         default=True)
     parser.add_argument('--patience', type=int,
-                        help="Number of epochs before decreasing lr.",
+                        help="Number of epochs without val F1 improvement before decreasing lr.",
                         default=3)
+    parser.add_argument('--early_stop_patience', type=int, default=0,
+                        help="Number of epochs without val F1 improvement before stopping training, 0 (default) to never stop")
     parser.add_argument('--env_name', type=str, default=None,
                          help="Environment name for visdom visualization")
+    parser.add_argument('--metrics_sink', type=str, default='visdom', choices=['visdom', 'jsonl', 'parquet', 'none'],
+                        help="Where training metrics are written, a visdom server, local jsonl / parquet files or nowhere")
+    parser.add_argument('--metrics_dir', type=str, default=None,
+                        help="Output directory of the jsonl / parquet sinks, defaults to SAVE_DIR/NAME_metrics")
+    parser.add_argument('--sink_images', type=str2bool, default=False,
+                        help="Save sampled batch predictions and labels as npz files with the jsonl / parquet sinks")
+    parser.add_argument('--vis_async', type=str2bool, default=True,
+                        help="Write metrics from a background thread, dropping batch records when the queue is full")
+    parser.add_argument('--vis_queue_size', type=int, default=8,
+                        help="Max number of pending metrics records with --vis_async")
+    parser.add_argument('--vis_train_every', type=int, default=10,
+                        help="Record the images of every this many train batches")
+    parser.add_argument('--vis_eval_every', type=int, default=5,
+                        help="Record the images of every this many val / test batches")
+    parser.add_argument('--vis_scalar_every', type=int, default=1,
+                        help="Write scalars (gradnorm, throughput) every this many updates")
     parser.add_argument('--seed', type=int, default=1,
                          help="Random seed to use for reproducability")
     parser.add_argument('--sample_w_clouds', type=str2bool, default=False,
@@ -390,8 +436,12 @@ def get_train_parser():
                          help="Whether to use least cloudy samples (True) or sample from cloudiness (False)")
     parser.add_argument('--include_doy', type=str2bool, default=False,
                          help="Include day of year as input feature")
+    parser.add_argument('--broadcast_doy', type=str2bool, default=False,
+                         help="Pass day of year as a compact [batch x timesteps] input that is broadcast inside the first convolution, instead of stacking it as input bands. Requires --var_length")
     parser.add_argument('--num_timesteps', type=int, default=40,
                         help="Number of timesteps to include")
+    parser.add_argument('--int_labels', type=str2bool, default=False,
+                        help="Load labels as int64 class maps with IGNORE_INDEX for unlabeled pixels instead of one-hot masks")
     # Args for CLSTM model
     parser.add_argument('--hidden_dims', type=int, 
                         help="Number of channels in hidden state used in convolutional RNN",
@@ -408,6 +458,23 @@ def get_train_parser():
     parser.add_argument('--bidirectional', type=str2bool,
                         help='Use bidirectional?',
                         default=False)
+    parser.add_argument('--frame_chunk_size', type=int, default=None,
+                        help="Number of frames (batch*timestamps) encoded at once by the per frame UNet in fcn_crnn / mi_clstm, None for all. "
+                             "In training only with --early_feats, the full UNet decodes with BatchNorm")
+    parser.add_argument('--checkpoint_frames', type=str2bool, default=False,
+                        help="Recompute the per frame UNet activations in backward instead of storing them")
+    parser.add_argument('--crnn_checkpoint_steps', type=int, default=None,
+                        help="Recompute blocks of this many CLSTM / CGRU timesteps in backward instead of storing their activations, None to store all")
+    parser.add_argument('--parallel_sats', type=str2bool, default=False,
+                        help="Run the per satellite branches of mi_clstm concurrently on separate threads")
+    parser.add_argument('--fused_bidir', type=str2bool, default=False,
+                        help="Run the forward and reverse CLSTM directions in the same timestep loop with grouped convs, not with --crnn_checkpoint_steps")
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'dynamic', 'static'],
+                        help="int8 quantization for CPU inference, dynamic for linear layers, static also for convs (calibrated on val by quantization.py)")
+    parser.add_argument('--calib_batches', type=int, default=10,
+                        help="Number of val batches used to calibrate static quantization")
+    parser.add_argument('--quantized_path', type=str, default=None,
+                        help="Quantized model saved by quantization.py, loaded by inference.py / predict.py instead of quantizing")
     parser.add_argument('--avg_hidden_states', type=str2bool, default=True,
                         help="average hidden states for each timestep?")
     # Arguments for number of bands to use
@@ -447,12 +514,28 @@ def get_train_parser():
                          help="Fix pretrained features")
     parser.add_argument('--clip_val', type=str2bool, default=True,
                          help="Whether or not to use gradient clipping, value is computed based on the number of parameters")
+    parser.add_argument('--checkpoint_every', type=int, default=1,
+                        help="Write a resumable checkpoint (SAVE_DIR/NAME_checkpoint) every this many epochs, 0 to disable")
+    parser.add_argument('--resume', type=str2bool, default=False,
+                        help="Resume the run --name from its checkpoint, if there is one")
+    parser.add_argument('--distributed', type=str2bool, default=False,
+                        help="Data-parallel training over torch.distributed ranks, launch with torchrun")
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help="torch.distributed backend")
+    parser.add_argument('--threads_per_rank', type=int, default=None,
+                        help="Intra-op threads per rank, defaults to the CPU cores split evenly between local ranks")
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help="Number of --batch_size micro-batches whose gradients are accumulated per optimizer step")
+    parser.add_argument('--amp', type=str2bool, default=False,
+                        help="Mixed precision, bf16 autocast on CPU and fp16 autocast with loss scaling on GPU")
+    parser.add_argument('--gradnorm_interval', type=int, default=10,
+                        help="Log the gradient norm every this many training steps, each log syncs with the device")
     parser.add_argument('--main_crnn', type=str2bool, default=False,
                          help="Whether or not to use a CRNN in the main encoder at the bottom of the U of the UNet model (for early feats) or just before the prediction (for not early feats)")
     parser.add_argument('--main_attn_type', type=str, default='None',
                          help="Attention type to use for main clstm layer, must be 'None', 'temporal', 'self', or 'vector'")
     parser.add_argument('--enc_attn_type', type=str, default='None',
-                         help="Attention type to use for encoder layers, must be 'None', 'temporal', 'self', or 'vector', self may use up too much memory")
+                         help="Attention type to use for encoder layers, must be 'None', 'temporal', 'self', or 'vector', self attends along time for each pixel")
     parser.add_argument('--d_attn_dim', type=int, default=32,
                          help="Number of features in w_s1 output for temporal attention")
     parser.add_argument('--r_attn_dim', type=int, default=1,
@@ -465,6 +548,8 @@ def get_train_parser():
                          help="Use crnn for encoder layers in addition to the main encodings")
     parser.add_argument('--enc_attn', type=str2bool, default=False,
                          help="Use attn for encoder layers in addition to the main encodings")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                         help="Directory of preprocessed grid caches shared by runs with the same data settings, no caching if unset")
     parser.add_argument('--var_length', action="store_true", default=False,
                          help="use variable length sequences")
     return parser
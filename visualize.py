@@ -17,60 +17,35 @@ import metrics
 import preprocess
 import util
 from constants import * 
+from metrics_sinks import MetricsSink
 
-class VisdomLogger:
-    def __init__(self, env_name, model_name, country, splits, port=8097):
+class VisdomLogger(MetricsSink):
+    """ Metrics sink that plots to a visdom server, see metrics_sinks.MetricsSink for the
+        async_logging, sampling and queue options
+    """
+    def __init__(self, env_name, model_name, country, splits, port=8097, **kwargs):
         env_name = model_name if env_name is None else env_name
         self.vis = visdom.Visdom(port=port, env=env_name)
-        self.country = country
-        
-        self.splits = splits
-        self._init_progress_data()
-        self._init_epoch_data()
-        
-        
-    def _init_progress_data(self):
-        # stores information across epochs
-        self.progress_data = {}
-        for split in self.splits:
-            self.progress_data[f'{split}_loss'] = []
-            self.progress_data[f'{split}_acc'] = []
-            self.progress_data[f'{split}_f1'] = []
-            self.progress_data[f'{split}_classf1'] = None    
-        self.progress_data['train_gradnorm'] = []
-        
-    def _init_epoch_data(self):
-        # stores information per epoch
-        self.epoch_data = {}
-        for split in self.splits:
-            self.epoch_data[f'{split}_loss'] = 0
-            self.epoch_data[f'{split}_correct'] = 0
-            self.epoch_data[f'{split}_pix'] = 0
-            self.epoch_data[f'{split}_cm'] = np.zeros((NUM_CLASSES[self.country], NUM_CLASSES[self.country])).astype(int)
-            
-    def update_progress(self, split, metric_name, value):
-        self.progress_data[f'{split}_{metric_name}'].append(value)
-    
-    def update_epoch_all(self, split, cm_cur, loss, total_correct, num_pixels):
-        self.epoch_data[f'{split}_cm'] += cm_cur
-        self.epoch_data[f'{split}_loss'] += loss.item()
-        self.epoch_data[f'{split}_correct'] += total_correct
-        self.epoch_data[f'{split}_pix'] += num_pixels
-    
-    def reset_epoch_data(self):
-        self.epoch_data = {}
-        for split in self.splits:
-            self.epoch_data[f'{split}_loss'] = 0
-            self.epoch_data[f'{split}_correct'] = 0
-            self.epoch_data[f'{split}_pix'] = 0
-            self.epoch_data[f'{split}_cm'] = np.zeros((NUM_CLASSES[self.country], NUM_CLASSES[self.country])).astype(int)
-    
-    def record_batch(self, inputs, clouds, targets, preds, confidence, 
-                     num_classes, split, include_doy, use_s1, use_s2, 
-                     model_name, time_slice, 
-                     save=False, save_dir=None, show_visdom=True, show_matplot=False, var_length=False):
+        super(VisdomLogger, self).__init__(country, splits, **kwargs)
+
+    def _log_scalar(self, split, metric_name, value, step):
+        title = 'Grad Norm' if metric_name == 'gradnorm' else f'{split} {metric_name}'
+        self.vis.line(Y=np.array([value]), X=np.array([step]), win=title, update='append',
+                      opts={'legend': [f'{split}_{metric_name}'],
+                            'markers': False,
+                            'title': title,
+                            'xlabel': 'Batch' if metric_name == 'gradnorm' else 'Epoch',
+                            'ylabel': metric_name})
+
+    def _record_batch(self, inputs, clouds, targets, preds, confidence, 
+                      num_classes, split, include_doy, use_s1, use_s2, 
+                      model_name, time_slice, 
+                      save, save_dir, show_visdom, show_matplot, var_length):
         
-        label_mask = np.sum(targets.numpy(), axis=1)
+        if preprocess.is_index_label(targets):
+            label_mask = (targets.numpy() != IGNORE_INDEX).astype(np.float32)
+        else:
+            label_mask = np.sum(targets.numpy(), axis=1)
         label_mask = np.expand_dims(label_mask, axis=1)
         if show_visdom:
             visdom_plot_images(self.vis, label_mask, 'Label Masks')
@@ -124,8 +99,11 @@ class VisdomLogger:
             visdom_plot_images(self.vis, boi, 'Input Images') 
 
         # Show targets (labels)
-        disp_targets = np.concatenate((np.zeros_like(label_mask), targets.numpy()), axis=1)
-        disp_targets = np.argmax(disp_targets, axis=1)
+        if preprocess.is_index_label(targets):
+            disp_targets = np.where(targets.numpy() != IGNORE_INDEX, targets.numpy() + 1, 0)
+        else:
+            disp_targets = np.concatenate((np.zeros_like(label_mask), targets.numpy()), axis=1)
+            disp_targets = np.argmax(disp_targets, axis=1)
         disp_targets = np.expand_dims(disp_targets, axis=1)
         disp_targets = visualize_rgb(disp_targets, num_classes)
         if show_visdom:
@@ -141,11 +119,6 @@ class VisdomLogger:
             visdom_plot_images(self.vis, disp_preds, 'Predicted Images')
             visdom_plot_images(self.vis, disp_preds_w_mask, 'Predicted Images with Label Mask')
 
-        # Show gradnorm per batch
-        if show_visdom:
-            if split == 'train':
-                visdom_plot_metric('gradnorm', split, 'Grad Norm', 'Batch', 'Norm', self.progress_data, self.vis)
-
         # TODO: put this into a separate helper function?
         if save:
             save_dir = save_dir.replace(" ", "")
@@ -168,52 +141,29 @@ class VisdomLogger:
             return labels_grid, inputs_grid, targets_grid, preds_grid, predsmask_grid
     
     
-    def record_epoch(self, split, epoch_num, country, save=False, save_dir=None):
-        """ Record values for epoch in visdom
-        """
-        if country in ['ghana', 'southsudan', 'tanzania', 'germany']:
-            class_names = CROPS[country]
-        else:
-            raise ValueError(f"Country {country} not supported in visualize.py, record_epoch")
-
-        if self.epoch_data[f'{split}_loss'] is not None: 
-            loss_epoch = self.epoch_data[f'{split}_loss'] / self.epoch_data[f'{split}_pix']
-        if self.epoch_data[f'{split}_correct'] is not None: 
-            acc_epoch = self.epoch_data[f'{split}_correct'] / self.epoch_data[f'{split}_pix']
-
-        # Don't append if you are saving. Information has already been appended!
-        if save == False:
-            self.progress_data[f'{split}_loss'].append(loss_epoch)
-            self.progress_data[f'{split}_acc'].append(acc_epoch)
-            self.progress_data[f'{split}_f1'].append(metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=True))
-
-            if self.progress_data[f'{split}_classf1'] is None:
-                self.progress_data[f'{split}_classf1'] = metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=False)
-                self.progress_data[f'{split}_classf1'] = np.vstack(self.progress_data[f'{split}_classf1']).T
-            else:
-                self.progress_data[f'{split}_classf1'] = np.vstack((self.progress_data[f'{split}_classf1'], metrics.get_f1score(self.epoch_data[f'{split}_cm'], avg=False)))
-
+    def _record_epoch(self, split, epoch_num, country, class_names, save, save_dir, progress_data, epoch_data):
         for cur_metric in ['loss', 'acc', 'f1']:
-            visdom_plot_metric(cur_metric, split, f'{split} {cur_metric}', 'Epoch', cur_metric, self.progress_data, self.vis)
+            visdom_plot_metric(cur_metric, split, f'{split} {cur_metric}', 'Epoch', cur_metric, progress_data, self.vis)
             if save or split in['test']:
                 save_dir = save_dir.replace(" ", "")
                 save_dir = save_dir.replace(":", "")
                 if not os.path.exists(save_dir):
                     os.makedirs(save_dir) 
-                visdom_save_metric(cur_metric, split, f'{split}{cur_metric}', 'Epoch', cur_metric, self.progress_data, save_dir)
+                visdom_save_metric(cur_metric, split, f'{split}{cur_metric}', 'Epoch', cur_metric, progress_data, save_dir)
 
-        visdom_plot_many_metrics('classf1', split, f'{split}_per_class_f1-score', 'Epoch', 'per class f1-score', class_names, self.progress_data, self.vis)
+        visdom_plot_many_metrics('classf1', split, f'{split}_per_class_f1-score', 'Epoch', 'per class f1-score', class_names, progress_data, self.vis)
 
-        fig = util.plot_confusion_matrix(self.epoch_data[f'{split}_cm'], class_names,
+        fig = util.plot_confusion_matrix(epoch_data[f'{split}_cm'], class_names,
                                          normalize=True,
                                          title='{} confusion matrix, epoch {}'.format(split, epoch_num),
                                          cmap=plt.cm.Blues)
 
         self.vis.matplot(fig, win=f'{split} CM')
         if save or split in ['test']:
-            visdom_save_many_metrics('classf1', split, f'{split}_per_class_f1', 'Epoch', 'per class f1-score', class_names, self.progress_data, save_dir)               
+            visdom_save_many_metrics('classf1', split, f'{split}_per_class_f1', 'Epoch', 'per class f1-score', class_names, progress_data, save_dir)               
             fig.savefig(os.path.join(save_dir, f'{split}_cm.png')) 
-            classification_report(self.epoch_data, split, epoch_num, country, save_dir)
+            classification_report(epoch_data, split, epoch_num, country, save_dir)
+        plt.close(fig)
 
 def clip_boi(boi):
     """ Clip bands of interest outside of 2*std per image sample